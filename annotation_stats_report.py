@@ -0,0 +1,266 @@
+"""Report statistics about an annotations json, per category and overall.
+
+Computes, for each category and for all annotations together:
+
+    - number of annotations and files
+    - mean, std, min and max duration, in frames and in seconds
+    - minimum background duration (see compute_min_background_duration)
+    - prior, i.e. the fraction of frames labeled with the category (only if
+      frame counts are given with --frames_root or --frame_counts_json)
+
+as well as how often each set of categories overlaps. Annotations are loaded
+once; the per-file work is done in parallel and merged. The report is written
+as JSON, and the per-category table optionally as CSV.
+"""
+
+import argparse
+import collections
+import csv
+import glob
+import json
+import logging
+import multiprocessing as mp
+import sys
+
+import numpy as np
+from tqdm import tqdm
+
+from frame_loader_util import parse_frame_path
+from util.annotation import load_annotations_json
+from util.annotation_stats import (compute_file_overlap_counts,
+                                   compute_min_background_duration,
+                                   count_category_frames, get_durations)
+
+CSV_FIELDS = ('category', 'num_annotations', 'num_files',
+              'mean_duration_frames', 'std_duration_frames',
+              'min_duration_frames', 'max_duration_frames',
+              'mean_duration_seconds', 'std_duration_seconds',
+              'min_duration_seconds', 'max_duration_seconds',
+              'min_background_duration', 'prior')
+
+
+def compute_file_stats(args):
+    """Compute statistics for the annotations of one file.
+
+    Args:
+        args (tuple): (filename, file_annotations, num_frames, class_list).
+            num_frames may be None, in which case category frames are not
+            counted.
+
+    Returns:
+        stats (dict)
+    """
+    filename, file_annotations, num_frames, class_list = args
+    by_category = collections.defaultdict(list)
+    for annotation in file_annotations:
+        by_category[annotation.category].append(annotation)
+    categories = {}
+    for category, category_annotations in by_category.items():
+        single_file = {filename: category_annotations}
+        categories[category] = {
+            'durations': get_durations(single_file),
+            'durations_seconds': get_durations(single_file, in_seconds=True),
+            'min_background_duration':
+            compute_min_background_duration(single_file)
+        }
+    overlap_counts, overlap_frame_counts = compute_file_overlap_counts(
+        file_annotations, count_frames=True)
+    category_frames = None
+    if num_frames is not None:
+        category_frames = count_category_frames(file_annotations, num_frames,
+                                                class_list)
+    return {
+        'categories': categories,
+        'min_background_duration':
+        compute_min_background_duration({filename: file_annotations}),
+        'overlap_counts': overlap_counts,
+        'overlap_frame_counts': overlap_frame_counts,
+        'category_frames': category_frames
+    }
+
+
+def _duration_stats(durations, durations_seconds, min_background_duration):
+    durations = np.concatenate(durations)
+    durations_seconds = np.concatenate(durations_seconds)
+    if np.isinf(min_background_duration):
+        min_background_duration = None
+    return collections.OrderedDict([
+        ('mean_duration_frames', durations.mean().item()),
+        ('std_duration_frames', durations.std().item()),
+        ('min_duration_frames', durations.min().item()),
+        ('max_duration_frames', durations.max().item()),
+        ('mean_duration_seconds', durations_seconds.mean().item()),
+        ('std_duration_seconds', durations_seconds.std().item()),
+        ('min_duration_seconds', durations_seconds.min().item()),
+        ('max_duration_seconds', durations_seconds.max().item()),
+        ('min_background_duration', min_background_duration),
+    ])
+
+
+def _overlap_dict(counts):
+    """Convert a dict keyed by category sets to a JSON-compatible dict."""
+    return collections.OrderedDict(
+        ('+'.join(sorted(categories)) or '<background>', count)
+        for categories, count in sorted(counts.items(),
+                                        key=lambda x: (-x[1], sorted(x[0]))))
+
+
+def load_frame_counts(frames_root=None, frame_counts_json=None):
+    """Load number of frames per video.
+
+    Args:
+        frames_root (str): Directory containing <video>/frame<index>.png.
+        frame_counts_json (str): JSON file mapping video name to number of
+            frames.
+
+    Returns:
+        frame_counts (dict): Maps video name to number of frames.
+    """
+    if frame_counts_json is not None:
+        with open(frame_counts_json) as f:
+            return json.load(f)
+    frame_counts = collections.Counter()
+    for frame_path in glob.iglob('{}/*/*.png'.format(frames_root)):
+        frame_info = parse_frame_path(frame_path)
+        if frame_info is not None:
+            frame_counts[frame_info[0]] += 1
+    return dict(frame_counts)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n')[0],
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('annotations_json')
+    parser.add_argument('--output_json',
+                        help='Path to write report to. Defaults to stdout.')
+    parser.add_argument('--output_csv',
+                        help='If specified, write per-category stats here.')
+    frame_counts_group = parser.add_mutually_exclusive_group()
+    frame_counts_group.add_argument('--frames_root',
+                                    help="""Directory containing a
+                                    subdirectory of frames for each video;
+                                    used to count frames for priors.""")
+    frame_counts_group.add_argument('--frame_counts_json',
+                                    help="""JSON file mapping video names to
+                                    number of frames; used for priors.""")
+    parser.add_argument('--use_cache',
+                        action='store_true',
+                        help="""Load annotations through the .npz cache; see
+                        util/annotation_table.py.""")
+    parser.add_argument('--num_processes', default=8, type=int)
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.INFO)
+    logging.basicConfig(format='%(asctime)s.%(msecs).03d: %(message)s',
+                        datefmt='%H:%M:%S')
+
+    annotations = load_annotations_json(args.annotations_json,
+                                        use_cache=args.use_cache)
+    class_list = sorted(set(annotation.category
+                            for file_annotations in annotations.values()
+                            for annotation in file_annotations))
+    logging.info('Loaded %s annotations for %s files, %s categories',
+                 sum(len(x) for x in annotations.values()), len(annotations),
+                 len(class_list))
+
+    frame_counts = None
+    if args.frames_root or args.frame_counts_json:
+        frame_counts = load_frame_counts(args.frames_root,
+                                         args.frame_counts_json)
+        missing = [x for x in annotations if x not in frame_counts]
+        if missing:
+            logging.warning(
+                '%s annotated files have no frame count and are ignored for '
+                'priors; e.g. %s', len(missing), missing[0])
+
+    tasks = [(filename, file_annotations,
+              frame_counts.get(filename) if frame_counts else None,
+              class_list)
+             for filename, file_annotations in sorted(annotations.items())]
+    pool = mp.Pool(args.num_processes)
+    # Maps category to {'durations': [arrays], ..., 'num_files': int}
+    categories = collections.defaultdict(
+        lambda: {'durations': [], 'durations_seconds': [], 'num_files': 0,
+                 'min_background_duration': float('inf')})
+    overlap_counts = collections.Counter()
+    overlap_frame_counts = collections.Counter()
+    category_frames = np.zeros(len(class_list))
+    min_background_duration = float('inf')
+    for stats in tqdm(pool.imap_unordered(compute_file_stats, tasks,
+                                          chunksize=16),
+                      total=len(tasks)):
+        for category, category_stats in stats['categories'].items():
+            merged = categories[category]
+            merged['durations'].append(category_stats['durations'])
+            merged['durations_seconds'].append(
+                category_stats['durations_seconds'])
+            merged['num_files'] += 1
+            merged['min_background_duration'] = min(
+                merged['min_background_duration'],
+                category_stats['min_background_duration'])
+        min_background_duration = min(min_background_duration,
+                                      stats['min_background_duration'])
+        overlap_counts.update(stats['overlap_counts'])
+        overlap_frame_counts.update(stats['overlap_frame_counts'])
+        if stats['category_frames'] is not None:
+            category_frames += stats['category_frames']
+    pool.close()
+
+    priors = None
+    if frame_counts is not None:
+        priors = category_frames / sum(frame_counts.values())
+
+    category_report = collections.OrderedDict()
+    for i, category in enumerate(class_list):
+        merged = categories[category]
+        row = collections.OrderedDict([
+            ('category', category),
+            ('num_annotations', sum(len(x) for x in merged['durations'])),
+            ('num_files', merged['num_files']),
+        ])
+        row.update(
+            _duration_stats(merged['durations'], merged['durations_seconds'],
+                            merged['min_background_duration']))
+        row['prior'] = priors[i].item() if priors is not None else None
+        category_report[category] = row
+
+    overall = collections.OrderedDict([
+        ('num_annotations', sum(x['num_annotations']
+                                for x in category_report.values())),
+        ('num_files', len(annotations)),
+        ('num_categories', len(class_list)),
+    ])
+    if class_list:
+        overall.update(_duration_stats(
+            [x for merged in categories.values()
+             for x in merged['durations']],
+            [x for merged in categories.values()
+             for x in merged['durations_seconds']],
+            min_background_duration))
+    if frame_counts is not None:
+        overall['num_frames'] = sum(frame_counts.values())
+    report = collections.OrderedDict([
+        ('annotations_json', args.annotations_json),
+        ('overall', overall),
+        ('categories', category_report),
+        ('overlap_instance_counts', _overlap_dict(overlap_counts)),
+        ('overlap_frame_counts', _overlap_dict(overlap_frame_counts)),
+    ])
+
+    if args.output_json:
+        with open(args.output_json, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print('')
+    if args.output_csv:
+        with open(args.output_csv, 'w') as f:
+            writer = csv.DictWriter(f, fieldnames=CSV_FIELDS)
+            writer.writeheader()
+            for row in category_report.values():
+                writer.writerow(row)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""Generate a synthetic video corpus for benchmarks.
+
+Creates, in <output_dir>:
+
+    videos/video_<i>.mp4: ffmpeg testsrc videos of the given duration, size
+        and frame rate.
+    video_list.txt: Paths to the videos, one per line (as dump_frames.py
+        expects).
+    annotations.json: Random annotations in the format of
+        util.annotation.load_annotations_json.
+    class_mapping.txt: Lines of the form "<class_id> <class_name>".
+    corpus.json: The parameters used to generate the corpus.
+
+The corpus is fully determined by the arguments (including --seed), so runs
+of benchmarks/run_benchmarks.py on corpora generated with the same arguments
+are comparable.
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import subprocess
+
+from tqdm import tqdm
+
+
+def make_video(output_path, duration, width, height, frames_per_second):
+    cmd = [
+        'ffmpeg', '-y', '-v', 'error', '-f', 'lavfi', '-i',
+        'testsrc=duration={}:size={}x{}:rate={}'.format(
+            duration, width, height, frames_per_second), '-pix_fmt',
+        'yuv420p', output_path
+    ]
+    subprocess.check_output(cmd, stderr=subprocess.STDOUT)
+
+
+def make_annotations(video_name, duration, frames_per_second, class_names,
+                     num_annotations, rng):
+    annotations = []
+    for _ in range(num_annotations):
+        start_seconds = rng.uniform(0, duration)
+        end_seconds = min(duration, start_seconds + rng.uniform(0.5, 3))
+        annotations.append({
+            'filename': video_name,
+            'start_seconds': start_seconds,
+            'end_seconds': end_seconds,
+            'start_frame': int(start_seconds * frames_per_second),
+            'end_frame': int(end_seconds * frames_per_second),
+            'frames_per_second': frames_per_second,
+            'category': rng.choice(class_names)
+        })
+    return annotations
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n')[0],
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('output_dir')
+    parser.add_argument('--num_videos', default=8, type=int)
+    parser.add_argument('--duration',
+                        default=10,
+                        type=float,
+                        help='Duration of each video in seconds.')
+    parser.add_argument('--width', default=320, type=int)
+    parser.add_argument('--height', default=240, type=int)
+    parser.add_argument('--frames_per_second', default=30, type=int)
+    parser.add_argument('--num_classes', default=20, type=int)
+    parser.add_argument('--annotations_per_video', default=10, type=int)
+    parser.add_argument('--seed', default=0, type=int)
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.INFO)
+    logging.basicConfig(format='%(asctime)s.%(msecs).03d: %(message)s',
+                        datefmt='%H:%M:%S')
+
+    video_dir = os.path.join(args.output_dir, 'videos')
+    if not os.path.isdir(video_dir):
+        os.makedirs(video_dir)
+
+    rng = random.Random(args.seed)
+    class_names = ['class_{}'.format(i) for i in range(args.num_classes)]
+    video_paths = []
+    annotations = []
+    for i in tqdm(range(args.num_videos)):
+        video_name = 'video_{:04d}'.format(i)
+        video_path = os.path.abspath(
+            os.path.join(video_dir, video_name + '.mp4'))
+        if not os.path.isfile(video_path):
+            make_video(video_path, args.duration, args.width, args.height,
+                       args.frames_per_second)
+        video_paths.append(video_path)
+        annotations.extend(
+            make_annotations(video_name, args.duration,
+                             args.frames_per_second, class_names,
+                             args.annotations_per_video, rng))
+
+    with open(os.path.join(args.output_dir, 'video_list.txt'), 'w') as f:
+        f.write('\n'.join(video_paths) + '\n')
+    with open(os.path.join(args.output_dir, 'annotations.json'), 'w') as f:
+        json.dump(annotations, f)
+    with open(os.path.join(args.output_dir, 'class_mapping.txt'), 'w') as f:
+        for i, name in enumerate(class_names):
+            f.write('{} {}\n'.format(i, name))
+    with open(os.path.join(args.output_dir, 'corpus.json'), 'w') as f:
+        json.dump(vars(args), f, indent=2)
+    logging.info('Wrote corpus of %s videos to %s', len(video_paths),
+                 args.output_dir)
+
+
+if __name__ == '__main__':
+    main()
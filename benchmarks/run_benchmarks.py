@@ -0,0 +1,288 @@
+"""Time the pipeline's scripts and annotation helpers on a synthetic corpus.
+
+Usage, from the repository root:
+
+    python -m benchmarks.make_corpus /tmp/corpus
+    python -m benchmarks.run_benchmarks /tmp/corpus --output_json run.json
+
+Each benchmark runs in its own subprocess, in order (later benchmarks read
+the outputs of earlier ones, e.g. resize_images reads the frames written by
+dump_frames). For each benchmark, the report contains:
+
+    seconds: Wall clock time.
+    items, items_per_second: Frames processed (or annotations, for the
+        annotation benchmarks).
+    megabytes, megabytes_per_second: Size of the benchmark's input.
+    peak_rss_megabytes: Peak resident set size of the benchmark process or
+        of any of its worker processes (whichever is largest), from wait4.
+
+A benchmark that fails is reported with its return code, and the remaining
+benchmarks still run.
+
+Benchmarks in OPTIONAL_BENCHMARKS need dependencies that are usually not
+installed (frames_to_caffe_datum_proto_lmdb needs caffe), so they only run
+when named with --benchmarks.
+"""
+
+import argparse
+import collections
+import json
+import logging
+import multiprocessing as mp
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import time
+
+REPOSITORY_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def directory_size(root):
+    """Return total size in bytes of files under root."""
+    if os.path.isfile(root):
+        return os.path.getsize(root)
+    total = 0
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            total += os.path.getsize(os.path.join(dirpath, filename))
+    return total
+
+
+class Corpus(object):
+    """Paths and parameters of a corpus created by make_corpus.py."""
+
+    def __init__(self, corpus_dir, work_dir):
+        self.corpus_dir = corpus_dir
+        self.work_dir = work_dir
+        with open(os.path.join(corpus_dir, 'corpus.json')) as f:
+            self.parameters = json.load(f)
+        self.videos = os.path.join(corpus_dir, 'videos')
+        self.video_list = os.path.join(corpus_dir, 'video_list.txt')
+        self.annotations_json = os.path.join(corpus_dir, 'annotations.json')
+        self.class_mapping = os.path.join(corpus_dir, 'class_mapping.txt')
+        self.frames_per_second = self.parameters['frames_per_second']
+        self.frames_per_video = int(
+            round(self.parameters['duration'] * self.frames_per_second))
+        self.num_frames = self.parameters['num_videos'] * self.frames_per_video
+        self.num_annotations = (self.parameters['num_videos'] *
+                                self.parameters['annotations_per_video'])
+
+    def output(self, name):
+        return os.path.join(self.work_dir, name)
+
+
+def _python(*args):
+    return [sys.executable] + [str(x) for x in args]
+
+
+def _function_command(corpus, name):
+    return _python('-m', 'benchmarks.run_benchmarks', corpus.corpus_dir,
+                   '--work_dir', corpus.work_dir, '--run_function', name)
+
+
+# Each benchmark maps a corpus and number of processes to (command, input
+# path, output path, number of items).
+BENCHMARKS = collections.OrderedDict([
+    ('dump_frames', lambda c, n: (
+        _python('dump_frames.py', c.video_list, c.output('frames'), '--fps',
+                0, '--num-workers', n),
+        c.videos, c.output('frames'), c.num_frames)),
+    ('resize_images', lambda c, n: (
+        _python('resize_images.py', c.output('frames'),
+                c.output('frames_resized'), '--shorter_side', 128,
+                '--num_processes', n),
+        c.output('frames'), c.output('frames_resized'), c.num_frames)),
+    ('frames_to_video_frames_proto_lmdb', lambda c, n: (
+        _python('frames_to_video_frames_proto_lmdb.py', c.output('frames'),
+                c.output('video_frames.lmdb'), '--num_processes', n),
+        c.output('frames'), c.output('video_frames.lmdb'), c.num_frames)),
+    ('frames_to_labeled_video_frames_lmdb', lambda c, n: (
+        _python('frames_to_labeled_video_frames_lmdb.py', '--frames_root',
+                c.output('frames'), '--annotations_json', c.annotations_json,
+                '--class_mapping', c.class_mapping, '--output_lmdb',
+                c.output('labeled_video_frames.lmdb'), '--frames_per_second',
+                c.frames_per_second, '--num_processes', n),
+        c.output('frames'), c.output('labeled_video_frames.lmdb'),
+        c.num_frames)),
+    ('frames_to_caffe_datum_proto_lmdb', lambda c, n: (
+        _python('frames_to_caffe_datum_proto_lmdb.py', c.output('frames'),
+                c.output('caffe_datum.lmdb')),
+        c.output('frames'), c.output('caffe_datum.lmdb'), c.num_frames)),
+    ('remove_images_from_labeled_video_frames', lambda c, n: (
+        _python('remove_images_from_labeled_video_frames.py',
+                c.output('labeled_video_frames.lmdb'),
+                c.output('labeled_video_frames_without_images.lmdb'),
+                '--num_processes', n),
+        c.output('labeled_video_frames.lmdb'),
+        c.output('labeled_video_frames_without_images.lmdb'), c.num_frames)),
+    ('collect_frame_labels', lambda c, n: (
+        _function_command(c, 'collect_frame_labels'), c.annotations_json,
+        None, c.num_frames)),
+    ('compute_duration_mean_std', lambda c, n: (
+        _function_command(c, 'compute_duration_mean_std'),
+        c.annotations_json, None, c.num_annotations)),
+    ('compute_min_background_duration', lambda c, n: (
+        _function_command(c, 'compute_min_background_duration'),
+        c.annotations_json, None, c.num_annotations)),
+    ('compute_priors', lambda c, n: (
+        _function_command(c, 'compute_priors'), c.annotations_json, None,
+        c.num_annotations)),
+    ('compute_overlap_counts', lambda c, n: (
+        _function_command(c, 'compute_overlap_counts'), c.annotations_json,
+        None, c.num_annotations)),
+])
+
+OPTIONAL_BENCHMARKS = ('frames_to_caffe_datum_proto_lmdb', )
+
+
+def run_function(corpus, name):
+    """Run an in-process benchmark, and return its duration in seconds.
+
+    Loading the annotations is not included in the duration."""
+    from util.annotation import (collect_frame_labels, load_annotations_json,
+                                 load_label_ids)
+    from util import annotation_stats
+
+    annotations = load_annotations_json(corpus.annotations_json)
+    start = time.time()
+    if name == 'collect_frame_labels':
+        for video_index in range(corpus.parameters['num_videos']):
+            file_annotations = annotations['video_{:04d}'.format(video_index)]
+            for frame_index in range(corpus.frames_per_video):
+                collect_frame_labels(
+                    file_annotations,
+                    frame_index,
+                    frames_per_second=corpus.frames_per_second)
+    elif name == 'compute_duration_mean_std':
+        annotation_stats.compute_duration_mean_std(annotations)
+    elif name == 'compute_min_background_duration':
+        annotation_stats.compute_min_background_duration(annotations)
+    elif name == 'compute_priors':
+        class_list = sorted(load_label_ids(corpus.class_mapping).keys())
+        frame_counts = {filename: corpus.frames_per_video
+                        for filename in annotations}
+        annotation_stats.compute_priors(annotations, class_list, frame_counts)
+    elif name == 'compute_overlap_counts':
+        annotation_stats.compute_overlap_counts(annotations, count_frames=True)
+    else:
+        raise ValueError('Unknown function benchmark: %s' % name)
+    return time.time() - start
+
+
+def run_benchmark(corpus, name, num_processes):
+    command, input_path, output_path, num_items = BENCHMARKS[name](
+        corpus, num_processes)
+    if output_path is not None and os.path.exists(output_path):
+        shutil.rmtree(output_path)
+    input_bytes = directory_size(input_path) if os.path.exists(
+        input_path) else 0
+    logging.info('Running %s: %s', name, ' '.join(command))
+
+    start = time.time()
+    process = subprocess.Popen(command,
+                               cwd=REPOSITORY_ROOT,
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT)
+    output = process.stdout.read()
+    # Use wait4 rather than process.wait() to get resource usage of this
+    # benchmark's processes only.
+    _, status, usage = os.wait4(process.pid, 0)
+    seconds = time.time() - start
+    process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1
+
+    result = collections.OrderedDict([('name', name),
+                                      ('returncode', process.returncode)])
+    if process.returncode != 0:
+        logging.error('%s failed:\n%s', name, output.decode('utf-8',
+                                                            'replace'))
+        return result
+    if command[1:3] == ['-m', 'benchmarks.run_benchmarks']:
+        # In-process benchmarks report their own duration, excluding setup.
+        seconds = json.loads(output.decode('utf-8').strip().split('\n')[-1])[
+            'seconds']
+    # ru_maxrss is in kilobytes on Linux.
+    result.update([
+        ('seconds', seconds),
+        ('items', num_items),
+        ('items_per_second', num_items / seconds if seconds else None),
+        ('megabytes', input_bytes / 2.0**20),
+        ('megabytes_per_second',
+         input_bytes / 2.0**20 / seconds if seconds else None),
+        ('peak_rss_megabytes', usage.ru_maxrss / 1024.0),
+    ])
+    return result
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       cwd=REPOSITORY_ROOT,
+                                       stderr=subprocess.STDOUT).decode(
+                                           'utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n')[0],
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('corpus_dir', help='Output of make_corpus.py.')
+    parser.add_argument('--work_dir',
+                        help="""Directory for benchmark outputs. Defaults to
+                        <corpus_dir>/work.""")
+    parser.add_argument('--output_json',
+                        help='Path to write report to. Defaults to stdout.')
+    parser.add_argument('--benchmarks',
+                        nargs='*',
+                        choices=list(BENCHMARKS.keys()),
+                        help="""Benchmarks to run. Defaults to all except
+                        those in OPTIONAL_BENCHMARKS.""")
+    parser.add_argument('--num_processes', default=4, type=int)
+    parser.add_argument('--run_function', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    corpus_dir = os.path.abspath(args.corpus_dir)
+    work_dir = os.path.abspath(args.work_dir or
+                               os.path.join(corpus_dir, 'work'))
+    corpus = Corpus(corpus_dir, work_dir)
+
+    if args.run_function:
+        seconds = run_function(corpus, args.run_function)
+        print(json.dumps({'seconds': seconds}))
+        return
+
+    logging.getLogger().setLevel(logging.INFO)
+    logging.basicConfig(format='%(asctime)s.%(msecs).03d: %(message)s',
+                        datefmt='%H:%M:%S')
+    if not os.path.isdir(work_dir):
+        os.makedirs(work_dir)
+
+    results = [
+        run_benchmark(corpus, name, args.num_processes)
+        for name in (args.benchmarks or [
+            name for name in BENCHMARKS if name not in OPTIONAL_BENCHMARKS
+        ])
+    ]
+    report = collections.OrderedDict([
+        ('git_revision', git_revision()),
+        ('time', time.strftime('%Y-%m-%dT%H:%M:%S')),
+        ('python', platform.python_version()),
+        ('platform', platform.platform()),
+        ('cpu_count', mp.cpu_count()),
+        ('num_processes', args.num_processes),
+        ('corpus', corpus.parameters),
+        ('benchmarks', results),
+    ])
+    if args.output_json:
+        with open(args.output_json, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print('')
+
+
+if __name__ == '__main__':
+    main()
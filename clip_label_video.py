@@ -1,44 +1,360 @@
-"""Label a video with an annotation, clip it around the annotation."""
+"""Label a video with an annotation, clip it around the annotation.
+
+Single clip:
+
+    clip_label_video.py <video_file> <label> <start_second> <end_second>
+        <output_prefix> [<context_seconds>]
+
+Batch mode, which extracts a padded clip for every annotation in an
+annotations json:
+
+    clip_label_video.py --annotations_json <json> --video_dir <dir>
+        --output_dir <dir> [--context_seconds <s>] [--no_overlay]
+
+In batch mode, annotations are grouped by file and videos are processed in
+parallel. Each video is opened once for all its clips. With --no_overlay,
+clips are cut by ffmpeg with input seeking and stream copy, without
+re-encoding; note that stream copy can only start clips at keyframes, so
+clips may start slightly before the padded start.
+
+Labels are drawn with moviepy by default. With --backend ffmpeg, the overlay
+is instead expressed as an ffmpeg trim/drawtext filter graph and rendered by a
+single ffmpeg process, which is much faster. In batch mode, the ffmpeg backend
+draws the labels of all annotations that overlap a clip, stacked from the
+bottom of the frame, and seeks to each clip with input seeking. The moviepy
+backend relies on moviepy's reader to seek, which only restarts ffmpeg at the
+new position for jumps of more than 100 frames, and decodes up to the clip
+otherwise.
+
+moviepy is only needed for the moviepy backend.
+"""
 
 import argparse
+import logging
+import os
+import subprocess
+from multiprocessing import Pool
 from os import path
 
-from moviepy.editor import VideoFileClip, TextClip, CompositeVideoClip
+from tqdm import tqdm
 
+from util.annotation import load_annotations_json
 
-def label_clip(video_path, label, start_second, end_second):
-    clip = VideoFileClip(video_path)
+
+def _text_clip(label, start_second, end_second):
+    from moviepy.editor import TextClip
     text_clip = TextClip(label, fontsize=40, color='white', bg_color='red')
     text_clip = text_clip.set_pos(('center', 'bottom'))
-    text_clip = text_clip.set_start(start_second).set_duration(end_second -
-                                                               start_second)
-    return CompositeVideoClip([clip, text_clip])
+    return text_clip.set_start(start_second).set_duration(end_second -
+                                                          start_second)
 
-if __name__ == '__main__':
+
+def label_clip(video_path, label, start_second, end_second):
+    from moviepy.editor import CompositeVideoClip, VideoFileClip
+    clip = VideoFileClip(video_path)
+    return CompositeVideoClip(
+        [clip, _text_clip(label, start_second, end_second)])
+
+
+def output_path(output_dir, video_path, label, start_second, end_second):
+    base_videoname = path.splitext(path.basename(video_path))[0]
+    return path.join(output_dir, '{}-{}-{}-{}.mp4'.format(
+        base_videoname, label, start_second, end_second))
+
+
+def padded_window(start_second, end_second, context_seconds, duration=None):
+    """Pad [start_second, end_second] by context_seconds, within the video.
+
+    >>> padded_window(0.5, 2, 1, duration=2.5)
+    (0, 2.5)
+    >>> padded_window(3, 4, 1)
+    (2, 5)
+    """
+    padded_start = max(0, start_second - context_seconds)
+    padded_end = end_second + context_seconds
+    if duration is not None:
+        padded_end = min(duration, padded_end)
+    return padded_start, padded_end
+
+
+def video_duration(video_path):
+    """Return duration of a video in seconds, using ffprobe."""
+    cmd = [
+        'ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of',
+        'default=nokey=1:noprint_wrappers=1', video_path
+    ]
+    output = subprocess.check_output(cmd, stderr=subprocess.STDOUT)
+    return float(output.decode().strip())
+
+
+def copy_clip(video_path, padded_start, padded_end, output_file):
+    """Cut [padded_start, padded_end] from a video without re-encoding."""
+    cmd = [
+        'ffmpeg', '-y', '-v', 'error', '-ss', str(padded_start), '-i',
+        video_path, '-t', str(padded_end - padded_start), '-c', 'copy',
+        '-avoid_negative_ts', 'make_zero', output_file
+    ]
+    subprocess.check_output(cmd, stderr=subprocess.STDOUT)
+
+
+def _escape(text, special_characters):
+    return ''.join('\\' + x if x in special_characters else x for x in text)
+
+
+def escape_drawtext(text):
+    r"""Escape text for the drawtext filter's text option in a filter graph.
+
+    Text is escaped once as an option value, and again for the filter graph
+    description; see "Quoting and escaping" in the ffmpeg-filters manual.
+
+    >>> print(escape_drawtext("it's 1:2, [ok]"))
+    it\\\'s 1\\:2\, \[ok\]
+    """
+    return _escape(_escape(text, "\\':"), "\\'[],;")
+
+
+def drawtext_filter_graph(labels, duration, font_file=None):
+    r"""Return a filter graph that trims a clip and draws labels on it.
+
+    Args:
+        labels (list of (str, float, float)): (label, start_second,
+            end_second) for each label, in seconds relative to the start of
+            the clip. Labels are stacked upwards from the bottom of the frame
+            in order.
+        duration (float): Duration to trim the clip to.
+        font_file (str): Font for drawtext. Needed if ffmpeg was built
+            without fontconfig.
+
+    >>> print(drawtext_filter_graph([('a', 1, 2.5)], 4).replace(':', '\n'))
+    trim=duration=4,setpts=PTS-STARTPTS,drawtext=text=a
+    expansion=none
+    fontsize=40
+    fontcolor=white
+    box=1
+    boxcolor=red
+    boxborderw=4
+    x=(w-text_w)/2
+    y=h-text_h-4-0*(text_h+12)
+    enable=between(t\,1\,2.5)
+    """
+    filters = ['trim=duration={}'.format(duration), 'setpts=PTS-STARTPTS']
+    for i, (label, start_second, end_second) in enumerate(labels):
+        options = [
+            'text=' + escape_drawtext(label), 'expansion=none', 'fontsize=40',
+            'fontcolor=white', 'box=1', 'boxcolor=red', 'boxborderw=4',
+            'x=(w-text_w)/2', 'y=h-text_h-4-{}*(text_h+12)'.format(i),
+            'enable=between(t\\,{}\\,{})'.format(start_second, end_second)
+        ]
+        if font_file is not None:
+            options.insert(1, 'fontfile=' + escape_drawtext(font_file))
+        filters.append('drawtext=' + ':'.join(options))
+    return ','.join(filters)
+
+
+def render_clip_ffmpeg(video_path, labels, padded_start, padded_end,
+                       output_file, font_file=None):
+    """Cut [padded_start, padded_end] from a video and draw labels on it.
+
+    Args:
+        labels (list of (str, float, float)): (label, start_second,
+            end_second) in seconds relative to the start of the video.
+    """
+    duration = padded_end - padded_start
+    clip_labels = [(label, max(0, start_second - padded_start),
+                    min(duration, end_second - padded_start))
+                   for label, start_second, end_second in labels]
+    cmd = [
+        'ffmpeg', '-y', '-v', 'error', '-ss', str(padded_start), '-i',
+        video_path, '-t', str(duration), '-map', '0:v:0', '-map', '0:a?',
+        '-vf', drawtext_filter_graph(clip_labels, duration, font_file),
+        output_file
+    ]
+    subprocess.check_output(cmd, stderr=subprocess.STDOUT)
+
+
+def clip_video_annotations(args):
+    """Extract a clip for each annotation of one video.
+
+    Args:
+        args (tuple): (video_path, annotations, output_dir, context_seconds,
+            backend, font_file). annotations is a list of Annotation objects.
+            backend is one of 'moviepy' or 'ffmpeg', which draw labels, or
+            'copy', which copies clips without labels.
+
+    Returns:
+        num_clips (int): Number of clips written.
+    """
+    (video_path, annotations, output_dir, context_seconds, backend,
+     font_file) = args
+    overlay = backend == 'moviepy'
+    if overlay:
+        from moviepy.editor import CompositeVideoClip, VideoFileClip
+    clip = None
+    try:
+        if overlay:
+            clip = VideoFileClip(video_path)
+            duration = clip.duration
+        else:
+            duration = video_duration(video_path)
+    except (IOError, OSError, subprocess.CalledProcessError):
+        logging.exception('Unable to open video (%s), skipping.', video_path)
+        return 0
+
+    num_clips = 0
+    try:
+        for annotation in annotations:
+            output_file = output_path(output_dir, video_path,
+                                      annotation.category,
+                                      annotation.start_seconds,
+                                      annotation.end_seconds)
+            padded_start, padded_end = padded_window(
+                annotation.start_seconds, annotation.end_seconds,
+                context_seconds, duration)
+            try:
+                if overlay:
+                    # Times of the label are relative to the subclip.
+                    subclip = clip.subclip(padded_start, padded_end)
+                    labeled_clip = CompositeVideoClip([
+                        subclip,
+                        _text_clip(annotation.category,
+                                   annotation.start_seconds - padded_start,
+                                   annotation.end_seconds - padded_start)
+                    ])
+                    labeled_clip.write_videofile(output_file,
+                                                 verbose=False,
+                                                 progress_bar=False)
+                elif backend == 'ffmpeg':
+                    # Draw this clip's own label at the bottom, and any other
+                    # annotations overlapping the clip above it.
+                    labels = [(annotation.category, annotation.start_seconds,
+                               annotation.end_seconds)]
+                    labels.extend(
+                        (x.category, x.start_seconds, x.end_seconds)
+                        for x in annotations
+                        if (x is not annotation and
+                            x.start_seconds < padded_end and
+                            x.end_seconds > padded_start))
+                    render_clip_ffmpeg(video_path, labels, padded_start,
+                                       padded_end, output_file, font_file)
+                else:
+                    copy_clip(video_path, padded_start, padded_end,
+                              output_file)
+            except subprocess.CalledProcessError as e:
+                output = (e.output or b'').decode('utf-8', 'replace')
+                logging.error('Failed to write %s: %s\n%s', output_file, e,
+                              output)
+                continue
+            except (IOError, OSError):
+                logging.exception('Failed to write %s', output_file)
+                continue
+            num_clips += 1
+    finally:
+        if clip is not None:
+            clip.reader.close()
+            if clip.audio is not None:
+                clip.audio.reader.close_proc()
+    return num_clips
+
+
+def main():
     parser = argparse.ArgumentParser(
-        description=__doc__,
+        description=__doc__.split('\n')[0],
         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    parser.add_argument('video_file', type=str)
-    parser.add_argument('label', type=str)
-    parser.add_argument('start_second', type=float)
-    parser.add_argument('end_second', type=float)
-    parser.add_argument('output_prefix', type=str)
+    parser.add_argument('video_file', type=str, nargs='?')
+    parser.add_argument('label', type=str, nargs='?')
+    parser.add_argument('start_second', type=float, nargs='?')
+    parser.add_argument('end_second', type=float, nargs='?')
+    parser.add_argument('output_prefix', type=str, nargs='?')
     parser.add_argument(
         'context_seconds',
         nargs='?',
         default=1.,
         type=float,
         help='Seconds of context to pad before and after the label.')
+    parser.add_argument('--backend',
+                        choices=['moviepy', 'ffmpeg'],
+                        default='moviepy',
+                        help='How to render labels.')
+    parser.add_argument('--font_file',
+                        help="""Font file for the ffmpeg backend, if ffmpeg
+                        was built without fontconfig.""")
+
+    batch_group = parser.add_argument_group('batch mode')
+    batch_group.add_argument('--annotations_json')
+    batch_group.add_argument('--video_dir',
+                             help="""Directory containing a video named
+                             <filename><video_extension> for each annotation
+                             filename.""")
+    batch_group.add_argument('--video_extension', default='.mp4')
+    batch_group.add_argument(
+        '--context_seconds',
+        dest='batch_context_seconds',
+        metavar='CONTEXT_SECONDS',
+        default=1.,
+        type=float,
+        help='Seconds of context to pad before and after each annotation.')
+    batch_group.add_argument('--output_dir')
+    batch_group.add_argument('--no_overlay',
+                             action='store_true',
+                             help="""Don't draw labels; copy clips without
+                             re-encoding.""")
+    batch_group.add_argument('--num_processes', default=4, type=int)
 
     args = parser.parse_args()
 
-    labeled_clip = label_clip(args.video_file, args.label, args.start_second,
-                              args.end_second)
-    padded_start = args.start_second - args.context_seconds
-    padded_end = args.end_second + args.context_seconds
-    labeled_clip = labeled_clip.subclip(padded_start, padded_end)
+    if args.annotations_json is None:
+        if args.output_prefix is None:
+            parser.error('Specify a video, label, start and end second, and '
+                         'output prefix, or --annotations_json.')
+        output_file = output_path(args.output_prefix, args.video_file,
+                                  args.label, args.start_second,
+                                  args.end_second)
+        if args.backend == 'ffmpeg':
+            padded_start, padded_end = padded_window(
+                args.start_second, args.end_second, args.context_seconds,
+                video_duration(args.video_file))
+            render_clip_ffmpeg(args.video_file,
+                               [(args.label, args.start_second,
+                                 args.end_second)], padded_start, padded_end,
+                               output_file, args.font_file)
+            return
+        labeled_clip = label_clip(args.video_file, args.label,
+                                  args.start_second, args.end_second)
+        padded_start, padded_end = padded_window(args.start_second,
+                                                 args.end_second,
+                                                 args.context_seconds,
+                                                 labeled_clip.duration)
+        labeled_clip = labeled_clip.subclip(padded_start, padded_end)
+        labeled_clip.write_videofile(output_file)
+        return
+
+    if args.video_dir is None or args.output_dir is None:
+        parser.error('--video_dir and --output_dir are required with '
+                     '--annotations_json.')
+    logging.getLogger().setLevel(logging.INFO)
+    logging.basicConfig(format='%(asctime)s.%(msecs).03d: %(message)s',
+                        datefmt='%H:%M:%S')
+    if not path.isdir(args.output_dir):
+        os.makedirs(args.output_dir)
 
-    base_videoname = path.splitext(path.basename(args.video_file))[0]
-    output_file = path.join(args.output_prefix, '{}-{}-{}-{}.mp4'.format(
-        base_videoname, args.label, args.start_second, args.end_second))
-    labeled_clip.write_videofile(output_file)
+    annotations = load_annotations_json(args.annotations_json)
+    tasks = [(path.join(args.video_dir, filename + args.video_extension),
+              file_annotations, args.output_dir, args.batch_context_seconds,
+              'copy' if args.no_overlay else args.backend, args.font_file)
+             for filename, file_annotations in sorted(annotations.items())]
+    pool = Pool(args.num_processes)
+    try:
+        num_clips = sum(
+            tqdm(pool.imap_unordered(clip_video_annotations, tasks),
+                 total=len(tasks)))
+    except KeyboardInterrupt:
+        print('Parent received control-c, exiting.')
+        pool.terminate()
+        return
+    pool.close()
+    logging.info('Wrote %s clips for %s videos to %s', num_clips, len(tasks),
+                 args.output_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,36 @@
-"""Dump video frames as images."""
+"""Dump video frames as images.
+
+Videos are dumped by one of two drivers:
+
+    pool: A fixed number (--num-workers) of worker processes, each running one
+        ffmpeg process at a time.
+    async: ffmpeg processes are run directly from an asyncio event loop. The
+        number of concurrent ffmpeg processes starts at --num-workers, and is
+        adjusted every --adjust-interval seconds from the CPU utilization and
+        I/O wait in /proc/stat, within [--min-workers, --max-workers]. ffmpeg's
+        stderr is streamed and discarded, keeping only its tail to log if
+        ffmpeg fails.
+"""
 
 import argparse
+import asyncio
+import collections
 import json
 import logging
 import math
 import os
 import subprocess
-from multiprocessing import Pool
+import time
+from multiprocessing import Pool, cpu_count
 from pathlib import Path
 
 from moviepy.video.io.ffmpeg_reader import ffmpeg_parse_infos
 from tqdm import tqdm
 
 from util.log import setup_logging
+from util.sharding import (add_shard_arguments, check_shard_arguments,
+                           in_shard, shard_output_path,
+                           write_completion_marker)
 
 
 def frames_already_dumped(video_path,
@@ -81,69 +99,125 @@ def frames_already_dumped(video_path,
     return True
 
 
+class FrameDumpJob(object):
+    """Dump frames from one video, in steps so that drivers can run ffmpeg.
+
+    Usage:
+
+        job = FrameDumpJob(video_path, output_directory, frames_per_second,
+                           file_logger_name)
+        if job.prepare():
+            returncode = <run job.command>
+            job.finish(returncode == 0)
+        # job.success is now set.
+    """
+
+    def __init__(self, video_path, output_directory, frames_per_second,
+                 file_logger_name):
+        """See dump_frames for arguments."""
+        self.video_path = video_path
+        self.output_directory = output_directory
+        self.frames_per_second = frames_per_second
+        self.file_logger_name = file_logger_name
+        self.info_path = '{}/info.json'.format(output_directory)
+        self.name_format = '{}/frame%04d.png'.format(output_directory)
+        self.command = None
+        self.success = False
+
+    def _frames_already_dumped(self, log_reason):
+        return frames_already_dumped(self.video_path, self.output_directory,
+                                     self.frames_per_second, self.info_path,
+                                     self.name_format, log_reason)
+
+    def prepare(self):
+        """Set self.command to the ffmpeg command to dump frames.
+
+        Returns:
+            needs_dump (bool): If False, the video does not need to be dumped
+                (either the frames exist or the video could not be read), and
+                self.success is final.
+        """
+        if not os.path.isdir(self.output_directory):
+            os.mkdir(self.output_directory)
+
+        try:
+            video_info = ffmpeg_parse_infos(self.video_path)
+            video_fps = video_info['video_fps']
+            video_duration = video_info['duration']
+        except OSError as e:
+            logging.error('Unable to open video (%s), skipping.' %
+                          self.video_path)
+            logging.exception('Exception:')
+            return False
+        except KeyError as e:
+            logging.error('Unable to extract metadata about video (%s), '
+                          'skipping.' % self.video_path)
+            logging.exception('Exception:')
+            return False
+
+        extract_all_frames = self.frames_per_second is None
+        if extract_all_frames:
+            self.frames_per_second = video_fps
+
+        if self._frames_already_dumped(False):
+            logging.getLogger(self.file_logger_name).info(
+                'Frames for {} exist, skipping...'.format(self.video_path))
+            self.success = True
+            return False
+
+        if extract_all_frames:
+            self.command = ['ffmpeg', '-i', self.video_path, self.name_format]
+        else:
+            self.command = ['ffmpeg', '-i', self.video_path, '-vf',
+                            'fps={}'.format(self.frames_per_second),
+                            self.name_format]
+        return True
+
+    def finish(self, successfully_wrote_images):
+        """Write the info file and check that all frames were dumped.
+
+        Args:
+            successfully_wrote_images (bool): Whether self.command succeeded.
+        """
+        if not successfully_wrote_images:
+            return
+        info = {'frames_per_second': self.frames_per_second,
+                'input_video_path': os.path.abspath(self.video_path)}
+        with open(self.info_path, 'w') as info_file:
+            json.dump(info, info_file)
+
+        if not self._frames_already_dumped(True):
+            logging.error(
+                "Images for {} don't seem to be dumped properly!".format(
+                    self.video_path))
+            return
+        self.success = True
+
+
 def dump_frames(video_path, output_directory, frames_per_second,
                 file_logger_name):
     """Dump frames at frames_per_second from a video to output_directory.
 
-    If frames_per_second is None, the clip's fps attribute is used instead."""
-    if not os.path.isdir(output_directory):
-        os.mkdir(output_directory)
-
-    file_logger = logging.getLogger(file_logger_name)
+    If frames_per_second is None, the clip's fps attribute is used instead.
 
-    try:
-        video_info = ffmpeg_parse_infos(video_path)
-        video_fps = video_info['video_fps']
-        video_duration = video_info['duration']
-    except OSError as e:
-        logging.error('Unable to open video (%s), skipping.' % video_path)
-        logging.exception('Exception:')
-        return
-    except KeyError as e:
-        logging.error('Unable to extract metadata about video (%s), skipping.'
-                      % video_path)
-        logging.exception('Exception:')
-        return
-    info_path = '{}/info.json'.format(output_directory)
-    name_format = '{}/frame%04d.png'.format(output_directory)
-
-    extract_all_frames = frames_per_second is None
-    if extract_all_frames:
-        frames_per_second = video_fps
-
-    frames_already_dumped_helper = lambda log_reason: \
-        frames_already_dumped(video_path, output_directory,
-                              frames_per_second, info_path,
-                              name_format, log_reason)
-
-    if frames_already_dumped_helper(False):
-        file_logger.info('Frames for {} exist, skipping...'.format(video_path))
-        return
+    Returns:
+        success (bool): Whether all frames were dumped (or had already been
+            dumped)."""
+    job = FrameDumpJob(video_path, output_directory, frames_per_second,
+                       file_logger_name)
+    if not job.prepare():
+        return job.success
 
     successfully_wrote_images = False
     try:
-        if extract_all_frames:
-            cmd = ['ffmpeg', '-i', video_path, name_format]
-        else:
-            cmd = ['ffmpeg', '-i', video_path, '-vf',
-                   'fps={}'.format(frames_per_second), name_format]
-        subprocess.check_output(cmd, stderr=subprocess.STDOUT)
+        subprocess.check_output(job.command, stderr=subprocess.STDOUT)
         successfully_wrote_images = True
     except subprocess.CalledProcessError as e:
         logging.error("Failed to dump images for %s", video_path)
         logging.error(e)
         logging.error(e.output.decode('utf-8'))
-
-    if successfully_wrote_images:
-        info = {'frames_per_second': frames_per_second,
-                'input_video_path': os.path.abspath(video_path)}
-        with open(info_path, 'w') as info_file:
-            json.dump(info, info_file)
-
-        if not frames_already_dumped_helper(True):
-            logging.error(
-                "Images for {} don't seem to be dumped properly!".format(
-                    video_path))
+    job.finish(successfully_wrote_images)
+    return job.success
 
 
 def dump_frames_star(args):
@@ -151,6 +225,159 @@ def dump_frames_star(args):
     return dump_frames(*args)
 
 
+# Number of bytes at the end of ffmpeg's stderr to log if it fails.
+STDERR_TAIL_BYTES = 8192
+
+
+def read_cpu_times(stat_path='/proc/stat'):
+    """Return (busy, iowait, total) CPU time since boot, or None.
+
+    Times are summed over all CPUs, in units of USER_HZ. Returns None if
+    stat_path cannot be read (e.g. not on Linux)."""
+    try:
+        with open(stat_path) as f:
+            fields = f.readline().split()
+    except (IOError, OSError):
+        return None
+    # user nice system idle iowait irq softirq steal; guest time is already
+    # included in user time.
+    times = [int(x) for x in fields[1:9]]
+    idle, iowait = times[3], times[4]
+    total = sum(times)
+    return total - idle - iowait, iowait, total
+
+
+def next_concurrency(concurrency, cpu_utilization, iowait_fraction,
+                     min_workers, max_workers, target_utilization=0.9,
+                     max_iowait=0.25):
+    """Adjust the number of concurrent ffmpeg processes.
+
+    Removes a process if too much time is spent waiting on I/O, and otherwise
+    adds one while the CPUs are below target_utilization.
+
+    >>> next_concurrency(4, 0.5, 0.0, 1, 8)
+    5
+    >>> next_concurrency(4, 0.5, 0.4, 1, 8)
+    3
+    >>> next_concurrency(4, 0.95, 0.0, 1, 8)
+    4
+    >>> next_concurrency(8, 0.5, 0.0, 1, 8)
+    8
+    """
+    if iowait_fraction > max_iowait:
+        concurrency -= 1
+    elif cpu_utilization < target_utilization:
+        concurrency += 1
+    return max(min_workers, min(max_workers, concurrency))
+
+
+async def run_ffmpeg(command):
+    """Run command, killing it if cancelled.
+
+    Returns:
+        returncode (int)
+        stderr_tail (str): Last STDERR_TAIL_BYTES of stderr.
+    """
+    process = await asyncio.create_subprocess_exec(
+        *command,
+        stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE)
+    stderr_tail = b''
+    try:
+        # ffmpeg separates progress updates with carriage returns, so read
+        # chunks rather than lines.
+        while True:
+            chunk = await process.stderr.read(1 << 16)
+            if not chunk:
+                break
+            stderr_tail = (stderr_tail + chunk)[-STDERR_TAIL_BYTES:]
+        returncode = await process.wait()
+    except asyncio.CancelledError:
+        process.kill()
+        await process.wait()
+        raise
+    return returncode, stderr_tail.decode('utf-8', 'replace')
+
+
+async def dump_frames_async(task):
+    """Like dump_frames_star, but runs ffmpeg from the event loop."""
+    loop = asyncio.get_running_loop()
+    job = FrameDumpJob(*task)
+    # prepare() and finish() probe the video with blocking subprocess calls,
+    # so run them in threads.
+    if not await loop.run_in_executor(None, job.prepare):
+        return job.success
+    returncode, stderr_tail = await run_ffmpeg(job.command)
+    if returncode != 0:
+        logging.error('Failed to dump images for %s (exit status %s)',
+                      job.video_path, returncode)
+        logging.error(stderr_tail)
+    await loop.run_in_executor(None, job.finish, returncode == 0)
+    return job.success
+
+
+async def dump_frames_adaptive(tasks, num_workers, min_workers, max_workers,
+                               adjust_interval, progress):
+    """Run dump_frames_async for each task, adapting the concurrency.
+
+    Returns:
+        results (list of bool): Success of each task, in completion order.
+    """
+    pending = collections.deque(tasks)
+    running = set()
+    results = []
+    concurrency = max(min_workers, min(max_workers, num_workers))
+    last_times = read_cpu_times()
+    last_adjust = time.time()
+    if last_times is None:
+        logging.warning('Unable to read CPU usage; running a fixed %s ffmpeg '
+                        'processes.', concurrency)
+    try:
+        while pending or running:
+            while pending and len(running) < concurrency:
+                running.add(
+                    asyncio.ensure_future(dump_frames_async(
+                        pending.popleft())))
+            done, running = await asyncio.wait(
+                running,
+                timeout=adjust_interval,
+                return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                try:
+                    results.append(future.result())
+                except Exception:
+                    logging.exception('Failed to dump frames.')
+                    results.append(False)
+                progress.update(1)
+
+            now = time.time()
+            if last_times is None or now - last_adjust < adjust_interval:
+                continue
+            times = read_cpu_times()
+            elapsed = times[2] - last_times[2]
+            if elapsed > 0:
+                cpu_utilization = (times[0] - last_times[0]) / elapsed
+                iowait_fraction = (times[1] - last_times[1]) / elapsed
+                new_concurrency = next_concurrency(
+                    concurrency, cpu_utilization, iowait_fraction,
+                    min_workers, max_workers)
+                if new_concurrency != concurrency:
+                    logging.info(
+                        'CPU %.0f%%, I/O wait %.0f%%: running %s ffmpeg '
+                        'processes (was %s).', 100 * cpu_utilization,
+                        100 * iowait_fraction, new_concurrency, concurrency)
+                    concurrency = new_concurrency
+            last_times = times
+            last_adjust = now
+    except asyncio.CancelledError:
+        for future in running:
+            future.cancel()
+        await asyncio.gather(*running, return_exceptions=True)
+        raise
+    return results
+
+
 def main():
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument(
@@ -166,9 +393,32 @@ def main():
                         type=float,
                         help=('Number of frames to output per second. If 0, '
                               'dumps all frames in the clip.'))
-    parser.add_argument('--num-workers', type=int, default=4)
+    parser.add_argument('--driver', choices=['pool', 'async'], default='pool')
+    parser.add_argument('--num-workers',
+                        type=int,
+                        default=4,
+                        help="""Number of worker processes, or, with
+                        --driver=async, the initial number of ffmpeg
+                        processes.""")
+    parser.add_argument('--min-workers',
+                        type=int,
+                        default=1,
+                        help='Minimum ffmpeg processes for --driver=async.')
+    parser.add_argument('--max-workers',
+                        type=int,
+                        default=cpu_count(),
+                        help='Maximum ffmpeg processes for --driver=async.')
+    parser.add_argument('--adjust-interval',
+                        type=float,
+                        default=5,
+                        help="""Seconds between adjustments of the number of
+                        ffmpeg processes for --driver=async.""")
+    add_shard_arguments(parser)
 
     args = parser.parse_args()
+    check_shard_arguments(parser, args)
+    if not 1 <= args.min_workers <= args.max_workers:
+        parser.error('Must have 1 <= --min-workers <= --max-workers.')
 
     video_list = args.video_list
     output_directory = args.output_directory
@@ -179,7 +429,10 @@ def main():
 
     output_directory.mkdir(exist_ok=True, parents=True)
 
-    logging_path = str(output_directory) + '/dump_frames.py'
+    # Shards may share output_directory, so each writes its own log.
+    logging_path = shard_output_path(
+        str(output_directory) + '/dump_frames.py', args.shard_index,
+        args.num_shards)
     setup_logging(logging_path)
     logging.info('Args:\n%s', vars(args))
 
@@ -188,6 +441,8 @@ def main():
         for line in f:
             video_path = line.strip()
             base_filename = os.path.splitext(os.path.basename(video_path))[0]
+            if not in_shard(base_filename, args.shard_index, args.num_shards):
+                continue
             output_video_directory = os.path.join(output_directory,
                                                   base_filename)
             dump_frames_tasks.append((video_path, output_video_directory,
@@ -196,15 +451,46 @@ def main():
     file_logger.info('Videos:\n%s',
                      '\n'.join([x[0] for x in dump_frames_tasks]))
 
-    pool = Pool(args.num_workers)
-    try:
-        list(
-            tqdm(
-                pool.imap_unordered(dump_frames_star, dump_frames_tasks),
-                total=len(dump_frames_tasks)))
-    except KeyboardInterrupt:
-        print('Parent received control-c, exiting.')
-        pool.terminate()
+    if args.driver == 'async':
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        main_task = loop.create_task(
+            dump_frames_adaptive(dump_frames_tasks, args.num_workers,
+                                 args.min_workers, args.max_workers,
+                                 args.adjust_interval,
+                                 tqdm(total=len(dump_frames_tasks))))
+        try:
+            results = loop.run_until_complete(main_task)
+        except KeyboardInterrupt:
+            print('Parent received control-c, killing ffmpeg processes.')
+            main_task.cancel()
+            try:
+                loop.run_until_complete(main_task)
+            except asyncio.CancelledError:
+                pass
+            return
+        finally:
+            loop.close()
+    else:
+        pool = Pool(args.num_workers)
+        try:
+            results = list(
+                tqdm(
+                    pool.imap_unordered(dump_frames_star, dump_frames_tasks),
+                    total=len(dump_frames_tasks)))
+        except KeyboardInterrupt:
+            print('Parent received control-c, exiting.')
+            pool.terminate()
+            return
+
+    num_failed = results.count(False)
+    if num_failed:
+        logging.error('Failed to dump frames for %s videos; not marking '
+                      'shard as complete.', num_failed)
+    else:
+        write_completion_marker(str(output_directory), args.shard_index,
+                                args.num_shards,
+                                num_videos=len(dump_frames_tasks))
 
 
 if __name__ == '__main__':
@@ -5,18 +5,76 @@ Takes as input an HDF5 mapping '<video_name>' to a binary matrix of
 for each frame. The labels are numpy arrays stored as byte strings, and can be
 loaded calling numpy.fromstring on the values.
 
+With --packed, the LMDB instead has one key per video, '<video_name>', whose
+value is the bit-packed label matrix of the video; see util/packed_labels.py
+for the format and a reader.
+
+Datasets are read in chunks of --chunk_frames frames. Records of each video are
+sorted by key and written in batches of --batch_size, each in its own
+transaction and in LMDB's append mode where possible, so neither the HDF5
+datasets nor the LMDB transaction need to fit in memory. The LMDB map grows as
+needed.
+
 NOTE: The frame numbers are 1-indexed.
 """
 
 import argparse
-from StringIO import StringIO
+import logging
 
-import caffe
 import h5py
 import lmdb
-import numpy as np
 from tqdm import tqdm
 
+from util.lmdb_transform import write_records
+from util.packed_labels import pack_header, pack_rows
+
+
+class RecordWriter(object):
+    """Buffer records and write them to an LMDB in sorted batches.
+
+    Records are buffered until flush() is called (or max_buffered_bytes of keys
+    and values are buffered), then sorted and written in transactions of
+    batch_size records.
+    Each batch whose first key is greater than the last key written is
+    appended; otherwise it is written with regular puts.
+
+    Keys of consecutive frames are not in lexicographic order ('v-10' <
+    'v-9'), so callers should flush once per video rather than per batch.
+    """
+
+    def __init__(self, environment, batch_size, max_buffered_bytes):
+        self.environment = environment
+        self.batch_size = batch_size
+        self.max_buffered_bytes = max_buffered_bytes
+        self.records = []
+        self.buffered_bytes = 0
+        self.last_key = None
+        self.num_appended = 0
+        self.num_written = 0
+
+    def put(self, key, value):
+        self.records.append((key, value))
+        self.buffered_bytes += len(key) + len(value)
+        if self.buffered_bytes >= self.max_buffered_bytes:
+            self.flush()
+
+    def flush(self):
+        self.records.sort()
+        for start in range(0, len(self.records), self.batch_size):
+            batch = self.records[start:start + self.batch_size]
+            append = self.last_key is None or batch[0][0] > self.last_key
+            write_records(self.environment, batch, append=append)
+            self.num_written += len(batch)
+            if append:
+                self.num_appended += len(batch)
+            self.last_key = max(self.last_key or b'', batch[-1][0])
+        self.records = []
+        self.buffered_bytes = 0
+
+
+def frame_key(video_name, frame_number):
+    return '{}-{}'.format(video_name, frame_number).encode('utf-8')
+
 
 def main():
     parser = argparse.ArgumentParser(
@@ -27,19 +85,61 @@ def main():
         help=('Maps video names to a binary matrix of shape (num_frames, '
               'num_labels).'))
     parser.add_argument('output_lmdb')
+    parser.add_argument('--packed',
+                        action='store_true',
+                        help="""Store one bit-packed label matrix per video
+                        instead of one label vector per frame.""")
+    parser.add_argument('--chunk_frames',
+                        default=10000,
+                        type=int,
+                        help='Number of frames to read from HDF5 at a time.')
+    parser.add_argument('--batch_size',
+                        default=10000,
+                        type=int,
+                        help='Number of records to write per transaction.')
+    parser.add_argument('--max_buffered_mb',
+                        default=256,
+                        type=int,
+                        help="""Maximum size of keys and values to buffer
+                        before sorting and writing them.""")
+    parser.add_argument('--map_size',
+                        default=int(2e9),
+                        type=int,
+                        help="""Initial LMDB map size; doubled whenever it
+                        fills up.""")
 
     args = parser.parse_args()
 
-    map_size = 2e9
+    logging.getLogger().setLevel(logging.INFO)
+    logging.basicConfig(format='%(asctime)s.%(msecs).03d: %(message)s',
+                        datefmt='%H:%M:%S')
 
-    lmdb_environment = lmdb.open(args.output_lmdb, map_size=int(map_size))
-    with lmdb_environment.begin(write=True) as lmdb_transaction, h5py.File(
-            args.labels_hdf5) as labels:
-        for video_name, file_labels in tqdm(labels.items()):
-            file_labels = np.asarray(file_labels)
-            for frame_number, frame_labels in enumerate(file_labels):
-                key = '{}-{}'.format(video_name, frame_number + 1)
-                lmdb_transaction.put(key, frame_labels.tobytes())
+    lmdb_environment = lmdb.open(args.output_lmdb, map_size=args.map_size)
+    writer = RecordWriter(lmdb_environment, args.batch_size,
+                          args.max_buffered_mb * 2**20)
+    with h5py.File(args.labels_hdf5, 'r') as labels:
+        # Sort so that keys are (almost always) written in increasing order.
+        for video_name in tqdm(sorted(labels.keys())):
+            file_labels = labels[video_name]
+            num_frames = file_labels.shape[0]
+            packed_chunks = []
+            for start in range(0, num_frames, args.chunk_frames):
+                chunk = file_labels[start:start + args.chunk_frames]
+                if args.packed:
+                    packed_chunks.append(pack_rows(chunk))
+                    continue
+                for i, frame_labels in enumerate(chunk):
+                    writer.put(frame_key(video_name, start + i + 1),
+                               frame_labels.tobytes())
+            if args.packed:
+                writer.put(video_name.encode('utf-8'),
+                           pack_header(*file_labels.shape) +
+                           b''.join(packed_chunks))
+            else:
+                writer.flush()
+    writer.flush()
+    logging.info('Wrote %s records (%s appended) to %s', writer.num_written,
+                 writer.num_appended, args.output_lmdb)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,315 @@
+"""Tile sampled video frames into labeled contact sheets.
+
+Takes as input either an LMDB of LabeledVideoFrames/VideoFrames, or a root
+directory containing a subdirectory of frames for each video (as created by
+dump_frames.py). Frames are sampled
+
+    - random: num_samples frames from the whole dataset,
+    - per_video: num_samples frames from each video, or
+    - per_label: num_samples frames with each label,
+
+decoded in parallel, and tiled, with the frame key and labels under each
+frame, into pages of --rows x --columns frames written to
+<output_prefix>-<page>.png.
+
+Frames in LMDBs are read by key, so only the sampled values are read (except
+in per_label mode, which scans the labels of every frame). For --frames_root,
+labels are computed from --annotations_json.
+"""
+
+import argparse
+import collections
+import glob
+import logging
+import multiprocessing as mp
+import os
+import random
+
+import numpy as np
+from PIL import Image, ImageDraw
+from tqdm import tqdm
+
+from frame_loader_util import parse_frame_path
+from util.annotation import FrameLabelIndex, load_annotations_json
+from util.lmdb_transform import key_ranges
+from util.video_frames_reader import (frame_key, load_video_frames,
+                                      open_readonly_lmdb, parse_frame_key)
+from util.video_frames_wire import parse_frame, parse_labels
+
+CAPTION_LINE_HEIGHT = 12
+CAPTION_LINES = 2
+BACKGROUND_COLOR = (32, 32, 32)
+TEXT_COLOR = (255, 255, 255)
+
+
+def _thumbnail(image, tile_width, tile_height):
+    """Resize a PIL image to fit in a tile, preserving aspect ratio."""
+    scale = min(tile_width / float(image.width),
+                tile_height / float(image.height))
+    size = (max(1, int(round(image.width * scale))),
+            max(1, int(round(image.height * scale))))
+    return np.asarray(image.convert('RGB').resize(size, Image.BILINEAR))
+
+
+def load_lmdb_tile(args):
+    """Load a frame and its label names from an LMDB.
+
+    Args:
+        args (tuple): (lmdb_path, labeled, video_name, frame_index,
+            tile_width, tile_height)
+
+    Returns:
+        tile (np.array, shape (height, width, 3)): RGB thumbnail.
+        labels (list of str)
+    """
+    (lmdb_path, labeled, video_name, frame_index, tile_width,
+     tile_height) = args
+    with open_readonly_lmdb(lmdb_path).begin(buffers=True) as transaction:
+        value = transaction.get(frame_key(video_name, frame_index))
+        image = parse_frame(value, labeled).image
+        shape = (image.channels, image.height, image.width)
+        # Frames are stored as (channels, height, width) in BGR order.
+        pixels = np.frombuffer(value, dtype=np.uint8,
+                               count=image.data_end - image.data_start,
+                               offset=image.data_start).reshape(shape)
+        pixels = pixels[::-1].transpose((1, 2, 0))
+        if image.channels == 1:
+            pixels = pixels[:, :, 0]
+        tile = _thumbnail(Image.fromarray(np.ascontiguousarray(pixels)),
+                          tile_width, tile_height)
+        labels = ([name for name, _ in parse_labels(value)]
+                  if labeled else [])
+    return tile, labels
+
+
+def load_file_tile(args):
+    """Load a frame from an image file.
+
+    Args:
+        args (tuple): (frame_path, labels, tile_width, tile_height)
+
+    Returns:
+        tile (np.array, shape (height, width, 3)): RGB thumbnail.
+        labels (list of str)
+    """
+    frame_path, labels, tile_width, tile_height = args
+    return _thumbnail(Image.open(frame_path), tile_width, tile_height), labels
+
+
+def scan_lmdb_labels(args):
+    """Return a dict mapping label name to keys of frames with that label.
+
+    Args:
+        args (tuple): (lmdb_path, start_key, num_keys)
+    """
+    lmdb_path, start_key, num_keys = args
+    label_frames = collections.defaultdict(list)
+    with open_readonly_lmdb(lmdb_path).begin(buffers=True) as transaction:
+        cursor = transaction.cursor()
+        cursor.set_key(start_key)
+        for i, (key, value) in enumerate(cursor):
+            if i == num_keys:
+                break
+            frame = parse_frame_key(bytes(key))
+            for name, _ in parse_labels(value):
+                label_frames[name].append(frame)
+    return label_frames
+
+
+def sample_frames(frames, num_samples, rng, mode, label_frames=None):
+    """Sample (group, video_name, frame_index) tuples.
+
+    Args:
+        frames (dict): Maps video name to list of frame indices.
+        num_samples (int): Number of samples overall (random), or per group.
+        rng (random.Random)
+        mode (str): 'random', 'per_video' or 'per_label'.
+        label_frames (dict): Maps label name to list of (video_name,
+            frame_index) tuples. Required for per_label.
+
+    Returns:
+        samples (list): Sorted by group, then video and frame.
+    """
+    if mode == 'random':
+        groups = {'': [(video, frame) for video, indices in frames.items()
+                       for frame in indices]}
+    elif mode == 'per_video':
+        groups = {video: [(video, frame) for frame in indices]
+                  for video, indices in frames.items()}
+    elif mode == 'per_label':
+        groups = label_frames
+    else:
+        raise ValueError('Unknown sampling mode: %s' % mode)
+    samples = []
+    for group in sorted(groups):
+        members = groups[group]
+        chosen = rng.sample(members, min(num_samples, len(members)))
+        samples.extend((group, ) + x for x in sorted(chosen))
+    return samples
+
+
+def render_page(tiles, captions, rows, columns, tile_width, tile_height):
+    """Tile thumbnails and their captions into one image."""
+    cell_height = tile_height + CAPTION_LINE_HEIGHT * CAPTION_LINES
+    page = Image.new('RGB', (columns * tile_width, rows * cell_height),
+                     BACKGROUND_COLOR)
+    draw = ImageDraw.Draw(page)
+    for i, (tile, caption) in enumerate(zip(tiles, captions)):
+        row, column = divmod(i, columns)
+        x = column * tile_width
+        y = row * cell_height
+        height, width = tile.shape[:2]
+        page.paste(Image.fromarray(tile), (x + (tile_width - width) // 2,
+                                           y + (tile_height - height) // 2))
+        for line_index, line in enumerate(caption[:CAPTION_LINES]):
+            draw.text((x + 2, y + tile_height + line_index *
+                       CAPTION_LINE_HEIGHT), line, fill=TEXT_COLOR)
+    return page
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n')[0],
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    input_group = parser.add_mutually_exclusive_group(required=True)
+    input_group.add_argument('--input_lmdb')
+    input_group.add_argument('--frames_root')
+    parser.add_argument('--output_prefix', required=True)
+    parser.add_argument('--video_frames',
+                        action='store_true',
+                        help="""Input LMDB contains VideoFrames instead of
+                        LabeledVideoFrames.""")
+    parser.add_argument('--annotations_json',
+                        help='Annotations used to label --frames_root.')
+    parser.add_argument('--frames_per_second',
+                        default=0,
+                        type=float,
+                        help='FPS that frames were extracted at.')
+    parser.add_argument('--frame_step',
+                        default=0,
+                        type=float,
+                        help="""Frame step that frames were extracted at.
+                        Either frame_step or frames_per_second must be
+                        specified with --annotations_json.""")
+    parser.add_argument('--sample',
+                        choices=['random', 'per_video', 'per_label'],
+                        default='random')
+    parser.add_argument('--num_samples',
+                        default=100,
+                        type=int,
+                        help="""Number of frames to sample (per video or
+                        label, for per_video and per_label).""")
+    parser.add_argument('--rows', default=8, type=int)
+    parser.add_argument('--columns', default=8, type=int)
+    parser.add_argument('--tile_width', default=160, type=int)
+    parser.add_argument('--tile_height', default=120, type=int)
+    parser.add_argument('--seed', default=0, type=int)
+    parser.add_argument('--num_processes', default=8, type=int)
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.INFO)
+    logging.basicConfig(format='%(asctime)s.%(msecs).03d: %(message)s',
+                        datefmt='%H:%M:%S')
+
+    output_dir = os.path.dirname(args.output_prefix)
+    if output_dir and not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    pool = mp.Pool(args.num_processes)
+    rng = random.Random(args.seed)
+    label_frames = None
+    if args.input_lmdb:
+        labeled = not args.video_frames
+        frames = load_video_frames(open_readonly_lmdb(args.input_lmdb))
+        if args.sample == 'per_label':
+            if not labeled:
+                parser.error('per_label sampling requires labeled frames.')
+            label_frames = collections.defaultdict(list)
+            tasks = [(args.input_lmdb, start_key, num_keys)
+                     for start_key, num_keys in key_ranges(args.input_lmdb,
+                                                           10000)]
+            for range_labels in pool.imap(scan_lmdb_labels, tasks):
+                for name, range_frames in range_labels.items():
+                    label_frames[name].extend(range_frames)
+        samples = sample_frames(frames, args.num_samples, rng, args.sample,
+                                label_frames)
+        load_function = load_lmdb_tile
+        tasks = [(args.input_lmdb, labeled, video, frame, args.tile_width,
+                  args.tile_height) for _, video, frame in samples]
+    else:
+        frame_paths = {}
+        frames = collections.defaultdict(list)
+        for frame_path in glob.iglob('{}/*/*.png'.format(args.frames_root)):
+            frame_info = parse_frame_path(frame_path)
+            if frame_info is not None:
+                frame_paths[frame_info] = frame_path
+                frames[frame_info[0]].append(frame_info[1])
+        label_indices = {}
+        if args.annotations_json:
+            assert (args.frames_per_second == 0) != (args.frame_step == 0), (
+                "Exactly one of --frames_per_second or --frame_step "
+                "must be specified.")
+            annotations = load_annotations_json(args.annotations_json)
+            for video in frames:
+                if args.frames_per_second:
+                    label_indices[video] = FrameLabelIndex(
+                        annotations.get(video, []),
+                        frames_per_second=args.frames_per_second)
+                else:
+                    label_indices[video] = FrameLabelIndex(
+                        annotations.get(video, []),
+                        frame_step=args.frame_step)
+
+        def frame_labels(video, frame):
+            if video not in label_indices:
+                return []
+            # Frames are 1-indexed on disk.
+            return label_indices[video].labels(frame - 1)
+
+        if args.sample == 'per_label':
+            if not label_indices:
+                parser.error('per_label sampling requires --annotations_json.')
+            label_frames = collections.defaultdict(list)
+            for video, indices in frames.items():
+                for frame in indices:
+                    for label in frame_labels(video, frame):
+                        label_frames[label].append((video, frame))
+        samples = sample_frames(frames, args.num_samples, rng, args.sample,
+                                label_frames)
+        load_function = load_file_tile
+        tasks = [(frame_paths[(video, frame)], frame_labels(video, frame),
+                  args.tile_width, args.tile_height)
+                 for _, video, frame in samples]
+    logging.info('Sampled %s frames', len(samples))
+
+    page_size = args.rows * args.columns
+    tiles = []
+    captions = []
+    num_pages = 0
+    for (_, video, frame), (tile, labels) in zip(
+            samples,
+            tqdm(pool.imap(load_function, tasks, chunksize=8),
+                 total=len(tasks))):
+        tiles.append(tile)
+        captions.append(['{}-{}'.format(video, frame),
+                         ', '.join(labels) or '(no labels)'])
+        if len(tiles) == page_size:
+            num_pages += 1
+            render_page(tiles, captions, args.rows, args.columns,
+                        args.tile_width, args.tile_height).save(
+                            '{}-{:03d}.png'.format(args.output_prefix,
+                                                   num_pages))
+            tiles = []
+            captions = []
+    if tiles:
+        num_pages += 1
+        rows = (len(tiles) + args.columns - 1) // args.columns
+        render_page(tiles, captions, rows, args.columns, args.tile_width,
+                    args.tile_height).save('{}-{:03d}.png'.format(
+                        args.output_prefix, num_pages))
+    pool.close()
+    logging.info('Wrote %s pages to %s-*.png', num_pages, args.output_prefix)
+
+
+if __name__ == "__main__":
+    main()
@@ -28,37 +28,30 @@ from os import path
 
 import caffe
 import lmdb
-import numpy as np
-from PIL import Image
 from tqdm import tqdm
 
-from frame_loader_util import parse_frame_path, frame_path_to_key
+from frame_loader_util import (add_resize_arguments, frame_path_to_key,
+                               load_image, parse_frame_path,
+                               resize_arguments_from_args)
+from util.frame_cache import add_frame_cache_arguments, frame_cache_from_args
+from util.sharding import (add_shard_arguments, check_shard_arguments,
+                           in_shard, shard_output_path,
+                           write_completion_marker)
 
 
-def load_image_datum(image_path, resize_height=None, resize_width=None):
+def load_image_datum(image_path, resize_arguments):
     """Load an image in a Caffe datum in BGR order.
 
     Args:
         image_path (str): Path to an image.
-        resize_height (int): Height to resize an image to. If 0 or None, the
-            image is not resized.
-        resize_width (int): Width to resize an image to. If 0 or None, the
-            image is not resized.
+        resize_arguments (dict): Keyword arguments for
+            frame_loader_util.load_image.
 
     Returns:
         image_datum (caffe Datum): Contains the image in BGR order after
             resizing.
     """
-    image = Image.open(image_path)
-    if resize_height and resize_width:
-        image = image.resize((resize_width, resize_height))
-    # Image has shape (height, width, num_channels), where the
-    # channels are in RGB order.
-    image = np.array(image)
-    # Convert image from RGB to BGR.
-    image = image[:, :, ::-1]
-    # Convert image to (num_channels, height, width) shape.
-    image = image.transpose((2, 0, 1))
+    image = load_image(image_path, **resize_arguments)
     return caffe.io.array_to_datum(image).SerializeToString()
 
 
@@ -67,9 +60,9 @@ def load_image_datum_helper(args):
     return load_image_datum(*args)
 
 
-def load_image_batch(pool, frame_paths, resize_height, resize_width):
+def load_image_batch(pool, frame_paths, resize_arguments):
     """Loads a batch of images by calling load_image_datum in parallel."""
-    job_arguments = [(frame_path, resize_height, resize_width)
+    job_arguments = [(frame_path, resize_arguments)
                      for frame_path in frame_paths]
     return pool.map(load_image_datum_helper, job_arguments)
 
@@ -80,31 +73,34 @@ def main():
         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument('frames_root')
     parser.add_argument('output_lmdb')
-    parser.add_argument('--resize_width', default=None, nargs='?', type=int)
-    parser.add_argument('--resize_height', default=None, nargs='?', type=int)
+    add_resize_arguments(parser)
+    add_frame_cache_arguments(parser)
+    add_shard_arguments(parser)
 
     args = parser.parse_args()
+    check_shard_arguments(parser, args)
+    output_lmdb = shard_output_path(args.output_lmdb, args.shard_index,
+                                    args.num_shards)
 
-    # TODO(achald): Allow specifying either one, and resize the other based on
-    # aspect ratio.
-    if (args.resize_width is None) != (args.resize_height is None):
-        raise ValueError('Both resize_width and resize_height must be '
-                         'specified if either is specified.')
+    resize_arguments = resize_arguments_from_args(args)
+    resize_arguments['frame_cache'] = frame_cache_from_args(args)
     map_size = 500e9
 
     batch_size = 10000
 
-    print 'Loading frame paths.'
+    print('Loading frame paths.')
     frame_path_key_pairs = [
         (frame_path, frame_path_to_key(frame_path))
         for frame_path in glob.iglob('{}/*/*.png'.format(args.frames_root))
+        if in_shard(path.basename(path.dirname(frame_path)), args.shard_index,
+                    args.num_shards)
     ]
 
     frame_path_key_pairs_batched = (
         frame_path_key_pairs[i:i + batch_size]
         for i in range(0, len(frame_path_key_pairs), batch_size)
     )
-    print 'Loaded frame paths.'
+    print('Loaded frame paths.')
 
     progress = tqdm(total=len(frame_path_key_pairs))
     pool = mp.Pool(8)
@@ -112,18 +108,22 @@ def main():
         images_batch = load_image_batch(pool,
                                         [x[0]
                                          for x in frame_path_key_pairs_batch],
-                                        args.resize_height, args.resize_width)
-        lmdb_environment = lmdb.open(args.output_lmdb, map_size=int(map_size))
+                                        resize_arguments)
+        lmdb_environment = lmdb.open(output_lmdb, map_size=int(map_size))
         with lmdb_environment.begin(write=True) as lmdb_transaction:
             for i, (frame_path,
                     frame_key) in enumerate(frame_path_key_pairs_batch):
-                lmdb_transaction.put(frame_key, images_batch[i])
+                lmdb_transaction.put(frame_key.encode('utf-8'),
+                                     images_batch[i])
                 progress.update(1)
         # Usually, Python garbage collects on its own just fine. In this case,
         # it seems it isn't deleting images_batch until after the next
         # images_batch is finished loading (but this is just a conjecture).
         lmdb_environment.close()
         del images_batch
+    write_completion_marker(args.output_lmdb, args.shard_index,
+                            args.num_shards,
+                            num_frames=len(frame_path_key_pairs))
 
 
 if __name__ == "__main__":
@@ -16,9 +16,17 @@ parse_temporal_annotations.py.
 The output LMDB contains keys "<video_name>-<frame-number>" and corresponding
 LabeledVideoFrame as values. For example, video1/frame2.png is stored as the
 key "video1-2".
+
+With --clip_length T, frames are instead packed into VideoFrameClips of T
+consecutive frames (the last clip of a video may be shorter), keyed by their
+first frame: "<video_name>-1", "<video_name>-<1 + T>", "<video_name>-<1 + 2T>",
+and so on. Frames must be numbered consecutively from 1. Use
+util.video_frames_reader.VideoFrameClipsReader to read frames from such an
+LMDB.
 """
 
 import argparse
+import collections
 import glob
 import multiprocessing as mp
 import logging
@@ -27,14 +35,18 @@ from contextlib import contextmanager
 
 import lmdb
 import numpy as np
-from PIL import Image
 from tqdm import tqdm
 
-from util.annotation import (collect_frame_labels, load_annotations_json,
+from util.annotation import (FrameLabelIndex, load_annotations_json,
                              load_label_ids)
 from frames_to_video_frames_proto_lmdb import image_array_to_proto
-from frame_loader_util import load_images_async, parse_frame_path
+from frame_loader_util import (add_resize_arguments, load_images_async,
+                               parse_frame_path, resize_arguments_from_args)
 from util import video_frames_pb2
+from util.frame_cache import add_frame_cache_arguments, frame_cache_from_args
+from util.sharding import (add_shard_arguments, check_shard_arguments,
+                           in_shard, shard_output_path,
+                           write_completion_marker)
 
 
 def create_labeled_frame(video_name, frame_index, image_proto, labels,
@@ -50,45 +62,54 @@ def create_labeled_frame(video_name, frame_index, image_proto, labels,
     return video_frame
 
 
-def load_image(image_path, resize_height=None, resize_width=None):
-    """Load an image in video_frames.Image format.
+def create_video_frame_clip(video_name, start_frame_index, image_arrays,
+                            frame_labels, label_ids):
+    """Create a VideoFrameClip from consecutive frames.
 
     Args:
-        image_path (str): Path to an image.
-        resize_height (int): Height to resize an image to. If 0 or None, the
-            image is not resized.
-        resize_width (int): Width to resize an image to. If 0 or None, the
-            image is not resized.
-
-    Returns:
-        image_datum (numpy array): Contains the image in BGR order after
-            resizing.
+        video_name (str)
+        start_frame_index (int): Index of the first frame.
+        image_arrays (list of np.array): (channels, height, width) images, in
+            frame order.
+        frame_labels (list of list of str): Labels of each frame.
+        label_ids (dict): Maps label name to id.
+    """
+    clip = video_frames_pb2.VideoFrameClip()
+    clip.video_name = video_name
+    clip.start_frame_index = start_frame_index
+    clip.num_frames = len(image_arrays)
+    clip.channels, clip.height, clip.width = image_arrays[0].shape
+    clip.data = np.stack(image_arrays).tobytes()
+    for labels in frame_labels:
+        labels_proto = clip.frame_labels.add()
+        for label in labels:
+            label_proto = labels_proto.label.add()
+            label_proto.name = label
+            label_proto.id = label_ids[label]
+    return clip
+
+
+def main(argv=None):
+    """
+    A shard without any videos writes an empty LMDB and is marked complete:
+
+    >>> import os, tempfile
+    >>> root = tempfile.mkdtemp()
+    >>> with open(os.path.join(root, 'annotations.json'), 'w') as f:
+    ...     _ = f.write('[]')
+    >>> with open(os.path.join(root, 'classes.txt'), 'w') as f:
+    ...     _ = f.write('0 jump')
+    >>> output_lmdb = os.path.join(root, 'frames.lmdb')
+    >>> main(['--frames_root', os.path.join(root, 'frames'),
+    ...       '--annotations_json', os.path.join(root, 'annotations.json'),
+    ...       '--class_mapping', os.path.join(root, 'classes.txt'),
+    ...       '--output_lmdb', output_lmdb, '--frames_per_second', '1',
+    ...       '--shard-index', '1', '--num-shards', '2'])
+    >>> from util.sharding import missing_shards
+    >>> missing_shards(output_lmdb, 2)
+    [0]
+    >>> import shutil; shutil.rmtree(root)
     """
-    image = Image.open(image_path)
-    if resize_height and resize_width:
-        image = image.resize((resize_width, resize_height))
-    # Image has shape (height, width, num_channels), where the
-    # channels are in RGB order.
-    image = np.array(image)
-    # Convert image from RGB to BGR.
-    image = image[:, :, ::-1]
-    # Convert image to (num_channels, height, width) shape.
-    image = image.transpose((2, 0, 1))
-    return image
-
-
-def load_image_helper(args):
-    return load_image(*args)
-
-
-def load_image_batch(pool, frame_paths, resize_height, resize_width):
-    """Loads a batch of images by calling load_image_datum in parallel."""
-    job_arguments = [(frame_path, resize_height, resize_width)
-                     for frame_path in frame_paths]
-    return pool.map(load_image_helper, job_arguments)
-
-
-def main():
     parser = argparse.ArgumentParser(
         description=__doc__.split('\n')[0],
         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
@@ -104,8 +125,8 @@ def main():
     parser.add_argument('--output_without_images_lmdb', required=False)
 
     # Optional arguments.
-    parser.add_argument('--resize_width', default=None, nargs='?', type=int)
-    parser.add_argument('--resize_height', default=None, nargs='?', type=int)
+    add_resize_arguments(parser)
+    add_frame_cache_arguments(parser)
     parser.add_argument('--frames_per_second',
                         default=0,
                         type=float,
@@ -118,6 +139,12 @@ def main():
                         extracted. Either frame_step or frames_per_second must
                         be specified.""")
     parser.add_argument('--num_processes', default=16, nargs='?', type=int)
+    parser.add_argument('--clip_length',
+                        default=0,
+                        type=int,
+                        help="""If positive, store VideoFrameClips of this many
+                        consecutive frames instead of one LabeledVideoFrame
+                        per frame.""")
     parser.add_argument('--one-indexed-labels',
                         default=False,
                         action='store_true',
@@ -125,10 +152,19 @@ def main():
                         mapping are assumed to be 1-indexed; the output label
                         ids will be the input label id minus 1 so that they
                         are zero-indexed.""")
-
-    args = parser.parse_args()
-
-    logging_filepath = args.output_lmdb + '.log'
+    add_shard_arguments(parser)
+
+    args = parser.parse_args(argv)
+    check_shard_arguments(parser, args)
+    output_lmdb = shard_output_path(args.output_lmdb, args.shard_index,
+                                    args.num_shards)
+    output_without_images_lmdb = None
+    if args.output_without_images_lmdb:
+        output_without_images_lmdb = shard_output_path(
+            args.output_without_images_lmdb, args.shard_index,
+            args.num_shards)
+
+    logging_filepath = output_lmdb + '.log'
     log_formatter = logging.Formatter('%(asctime)s.%(msecs).03d: %(message)s',
                                       datefmt='%H:%M:%S')
 
@@ -140,11 +176,8 @@ def main():
     logging.info('Command line arguments: %s', sys.argv)
     logging.info('Parsed arguments: %s', args)
 
-    # TODO(achald): Allow specifying either one, and resize the other based on
-    # aspect ratio.
-    if (args.resize_width is None) != (args.resize_height is None):
-        raise ValueError('Both resize_width and resize_height must be '
-                         'specified if either is specified.')
+    resize_arguments = resize_arguments_from_args(args)
+    resize_arguments['frame_cache'] = frame_cache_from_args(args)
     map_size = int(500e9)
 
     assert (args.frames_per_second == 0) != (args.frame_step == 0), (
@@ -157,36 +190,76 @@ def main():
         frame_path: parse_frame_path(frame_path)
         for frame_path in glob.iglob('{}/*/*.png'.format(args.frames_root))
     }
+    frame_path_info = {
+        frame_path: info
+        for frame_path, info in frame_path_info.items()
+        if in_shard(info[0], args.shard_index, args.num_shards)
+    }
 
     logging.info('Loaded frame paths.')
 
-    annotations = load_annotations_json(args.annotations_json)
+    # Maps video name to number of frames, for --clip_length.
+    video_num_frames = {}
+    if args.clip_length > 0:
+        video_indices = collections.defaultdict(set)
+        for video_name, frame_index in frame_path_info.values():
+            video_indices[video_name].add(frame_index)
+        for video_name, indices in video_indices.items():
+            if indices == set(range(1, len(indices) + 1)):
+                video_num_frames[video_name] = len(indices)
+            else:
+                logging.error('Frames of %s are not numbered 1 to %s; '
+                              'skipping video.', video_name, len(indices))
+        frame_path_info = {
+            frame_path: info
+            for frame_path, info in frame_path_info.items()
+            if info[0] in video_num_frames
+        }
 
     num_paths = len(frame_path_info)
+    if num_paths == 0:
+        # Nothing to load; common when videos are hashed into many shards.
+        logging.info('No frames to write.')
+        lmdb.open(output_lmdb, map_size=map_size).close()
+        write_completion_marker(args.output_lmdb, args.shard_index,
+                                args.num_shards, num_frames=0)
+        return
+
+    annotations = load_annotations_json(args.annotations_json)
+
     progress = tqdm(total=num_paths)
 
     mp_manager = mp.Manager()
     queue = mp_manager.Queue(maxsize=batch_size)
     # Spawn threads to load images.
-    load_images_async(queue, args.num_processes, frame_path_info.keys(),
-                      args.resize_height, args.resize_width)
+    # Load frames in order, so that clips are completed (and their frames
+    # released) as soon as possible.
+    load_images_async(queue, args.num_processes,
+                      sorted(frame_path_info, key=frame_path_info.get),
+                      **resize_arguments)
     label_ids = load_label_ids(args.class_mapping, args.one_indexed_labels)
 
     @contextmanager
     def open_lmdbs():
-        if 'output_without_images_lmdb' in args:
-            with lmdb.open(args.output_lmdb,
+        if output_without_images_lmdb:
+            with lmdb.open(output_lmdb,
                            map_size=map_size).begin(write=True) \
                     as with_images, \
-                    lmdb.open(args.output_without_images_lmdb,
+                    lmdb.open(output_without_images_lmdb,
                               map_size=map_size).begin(write=True) \
                     as without_images:
                 yield with_images, without_images
         else:
-            with lmdb.open(args.output_lmdb, map_size=map_size).begin(
+            with lmdb.open(output_lmdb, map_size=map_size).begin(
                     write=True) as with_images:
                 yield with_images, None
 
+    # Maps video name to FrameLabelIndex.
+    label_indices = {}
+    # Maps (video name, start frame index) of incomplete clips to a dict
+    # mapping frame index to (image array, labels).
+    pending_clips = {}
+
     num_stored = 0
     loaded_images = False
     while True:
@@ -195,35 +268,62 @@ def main():
         with open_lmdbs() as transactions:
             lmdb_transaction, imageless_lmdb_transaction = transactions
             for _ in range(batch_size):
-                # Convert image arrays to image protocol buffers.
                 frame_path, image_array = queue.get()
-                image = image_array_to_proto(image_array)
-
                 video_name, frame_index = frame_path_info[frame_path]
-                if args.frames_per_second != 0:
-                    labels = collect_frame_labels(
-                        annotations[video_name],
-                        frame_index - 1,
-                        frames_per_second=args.frames_per_second)
-                else: # args.frame_step != 0
-                    labels = collect_frame_labels(annotations[video_name],
-                                                  frame_index - 1,
-                                                  frame_step=args.frame_step)
-                video_frame_proto = create_labeled_frame(
-                    video_name, frame_index, image, labels, label_ids)
-                frame_key = '{}-{}'.format(video_name, frame_index)
-                lmdb_transaction.put(frame_key,
-                                     video_frame_proto.SerializeToString())
-                if imageless_lmdb_transaction is not None:
-                    video_frame_proto.frame.image.data = ''
-                    imageless_lmdb_transaction.put(
+                if video_name not in label_indices:
+                    if args.frames_per_second != 0:
+                        label_indices[video_name] = FrameLabelIndex(
+                            annotations[video_name],
+                            frames_per_second=args.frames_per_second)
+                    else: # args.frame_step != 0
+                        label_indices[video_name] = FrameLabelIndex(
+                            annotations[video_name],
+                            frame_step=args.frame_step)
+                labels = label_indices[video_name].labels(frame_index - 1)
+                if args.clip_length > 0:
+                    clip_start = (1 + (frame_index - 1) // args.clip_length *
+                                  args.clip_length)
+                    clip = pending_clips.setdefault((video_name, clip_start),
+                                                    {})
+                    clip[frame_index] = (image_array, labels)
+                    clip_frames = min(
+                        args.clip_length,
+                        video_num_frames[video_name] - clip_start + 1)
+                    if len(clip) == clip_frames:
+                        del pending_clips[(video_name, clip_start)]
+                        frames = [clip[i] for i in sorted(clip)]
+                        clip_proto = create_video_frame_clip(
+                            video_name, clip_start, [x[0] for x in frames],
+                            [x[1] for x in frames], label_ids)
+                        clip_key = '{}-{}'.format(
+                            video_name, clip_start).encode('utf-8')
+                        lmdb_transaction.put(clip_key,
+                                             clip_proto.SerializeToString())
+                        if imageless_lmdb_transaction is not None:
+                            clip_proto.data = b''
+                            imageless_lmdb_transaction.put(
+                                clip_key, clip_proto.SerializeToString())
+                else:
+                    # Convert image arrays to image protocol buffers.
+                    image = image_array_to_proto(image_array)
+                    video_frame_proto = create_labeled_frame(
+                        video_name, frame_index, image, labels, label_ids)
+                    frame_key = '{}-{}'.format(
+                        video_name, frame_index).encode('utf-8')
+                    lmdb_transaction.put(
                         frame_key, video_frame_proto.SerializeToString())
+                    if imageless_lmdb_transaction is not None:
+                        video_frame_proto.frame.image.data = b''
+                        imageless_lmdb_transaction.put(
+                            frame_key, video_frame_proto.SerializeToString())
                 progress.update(1)
                 num_stored += 1
                 if num_stored >= num_paths:
                     loaded_images = True
                     break
-    logging.info('Output frames to %s.', args.output_lmdb)
+    logging.info('Output frames to %s.', output_lmdb)
+    write_completion_marker(args.output_lmdb, args.shard_index,
+                            args.num_shards, num_frames=num_paths)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,275 @@
+"""Export video frames to per-video NumPy arrays that can be memory mapped.
+
+Takes as input either an LMDB of VideoFrames/LabeledVideoFrames (as created by
+frames_to_video_frames_proto_lmdb.py or frames_to_labeled_video_frames_lmdb.py)
+or a root directory that contains a subdirectory for each video, which in turn
+contain frames for the video. For example:
+
+    <dataset>/
+        <video_name>/
+            frame1.png
+            frame2.png
+            ...
+
+Each video is written as a (num_frames, channels, height, width) uint8 .npy
+file, with frames in BGR order sorted by frame index, alongside an optional
+(num_frames, num_classes) uint8 label matrix and an index.json file. See
+util/video_memmap.py for the layout and for a loader.
+
+Labels are taken from the LabeledVideoFrames, or, for frame directories,
+computed from --annotations_json as in frames_to_labeled_video_frames_lmdb.py.
+"""
+
+import argparse
+import collections
+import glob
+import json
+import logging
+import multiprocessing as mp
+import os
+import sys
+
+import numpy as np
+from tqdm import tqdm
+
+from frame_loader_util import (add_resize_arguments, load_image,
+                               parse_frame_path, resize_arguments_from_args)
+from util.annotation import (FrameLabelIndex, load_annotations_json,
+                             load_label_ids)
+from util.frame_cache import add_frame_cache_arguments, frame_cache_from_args
+from util.video_frames_reader import (frame_key, load_video_frames,
+                                      open_readonly_lmdb)
+from util.video_frames_wire import parse_frame, parse_labels
+from util.video_memmap import INDEX_FILENAME, video_paths
+
+
+def _video_info(output_dir, video_name, frame_indices, has_labels):
+    """Write frame indices if needed and return the index entry of a video."""
+    frame_indices = np.asarray(frame_indices)
+    info = {'num_frames': len(frame_indices), 'has_labels': has_labels}
+    contiguous = np.array_equal(
+        frame_indices, np.arange(frame_indices[0],
+                                 frame_indices[0] + len(frame_indices)))
+    if contiguous:
+        info['first_frame_index'] = int(frame_indices[0])
+    else:
+        info['first_frame_index'] = None
+        np.save(video_paths(output_dir, video_name)[2], frame_indices)
+    return info
+
+
+def export_lmdb_video(args):
+    """Export one video from an LMDB.
+
+    Args:
+        args (tuple): (input_lmdb, labeled, output_dir, video_name,
+            frame_indices, num_classes). Labels are only exported if labeled
+            and num_classes is not None.
+
+    Returns:
+        video_name (str)
+        info (dict): Index entry for the video.
+    """
+    (input_lmdb, labeled, output_dir, video_name, frame_indices,
+     num_classes) = args
+    frames_path, labels_path, _ = video_paths(output_dir, video_name)
+    export_labels = labeled and num_classes is not None
+    with open_readonly_lmdb(input_lmdb).begin(buffers=True) as transaction:
+        frames = None
+        labels = None
+        for i, frame_index in enumerate(frame_indices):
+            value = transaction.get(frame_key(video_name, frame_index))
+            image = parse_frame(value, labeled).image
+            shape = (image.channels, image.height, image.width)
+            if frames is None:
+                frames = np.lib.format.open_memmap(
+                    frames_path, mode='w+', dtype=np.uint8,
+                    shape=(len(frame_indices), ) + shape)
+                if export_labels:
+                    labels = np.lib.format.open_memmap(
+                        labels_path, mode='w+', dtype=np.uint8,
+                        shape=(len(frame_indices), num_classes))
+            frames[i] = np.frombuffer(value, dtype=np.uint8,
+                                      count=image.data_end - image.data_start,
+                                      offset=image.data_start).reshape(shape)
+            if export_labels:
+                labels[i] = 0
+                labels[i, [label_id for _, label_id in parse_labels(value)
+                           ]] = 1
+    frames.flush()
+    if labels is not None:
+        labels.flush()
+    return video_name, _video_info(output_dir, video_name, frame_indices,
+                                   export_labels)
+
+
+def export_directory_video(args):
+    """Export one video from a directory of frames.
+
+    Args:
+        args (tuple): (output_dir, video_name, frames, resize_arguments,
+            label_args). frames is a list of (frame_index, frame_path) tuples
+            sorted by frame index. resize_arguments is a dict of keyword
+            arguments for frame_loader_util.load_image. label_args is None, or
+            (file_annotations, label_ids, frames_per_second, frame_step).
+
+    Returns:
+        video_name (str)
+        info (dict): Index entry for the video.
+    """
+    output_dir, video_name, frames, resize_arguments, label_args = args
+    frames_path, labels_path, _ = video_paths(output_dir, video_name)
+    frames_array = None
+    labels = None
+    for i, (frame_index, frame_path) in enumerate(frames):
+        image = load_image(frame_path, **resize_arguments)
+        if frames_array is None:
+            frames_array = np.lib.format.open_memmap(
+                frames_path, mode='w+', dtype=np.uint8,
+                shape=(len(frames), ) + image.shape)
+        frames_array[i] = image
+    frames_array.flush()
+    if label_args is not None:
+        file_annotations, label_ids, frames_per_second, frame_step = label_args
+        if frames_per_second:
+            label_index = FrameLabelIndex(file_annotations,
+                                          frames_per_second=frames_per_second)
+        else:
+            label_index = FrameLabelIndex(file_annotations,
+                                          frame_step=frame_step)
+        # Frames are usually 1-indexed on disk, but older dumps are
+        # 0-indexed; as in dump_frames.frames_already_dumped, a video is
+        # 0-indexed if it has a frame 0.
+        frame_indices = np.array([frame_index for frame_index, _ in frames])
+        offset = 0 if frame_indices.min() == 0 else 1
+        if offset == 0:
+            logging.info('Frames of %s are 0-indexed.', video_name)
+        label_rows = frame_indices - offset
+        all_labels = label_index.label_matrix(label_rows.max() + 1, label_ids)
+        labels = np.lib.format.open_memmap(labels_path, mode='w+',
+                                           dtype=np.uint8,
+                                           shape=(len(frames), len(label_ids)))
+        labels[:] = all_labels[label_rows]
+        labels.flush()
+    return video_name, _video_info(output_dir, video_name,
+                                   [frame_index for frame_index, _ in frames],
+                                   label_args is not None)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n')[0],
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    input_group = parser.add_mutually_exclusive_group(required=True)
+    input_group.add_argument('--input_lmdb')
+    input_group.add_argument('--frames_root')
+    parser.add_argument('--output_dir', required=True)
+    parser.add_argument('--video_frames',
+                        action='store_true',
+                        help="""Input LMDB contains VideoFrames instead of
+                        LabeledVideoFrames.""")
+    parser.add_argument('--class_mapping',
+                        help="""
+                        File containing lines of the form "<class_int_id>
+                        <class_name>". Required to export labels. The class id
+                        are assumed to be 0-indexed unless --one-indexed-labels
+                        is specified.""")
+    parser.add_argument('--one-indexed-labels',
+                        default=False,
+                        action='store_true',
+                        help="""If specified, the input label ids in the class
+                        mapping are assumed to be 1-indexed; the output label
+                        ids will be the input label id minus 1 so that they
+                        are zero-indexed.""")
+    parser.add_argument('--annotations_json',
+                        help="""Annotations used to label frames from
+                        --frames_root.""")
+    parser.add_argument('--frames_per_second',
+                        default=0,
+                        type=float,
+                        help='FPS that frames were extracted at.')
+    parser.add_argument('--frame_step',
+                        default=0,
+                        type=float,
+                        help="""Frame step that frames were extracted at.
+                        Either frame_step or frames_per_second must be
+                        specified with --annotations_json.""")
+    add_resize_arguments(parser)
+    add_frame_cache_arguments(parser)
+    parser.add_argument('--num_processes', default=8, type=int)
+    args = parser.parse_args()
+
+    for subdirectory in ('frames', 'labels', 'frame_indices'):
+        path = os.path.join(args.output_dir, subdirectory)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    logging_filepath = os.path.join(args.output_dir, 'export.log')
+    log_formatter = logging.Formatter('%(asctime)s.%(msecs).03d: %(message)s',
+                                      datefmt='%H:%M:%S')
+    file_handler = logging.FileHandler(logging_filepath)
+    file_handler.setFormatter(log_formatter)
+    logging.getLogger().addHandler(file_handler)
+    logging.getLogger().setLevel(logging.INFO)
+
+    logging.info('Writing log file to %s', logging_filepath)
+    logging.info('Command line arguments: %s', sys.argv)
+    logging.info('Parsed arguments: %s', args)
+
+    resize_arguments = resize_arguments_from_args(args)
+    resize_arguments['frame_cache'] = frame_cache_from_args(args)
+
+    label_ids = None
+    if args.class_mapping:
+        label_ids = load_label_ids(args.class_mapping,
+                                   args.one_indexed_labels)
+    num_classes = len(label_ids) if label_ids is not None else None
+
+    if args.input_lmdb:
+        video_frames = load_video_frames(open_readonly_lmdb(args.input_lmdb))
+        tasks = [(args.input_lmdb, not args.video_frames, args.output_dir,
+                  video_name, frame_indices, num_classes)
+                 for video_name, frame_indices in video_frames.items()]
+        export_function = export_lmdb_video
+    else:
+        annotations = None
+        if args.annotations_json:
+            assert label_ids is not None, (
+                '--class_mapping must be specified with --annotations_json.')
+            assert (args.frames_per_second == 0) != (args.frame_step == 0), (
+                "Exactly one of --frames_per_second or --frame_step "
+                "must be specified.")
+            annotations = load_annotations_json(args.annotations_json)
+        video_frames = collections.defaultdict(list)
+        for frame_path in glob.iglob('{}/*/*.png'.format(args.frames_root)):
+            frame_info = parse_frame_path(frame_path)
+            if frame_info is None:
+                continue
+            video_name, frame_index = frame_info
+            video_frames[video_name].append((frame_index, frame_path))
+        tasks = []
+        for video_name in sorted(video_frames):
+            label_args = None
+            if annotations is not None:
+                label_args = (annotations.get(video_name, []), label_ids,
+                              args.frames_per_second, args.frame_step)
+            tasks.append((args.output_dir, video_name,
+                          sorted(video_frames[video_name]),
+                          resize_arguments, label_args))
+        export_function = export_directory_video
+    logging.info('Exporting %d videos', len(tasks))
+
+    pool = mp.Pool(args.num_processes)
+    videos = {}
+    for video_name, info in tqdm(pool.imap_unordered(export_function, tasks),
+                                 total=len(tasks)):
+        videos[video_name] = info
+    pool.close()
+
+    with open(os.path.join(args.output_dir, INDEX_FILENAME), 'w') as f:
+        json.dump({'num_classes': num_classes, 'videos': videos}, f)
+    logging.info('Exported %d videos to %s', len(videos), args.output_dir)
+
+
+if __name__ == "__main__":
+    main()
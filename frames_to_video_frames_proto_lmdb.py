@@ -23,12 +23,15 @@ import multiprocessing as mp
 import sys
 
 import lmdb
-import numpy as np
-from PIL import Image
 from tqdm import tqdm
 
 from util import video_frames_pb2
-from frame_loader_util import load_images_async, parse_frame_path
+from frame_loader_util import (add_resize_arguments, load_images_async,
+                               parse_frame_path, resize_arguments_from_args)
+from util.frame_cache import add_frame_cache_arguments, frame_cache_from_args
+from util.sharding import (add_shard_arguments, check_shard_arguments,
+                           in_shard, shard_output_path,
+                           write_completion_marker)
 
 logging.getLogger().setLevel(logging.INFO)
 logging.basicConfig(format='%(asctime)s.%(msecs).03d: %(message)s',
@@ -47,7 +50,7 @@ def create_video_frame(video_name, frame_index, image_proto):
 def image_array_to_proto(image_array):
     image = video_frames_pb2.Image()
     image.channels, image.height, image.width = image_array.shape
-    image.data = image_array.tostring()
+    image.data = image_array.tobytes()
     return image
 
 
@@ -57,16 +60,17 @@ def main():
         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument('frames_root')
     parser.add_argument('output_lmdb')
-    parser.add_argument('--resize_width', default=None, nargs='?', type=int)
-    parser.add_argument('--resize_height', default=None, nargs='?', type=int)
+    add_resize_arguments(parser)
+    add_frame_cache_arguments(parser)
     parser.add_argument('--num_processes', default=16, nargs='?', type=int)
+    add_shard_arguments(parser)
     args = parser.parse_args()
+    check_shard_arguments(parser, args)
+    output_lmdb = shard_output_path(args.output_lmdb, args.shard_index,
+                                    args.num_shards)
 
-    # TODO(achald): Allow specifying either one, and resize the other based on
-    # aspect ratio.
-    if (args.resize_width is None) != (args.resize_height is None):
-        raise ValueError('Both resize_width and resize_height must be '
-                         'specified if either is specified.')
+    resize_arguments = resize_arguments_from_args(args)
+    resize_arguments['frame_cache'] = frame_cache_from_args(args)
     map_size = int(500e9)
 
     batch_size = 5000
@@ -76,31 +80,38 @@ def main():
         frame_path: parse_frame_path(frame_path)
         for frame_path in glob.iglob('{}/*/*.png'.format(args.frames_root))
     }
+    frame_path_info = {
+        frame_path: info
+        for frame_path, info in frame_path_info.items()
+        if in_shard(info[0], args.shard_index, args.num_shards)
+    }
 
-    print 'Loaded frame paths.'
+    logging.info('Loaded frame paths.')
 
     num_paths = len(frame_path_info)
+    if num_paths == 0:
+        # Nothing to load; common when videos are hashed into many shards.
+        logging.info('No frames to write.')
+        lmdb.open(output_lmdb, map_size=map_size).close()
+        write_completion_marker(args.output_lmdb, args.shard_index,
+                                args.num_shards, num_frames=0)
+        return
     progress = tqdm(total=num_paths)
 
     mp_manager = mp.Manager()
     queue = mp_manager.Queue(maxsize=batch_size)
     # Spawn threads to load images.
     load_images_async(queue, args.num_processes, frame_path_info.keys(),
-                      args.resize_height, args.resize_width)
+                      **resize_arguments)
 
     num_stored = 0
     loaded_images = False
     while True:
         if loaded_images:
             break
-        with lmdb.open(args.output_lmdb, map_size=map_size).begin(
+        with lmdb.open(output_lmdb, map_size=map_size).begin(
                 write=True) as lmdb_transaction:
             for _ in range(batch_size):
-                num_stored += 1
-                if num_stored >= num_paths:
-                    loaded_images = True
-                    break
-
                 # Convert image arrays to image protocol buffers.
                 frame_path, image_array = queue.get()
                 image = image_array_to_proto(image_array)
@@ -108,10 +119,17 @@ def main():
                 video_name, frame_index = frame_path_info[frame_path]
                 video_frame_proto = create_video_frame(video_name, frame_index,
                                                        image)
-                frame_key = '{}-{}'.format(video_name, frame_index)
+                frame_key = '{}-{}'.format(video_name,
+                                           frame_index).encode('utf-8')
                 lmdb_transaction.put(frame_key,
                                      video_frame_proto.SerializeToString())
                 progress.update(1)
+                num_stored += 1
+                if num_stored >= num_paths:
+                    loaded_images = True
+                    break
+    write_completion_marker(args.output_lmdb, args.shard_index,
+                            args.num_shards, num_frames=num_paths)
 
 
 if __name__ == "__main__":
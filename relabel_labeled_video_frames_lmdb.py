@@ -0,0 +1,130 @@
+"""Recompute the labels of a LabeledVideoFrame LMDB from new annotations.
+
+Labels are computed from each frame's video_name and frame_index in the same
+way as frames_to_labeled_video_frames_lmdb.py, but the images are never decoded:
+the frame (including its image bytes) is copied through at the wire level and
+only the label fields are rewritten.
+
+Two output modes are supported:
+
+    --output_lmdb: Write a full copy of the input LMDB with the new labels.
+    --labels_lmdb: Write an LMDB with the same keys containing only the labels
+        (serialized as a LabeledVideoFrame without a frame). This avoids
+        rewriting any image pages; pass it as labels_lmdb to
+        util.video_frames_reader.VideoFramesReader to read frames from the
+        original LMDB with the new labels.
+"""
+
+import argparse
+import logging
+import sys
+
+from util.annotation import (FrameLabelIndex, load_annotations_json,
+                             load_label_ids)
+from util.lmdb_transform import transform_lmdb
+from util.video_frames_wire import encode_labels, parse_frame, replace_labels
+
+# Maps video name to FrameLabelIndex, built lazily in each worker.
+_label_indices = {}
+
+
+def compute_labels(value, annotations, label_ids, frames_per_second,
+                   frame_step):
+    """Compute serialized labels for a serialized LabeledVideoFrame."""
+    frame = parse_frame(value)
+    if frame.video_name not in _label_indices:
+        file_annotations = annotations.get(frame.video_name, [])
+        if frames_per_second:
+            _label_indices[frame.video_name] = FrameLabelIndex(
+                file_annotations, frames_per_second=frames_per_second)
+        else:
+            _label_indices[frame.video_name] = FrameLabelIndex(
+                file_annotations, frame_step=frame_step)
+    # Frames are 1-indexed on disk; see frames_to_labeled_video_frames_lmdb.py.
+    labels = _label_indices[frame.video_name].labels(frame.frame_index - 1)
+    return encode_labels(labels, label_ids)
+
+
+def relabel_frame(key, value, *label_args):
+    return replace_labels(value, compute_labels(value, *label_args))
+
+
+def labels_only(key, value, *label_args):
+    return compute_labels(value, *label_args)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n')[0],
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('input_lmdb',
+                        help='LMDB containing LabeledVideoFrames as values.')
+    parser.add_argument('--annotations_json', required=True)
+    parser.add_argument('--class_mapping',
+                        required=True,
+                        help="""
+                        File containing lines of the form "<class_int_id>
+                        <class_name>". The class id are assumed to be
+                        0-indexed unless --one-indexed-labels is specified.""")
+    output_group = parser.add_mutually_exclusive_group(required=True)
+    output_group.add_argument('--output_lmdb',
+                              help='Output path for relabeled copy of input.')
+    output_group.add_argument('--labels_lmdb',
+                              help='Output path for labels-only LMDB.')
+    parser.add_argument('--frames_per_second',
+                        default=0,
+                        type=float,
+                        help='FPS that frames were extracted at.')
+    parser.add_argument('--frame_step',
+                        default=0,
+                        type=float,
+                        help="""Frame step that frames were extracted at.
+                        E.g., --frame_step=2 implies every other frame was
+                        extracted. Either frame_step or frames_per_second must
+                        be specified.""")
+    parser.add_argument('--one-indexed-labels',
+                        default=False,
+                        action='store_true',
+                        help="""If specified, the input label ids in the class
+                        mapping are assumed to be 1-indexed; the output label
+                        ids will be the input label id minus 1 so that they
+                        are zero-indexed.""")
+    parser.add_argument('--num_processes', default=8, type=int)
+    parser.add_argument('--range_size',
+                        default=5000,
+                        type=int,
+                        help='Number of records processed per task.')
+    args = parser.parse_args()
+
+    output_lmdb = args.output_lmdb or args.labels_lmdb
+    logging_filepath = output_lmdb + '.log'
+    log_formatter = logging.Formatter('%(asctime)s.%(msecs).03d: %(message)s',
+                                      datefmt='%H:%M:%S')
+
+    file_handler = logging.FileHandler(logging_filepath)
+    file_handler.setFormatter(log_formatter)
+    logging.getLogger().addHandler(file_handler)
+    logging.getLogger().setLevel(logging.INFO)
+
+    logging.info('Writing log file to %s', logging_filepath)
+    logging.info('Command line arguments: %s', sys.argv)
+    logging.info('Parsed arguments: %s', args)
+
+    assert (args.frames_per_second == 0) != (args.frame_step == 0), (
+        "Exactly one of --frames_per_second or --frame_step "
+        "must be specified.")
+
+    annotations = dict(load_annotations_json(args.annotations_json))
+    label_ids = load_label_ids(args.class_mapping, args.one_indexed_labels)
+    transform = relabel_frame if args.output_lmdb else labels_only
+    transform_lmdb(args.input_lmdb,
+                   output_lmdb,
+                   transform,
+                   transform_args=(annotations, label_ids,
+                                   args.frames_per_second, args.frame_step),
+                   num_processes=args.num_processes,
+                   range_size=args.range_size)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""Resize the images in a VideoFrame or LabeledVideoFrame LMDB.
+
+Reads an LMDB created by frames_to_video_frames_proto_lmdb.py or
+frames_to_labeled_video_frames_lmdb.py and writes one new LMDB per requested
+size, with the same keys and with every other field (video name, frame index,
+labels) copied through unchanged. Useful for producing a smaller copy of an
+LMDB after the source frames have been deleted.
+
+Images are stored as (channels, height, width) BGR arrays (see
+util/video_frames.proto), and are resized in that layout: each worker resizes
+all same-sized images in its range of keys together with numpy (see
+frame_loader_util.resize_image_batch).
+"""
+
+import argparse
+import collections
+import logging
+import sys
+
+import numpy as np
+
+from frame_loader_util import resize_image_batch
+from util.lmdb_transform import transform_lmdb
+from util.video_frames_wire import encode_image, parse_frame, replace_image
+
+
+def resize_frames(keys, values, sizes, labeled, resample):
+    """Resize the images in a batch of serialized frames to each size.
+
+    Args:
+        keys (list of bytes)
+        values (list of buffers): Serialized (Labeled)VideoFrames.
+        sizes (list of (width, height) tuples)
+        labeled (bool): Whether values are LabeledVideoFrames.
+        resample (str): See frame_loader_util.resize_image_batch.
+
+    Returns:
+        outputs (list of tuples): For each input, a tuple with one serialized
+            frame per size.
+    """
+    # Group frames by image shape so that each group is resized at once.
+    shape_groups = collections.defaultdict(list)
+    for i, value in enumerate(values):
+        image = parse_frame(value, labeled).image
+        if image is None:
+            raise ValueError('Frame %s has no image.' % keys[i])
+        shape = (image.channels, image.height, image.width)
+        shape_groups[shape].append((i, image))
+
+    outputs = [[None] * len(sizes) for _ in values]
+    for shape, group in shape_groups.items():
+        images = np.empty((len(group), ) + shape, dtype=np.uint8)
+        for j, (i, image) in enumerate(group):
+            images[j] = np.frombuffer(
+                values[i], dtype=np.uint8,
+                count=image.data_end - image.data_start,
+                offset=image.data_start).reshape(shape)
+        for size_index, (width, height) in enumerate(sizes):
+            resized = resize_image_batch(images, height, width, resample)
+            for j, (i, _) in enumerate(group):
+                image_bytes = encode_image(shape[0], height, width,
+                                           resized[j].tobytes())
+                outputs[i][size_index] = replace_image(values[i], image_bytes,
+                                                       labeled)
+    return [tuple(output) for output in outputs]
+
+
+def parse_size(size):
+    """Parse a "<width>x<height>" string.
+
+    >>> parse_size('320x240')
+    (320, 240)
+    """
+    width, height = size.lower().split('x')
+    return int(width), int(height)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n')[0],
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('input_lmdb')
+    parser.add_argument('--sizes',
+                        nargs='+',
+                        required=True,
+                        help='Output sizes, of the form <width>x<height>.')
+    parser.add_argument('--output_lmdbs',
+                        nargs='+',
+                        required=True,
+                        help='One output LMDB path per size.')
+    parser.add_argument('--video_frames',
+                        action='store_true',
+                        help="""Input contains VideoFrames instead of
+                        LabeledVideoFrames.""")
+    parser.add_argument('--resample',
+                        choices=['bilinear', 'nearest'],
+                        default='bilinear')
+    parser.add_argument('--num_processes', default=8, type=int)
+    parser.add_argument('--range_size',
+                        default=1000,
+                        type=int,
+                        help='Number of records processed per task.')
+    args = parser.parse_args()
+
+    if len(args.sizes) != len(args.output_lmdbs):
+        raise ValueError('Must specify one output LMDB per size.')
+    sizes = [parse_size(size) for size in args.sizes]
+
+    logging_filepath = args.output_lmdbs[0] + '.log'
+    log_formatter = logging.Formatter('%(asctime)s.%(msecs).03d: %(message)s',
+                                      datefmt='%H:%M:%S')
+
+    file_handler = logging.FileHandler(logging_filepath)
+    file_handler.setFormatter(log_formatter)
+    logging.getLogger().addHandler(file_handler)
+    logging.getLogger().setLevel(logging.INFO)
+
+    logging.info('Writing log file to %s', logging_filepath)
+    logging.info('Command line arguments: %s', sys.argv)
+    logging.info('Parsed arguments: %s', args)
+
+    transform_lmdb(args.input_lmdb,
+                   args.output_lmdbs,
+                   resize_frames,
+                   transform_args=(sizes, not args.video_frames,
+                                   args.resample),
+                   num_processes=args.num_processes,
+                   range_size=args.range_size,
+                   batched=True)
+
+
+if __name__ == "__main__":
+    main()
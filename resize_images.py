@@ -12,61 +12,46 @@ which in turn contain frames for the video. For example:
 The only assumption is that frames are named of the form "frame[0-9]+.png".
 
 Outputs a directory with the same structure as the input directory, but with
-resized frames.
+resized frames. With --sizes, frames are resized to several sizes at once,
+and each size is written to a subdirectory of the output directory.
 """
 
 import argparse
+import collections
 import glob
 import logging
 import multiprocessing as mp
 import os
-import re
 from os import path
 
-import numpy as np
-from PIL import Image
 from tqdm import tqdm
 
+from frame_loader_util import (add_resize_arguments, load_image_sizes,
+                               parse_resize_spec, resize_arguments_from_args)
+from util.sharding import (add_shard_arguments, check_shard_arguments,
+                           in_shard, write_completion_marker)
 
-def resize_image(image_path, resize_height, resize_width):
-    """Load an image in video_frames.Image format.
 
-    Args:
-        image_path (str): Path to an image.
-        resize_height (int): Height to resize an image to.
-        resize_width (int): Width to resize an image to.
-
-    Returns:
-        image (PIL Image)
-    """
-    image = Image.open(image_path)
-    image = image.resize((resize_width, resize_height))
-    return image
-
-
-def resize_image_async_helper(args):
-    """
-    Resize an image as specified by args and stores it and its path in the
-    queue.
+def resize_and_save(args):
+    """Resize an image to one or more sizes and save each to its output path.
 
-    The queue will be filled with (path, image) tuples.
+    The image is decoded once for all sizes. Each output is written to a
+    hidden temporary file in its output directory and renamed, so that an
+    interrupted job never leaves a partially written frame that would be
+    skipped when resuming.
 
     Args:
-        args (tuple): Tuple of (queue, args for load_image)
+        args (tuple): (frame_path, outputs), where outputs is a list of
+            (resize_arguments, output_path) tuples, and resize_arguments is a
+            dict of arguments to frame_loader_util.resize_geometry.
     """
-    queue = args[0]
-    frame_path = args[1]
-    image = resize_image(*args[1:])
-    queue.put((args[1], image))  # Will wait if queue is full.
-
-
-def resize_images_async(queue, num_processes, frame_paths, resize_height,
-                        resize_width):
-    """Loads images by calling load_image_datum in parallel."""
-    job_arguments = [(queue, frame_path, resize_height, resize_width)
-                     for frame_path in frame_paths]
-    pool = mp.Pool(num_processes)
-    return pool.map_async(resize_image_async_helper, job_arguments)
+    frame_path, outputs = args
+    images = load_image_sizes(frame_path, [x[0] for x in outputs])
+    for image, (_, output_path) in zip(images, outputs):
+        output_dir, output_filename = path.split(output_path)
+        temporary_path = path.join(output_dir, '.' + output_filename)
+        image.save(temporary_path)
+        os.rename(temporary_path, output_path)
 
 
 def main():
@@ -75,61 +60,88 @@ def main():
         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument('frames_root')
     parser.add_argument('output_dir')
-    parser.add_argument('--resize_width', required=True, type=int)
-    parser.add_argument('--resize_height', required=True, type=int)
+    add_resize_arguments(parser)
+    parser.add_argument('--sizes',
+                        nargs='*',
+                        help="""Write several sizes from one decode of each
+                        frame, to <output_dir>/<size>/. Each size is
+                        specified as in
+                        frame_loader_util.parse_resize_spec, e.g. 320x240,
+                        s256 (shorter side 256), l320 (longer side 320), or
+                        s256c224x224 (shorter side 256, center crop 224x224).
+                        Overrides the other resize flags.""")
     parser.add_argument('--num_processes', default=16, nargs='?', type=int)
-    parser.add_argument('--batch_write_size', default=100, nargs='?', type=int)
+    parser.add_argument('--batch_write_size',
+                        default=100,
+                        nargs='?',
+                        type=int,
+                        help="""Number of images each worker resizes and
+                        saves per task.""")
+    add_shard_arguments(parser)
     args = parser.parse_args()
+    check_shard_arguments(parser, args)
 
     logging.getLogger().setLevel(logging.INFO)
     logging.basicConfig(format='%(asctime)s.%(msecs).03d: %(message)s',
                         datefmt='%H:%M:%S')
 
-    batch_size = 5000
-
-    def output_file(frame_path):
+    if args.sizes:
+        # List of (resize_arguments, output root)
+        sizes = [(parse_resize_spec(spec), path.join(args.output_dir, spec))
+                 for spec in args.sizes]
+    else:
+        resize_arguments = resize_arguments_from_args(args)
+        if not any(resize_arguments.values()):
+            parser.error('No resize size specified.')
+        sizes = [(resize_arguments, args.output_dir)]
+
+    logging.info('Globbing images')
+    video_frames = collections.defaultdict(list)
+    for frame_path in glob.iglob('{}/*/*.png'.format(args.frames_root)):
         dirpath, filename = path.split(frame_path)
-        dirname = path.split(dirpath)[1]
-        return path.join(args.output_dir, dirname, filename)
-
-    image_paths = glob.iglob('{}/*/*.png'.format(args.frames_root))
-    logging.info('Globbing images, filtering resized images.')
-    image_paths = [image
-                   for image in tqdm(image_paths)
-                   if not path.isfile(output_file(image))]
-
-    logging.info('Resizing images')
-    progress = tqdm(total=len(image_paths))
-    mp_manager = mp.Manager()
-    queue = mp_manager.Queue(maxsize=batch_size)
-    # Spawn threads to load images.
-    resize_images_async(queue, args.num_processes, image_paths,
-                        args.resize_height, args.resize_width)
-
-    num_resized = 0
-    loaded_images = False
-    while not loaded_images:
-        frame_path, resized_image = queue.get()
-        output_path = output_file(frame_path)
-        output_dir = path.split(output_path)[0]
-
-        if path.isfile(output_path):
-            # This shouldn't happen since we've filtered for images that have a
-            # resized copy output, but it may have been created after we
-            # checked.
-            logging.info('Computed %s already, skipping', output_path)
-            continue
-
-        if not path.isdir(output_dir):
-            os.makedirs(output_dir)
-
-        resized_image.save(output_path)
-
-        num_resized += 1
-        progress.update(1)
-        if num_resized == len(image_paths):
-            loaded_images = True
-            break
+        video_name = path.split(dirpath)[1]
+        if in_shard(video_name, args.shard_index, args.num_shards):
+            video_frames[video_name].append(frame_path)
+
+    # Create output directories up front, and skip frames that have already
+    # been resized with one listdir per video and size.
+    logging.info('Filtering resized images.')
+    tasks = []
+    for video_name, frame_paths in tqdm(sorted(video_frames.items())):
+        # List of (resize_arguments, output directory, existing filenames)
+        video_outputs = []
+        for resize_arguments, output_root in sizes:
+            video_output_dir = path.join(output_root, video_name)
+            if path.isdir(video_output_dir):
+                existing = set(os.listdir(video_output_dir))
+            else:
+                os.makedirs(video_output_dir)
+                existing = set()
+            video_outputs.append((resize_arguments, video_output_dir,
+                                  existing))
+        for frame_path in sorted(frame_paths):
+            filename = path.basename(frame_path)
+            outputs = [(resize_arguments, path.join(video_output_dir,
+                                                    filename))
+                       for resize_arguments, video_output_dir, existing
+                       in video_outputs if filename not in existing]
+            if outputs:
+                tasks.append((frame_path, outputs))
+
+    logging.info('Resizing %s images', len(tasks))
+    pool = mp.Pool(args.num_processes)
+    for _ in tqdm(pool.imap_unordered(resize_and_save,
+                                      tasks,
+                                      chunksize=args.batch_write_size),
+                  total=len(tasks)):
+        pass
+    pool.close()
+    pool.join()
+    write_completion_marker(args.output_dir, args.shard_index,
+                            args.num_shards,
+                            num_videos=len(video_frames),
+                            num_frames_resized=len(tasks))
+
 
 if __name__ == "__main__":
     main()
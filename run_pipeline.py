@@ -0,0 +1,404 @@
+"""Dump, resize and label videos into an LMDB in one streaming pipeline.
+
+Runs the stages of dump_frames.py, resize_images.py and
+frames_to_labeled_video_frames_lmdb.py concurrently, connected by bounded
+queues:
+
+    dump (processes) -> load and resize (processes) -> label and write (main)
+
+Dump workers extract the frames of one video at a time with
+dump_frames.dump_frames, and queue each frame. Load workers decode and resize
+frames with frame_loader_util.load_image. The main process labels each frame
+and writes LabeledVideoFrames as in frames_to_labeled_video_frames_lmdb.py.
+When every frame of a video has been written, its dumped frames are deleted
+unless materialize_frames is set, so only the videos in flight are kept on
+disk. Because the queues are bounded, a slow stage stalls the stages before
+it instead of buffering their output.
+
+All options are read from one JSON config file, for example:
+
+    {
+        "video_list": "videos.txt",
+        "frames_dir": "/scratch/frames",
+        "frames_per_second": 10,
+        "annotations_json": "annotations.json",
+        "class_mapping": "class_mapping.txt",
+        "output_lmdb": "frames.lmdb",
+        "resize": {"shorter_side": 256},
+        "stages": {
+            "dump": {"num_workers": 4, "queue_size": 2000},
+            "load": {"num_workers": 16, "queue_size": 2000},
+            "write": {"batch_size": 1000}
+        }
+    }
+
+See DEFAULT_CONFIG for the remaining options. Relative paths are relative to
+the config file.
+"""
+
+import argparse
+import copy
+import json
+import logging
+import multiprocessing as mp
+import os
+import queue
+import shutil
+import sys
+import threading
+
+import lmdb
+from PIL import Image
+from tqdm import tqdm
+
+from dump_frames import dump_frames
+from frame_loader_util import array_to_pil, load_image, parse_frame_path
+from frames_to_labeled_video_frames_lmdb import create_labeled_frame
+from frames_to_video_frames_proto_lmdb import image_array_to_proto
+from util.annotation import (FrameLabelIndex, load_annotations_json,
+                             load_label_ids)
+from util.frame_cache import FrameCache
+from util.lmdb_transform import write_records
+from util.log import setup_logging
+
+DEFAULT_CONFIG = {
+    # Required: file containing new-line separated paths to videos.
+    'video_list': None,
+    # Required: directory to dump frames to.
+    'frames_dir': None,
+    # Number of frames to dump per second. If 0, dumps all frames.
+    'frames_per_second': 0,
+    # Required: annotations and class mapping, as in
+    # frames_to_labeled_video_frames_lmdb.py.
+    'annotations_json': None,
+    'class_mapping': None,
+    'one_indexed_labels': False,
+    # Required: output LMDB.
+    'output_lmdb': None,
+    # Optional LMDB to also write frames without images to.
+    'output_without_images_lmdb': None,
+    # Arguments to frame_loader_util.resize_geometry, e.g. resize_height,
+    # resize_width, shorter_side, crop_width and crop_height.
+    'resize': {},
+    # If true, keep the dumped frames in frames_dir.
+    'materialize_frames': False,
+    # If set, also save resized frames to this directory, in the same layout
+    # as frames_dir.
+    'resized_frames_dir': None,
+    # If set, cache decoded and resized frames here (see
+    # util/frame_cache.py), so that rebuilds from the same frames skip
+    # decoding. Only useful with materialize_frames, since frames that are
+    # dumped again have new modification times.
+    'frame_cache_dir': None,
+    'frame_cache_max_gb': 100,
+    'map_size': int(1e9),
+    'stages': {
+        # queue_size is the maximum number of frames queued for the next
+        # stage.
+        'dump': {'num_workers': 4, 'queue_size': 2000},
+        'load': {'num_workers': 16, 'queue_size': 2000},
+        'write': {'batch_size': 1000},
+    },
+}
+
+PATH_KEYS = ('video_list', 'frames_dir', 'annotations_json', 'class_mapping',
+             'output_lmdb', 'output_without_images_lmdb',
+             'resized_frames_dir', 'frame_cache_dir')
+
+# How often to check that load workers are alive while waiting for images.
+WORKER_CHECK_SECONDS = 10
+
+REQUIRED_KEYS = ('video_list', 'frames_dir', 'annotations_json',
+                 'class_mapping', 'output_lmdb')
+
+
+def load_config(config_path):
+    """Load a pipeline config, filling in defaults.
+
+    Raises:
+        ValueError: If the config has unknown or missing keys.
+    """
+    with open(config_path) as f:
+        user_config = json.load(f)
+    config = copy.deepcopy(DEFAULT_CONFIG)
+    for key, value in user_config.items():
+        if key not in config:
+            raise ValueError('Unknown config key: %s' % key)
+        if key == 'stages':
+            for stage, stage_config in value.items():
+                if stage not in config['stages']:
+                    raise ValueError('Unknown stage: %s' % stage)
+                config['stages'][stage].update(stage_config)
+        else:
+            config[key] = value
+    missing = [key for key in REQUIRED_KEYS if config[key] is None]
+    if missing:
+        raise ValueError('Missing config keys: %s' % ', '.join(missing))
+    config_dir = os.path.dirname(os.path.abspath(config_path))
+    for key in PATH_KEYS:
+        if config[key] is not None:
+            config[key] = os.path.join(config_dir, config[key])
+    return config
+
+
+def video_output_name(video_path):
+    return os.path.splitext(os.path.basename(video_path))[0]
+
+
+def dump_worker(video_queue, frame_queue, config, logging_path):
+    """Dump frames for each video in video_queue, and queue each frame.
+
+    Frames are queued as (video_name, frame_index, frame_path, num_frames)
+    tuples, where num_frames is the number of frames dumped for the video.
+    """
+    frames_per_second = config['frames_per_second'] or None
+    while True:
+        video_path = video_queue.get()
+        if video_path is None:
+            break
+        video_name = video_output_name(video_path)
+        output_directory = os.path.join(config['frames_dir'], video_name)
+        if not dump_frames(video_path, output_directory, frames_per_second,
+                           logging_path):
+            # Don't write the frames of a partially dumped video.
+            logging.error('Skipping %s, as dumping its frames failed.',
+                          video_path)
+            if (not config['materialize_frames'] and
+                    os.path.isdir(output_directory)):
+                shutil.rmtree(output_directory)
+            continue
+        if not os.path.isdir(output_directory):
+            continue
+        frames = []
+        for filename in os.listdir(output_directory):
+            frame_path = os.path.join(output_directory, filename)
+            frame_info = parse_frame_path(frame_path)
+            if frame_info is not None:
+                frames.append((frame_info[1], frame_path))
+        for frame_index, frame_path in sorted(frames):
+            frame_queue.put((video_name, frame_index, frame_path,
+                             len(frames)))
+
+
+def save_resized_frame(image_array, output_path):
+    """Save a (channels, height, width) BGR array as an image.
+
+    The image is written to a temporary file and renamed, so that an
+    interrupted run never leaves a truncated image at output_path.
+    """
+    extension = os.path.splitext(output_path)[1].lower()
+    temporary_path = '{}.{}.tmp'.format(output_path, os.getpid())
+    array_to_pil(image_array).save(
+        temporary_path, format=Image.registered_extensions()[extension])
+    os.rename(temporary_path, output_path)
+
+
+def load_worker(frame_queue, image_queue, config):
+    """Load and resize frames from frame_queue, and queue the image arrays.
+
+    Images are queued as (video_name, frame_index, image_array, num_frames)
+    tuples. If a frame cannot be loaded, the error is logged and image_array
+    is None. A None in frame_queue stops the worker, which then queues None;
+    None is also queued if the worker fails for any other reason.
+    """
+    resize_arguments = config['resize']
+    resized_frames_dir = config['resized_frames_dir']
+    frame_cache = None
+    if config['frame_cache_dir'] is not None:
+        frame_cache = FrameCache(
+            config['frame_cache_dir'],
+            max_bytes=int(config['frame_cache_max_gb'] * 2**30))
+    try:
+        while True:
+            task = frame_queue.get()
+            if task is None:
+                break
+            video_name, frame_index, frame_path, num_frames = task
+            try:
+                image_array = load_image(frame_path, frame_cache=frame_cache,
+                                         **resize_arguments)
+                if resized_frames_dir is not None:
+                    save_resized_frame(
+                        image_array,
+                        os.path.join(resized_frames_dir, video_name,
+                                     os.path.basename(frame_path)))
+            except Exception:
+                logging.exception('Failed to load %s', frame_path)
+                image_array = None
+            image_queue.put((video_name, frame_index, image_array,
+                             num_frames))
+    finally:
+        image_queue.put(None)
+
+
+def stop_load_workers(dump_processes, frame_queue, num_load_workers):
+    """Wait for dump workers to finish, then tell load workers to stop."""
+    for process in dump_processes:
+        process.join()
+    for _ in range(num_load_workers):
+        frame_queue.put(None)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n')[0],
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('config', help='Path to JSON config file.')
+    args = parser.parse_args()
+
+    config = load_config(args.config)
+    stages = config['stages']
+
+    logging_path = config['output_lmdb'] + '.log'
+    setup_logging(logging_path)
+    logging.info('Command line arguments: %s', sys.argv)
+    logging.info('Config: %s', json.dumps(config, indent=2, sort_keys=True))
+
+    with open(config['video_list']) as f:
+        video_paths = [line.strip() for line in f if line.strip()]
+    video_names = [video_output_name(x) for x in video_paths]
+    if not os.path.isdir(config['frames_dir']):
+        os.makedirs(config['frames_dir'])
+    if config['resized_frames_dir'] is not None:
+        for video_name in video_names:
+            video_output_dir = os.path.join(config['resized_frames_dir'],
+                                            video_name)
+            if not os.path.isdir(video_output_dir):
+                os.makedirs(video_output_dir)
+
+    annotations = load_annotations_json(config['annotations_json'])
+    label_ids = load_label_ids(config['class_mapping'],
+                               config['one_indexed_labels'])
+
+    video_queue = mp.Queue()
+    for video_path in video_paths:
+        video_queue.put(video_path)
+    frame_queue = mp.Queue(maxsize=stages['dump']['queue_size'])
+    image_queue = mp.Queue(maxsize=stages['load']['queue_size'])
+
+    num_dump_workers = stages['dump']['num_workers']
+    num_load_workers = stages['load']['num_workers']
+    for _ in range(num_dump_workers):
+        video_queue.put(None)
+    dump_processes = [
+        mp.Process(target=dump_worker,
+                   args=(video_queue, frame_queue, config, logging_path))
+        for _ in range(num_dump_workers)
+    ]
+    load_processes = [
+        mp.Process(target=load_worker,
+                   args=(frame_queue, image_queue, config))
+        for _ in range(num_load_workers)
+    ]
+    for process in dump_processes + load_processes:
+        process.daemon = True
+        process.start()
+    stopper = threading.Thread(target=stop_load_workers,
+                               args=(dump_processes, frame_queue,
+                                     num_load_workers))
+    stopper.daemon = True
+    stopper.start()
+
+    environment = lmdb.open(config['output_lmdb'],
+                            map_size=config['map_size'])
+    imageless_environment = None
+    if config['output_without_images_lmdb'] is not None:
+        imageless_environment = lmdb.open(
+            config['output_without_images_lmdb'],
+            map_size=config['map_size'])
+
+    # Maps video name to FrameLabelIndex, for videos with frames in flight.
+    label_indices = {}
+    # Maps video name to number of frames processed (written, or skipped as
+    # they failed to load).
+    num_processed = {}
+    num_failed = 0
+    records = []
+    imageless_records = []
+    # Videos whose frames are all written once records are flushed.
+    completed_videos = []
+
+    def flush():
+        write_records(environment, sorted(records), append=False)
+        if imageless_environment is not None:
+            write_records(imageless_environment, sorted(imageless_records),
+                          append=False)
+        del records[:]
+        del imageless_records[:]
+        for video_name in completed_videos:
+            if not config['materialize_frames']:
+                shutil.rmtree(os.path.join(config['frames_dir'], video_name))
+        del completed_videos[:]
+
+    progress = tqdm()
+    num_stopped = 0
+    try:
+        while num_stopped < num_load_workers:
+            try:
+                item = image_queue.get(timeout=WORKER_CHECK_SECONDS)
+            except queue.Empty:
+                if not any(process.is_alive() for process in load_processes):
+                    logging.error('Load workers exited without finishing.')
+                    break
+                continue
+            if item is None:
+                num_stopped += 1
+                continue
+            video_name, frame_index, image_array, num_frames = item
+            if video_name not in label_indices:
+                if config['frames_per_second']:
+                    label_indices[video_name] = FrameLabelIndex(
+                        annotations.get(video_name, []),
+                        frames_per_second=config['frames_per_second'])
+                else:
+                    # All frames were dumped.
+                    label_indices[video_name] = FrameLabelIndex(
+                        annotations.get(video_name, []), frame_step=1)
+                num_processed[video_name] = 0
+            # Frames that failed to load are skipped, but still counted so
+            # that the video is completed.
+            if image_array is None:
+                num_failed += 1
+            else:
+                # Frames are 1-indexed on disk.
+                labels = label_indices[video_name].labels(frame_index - 1)
+                video_frame_proto = create_labeled_frame(
+                    video_name, frame_index,
+                    image_array_to_proto(image_array), labels, label_ids)
+                frame_key = '{}-{}'.format(video_name,
+                                           frame_index).encode('utf-8')
+                records.append(
+                    (frame_key, video_frame_proto.SerializeToString()))
+                if imageless_environment is not None:
+                    video_frame_proto.frame.image.data = b''
+                    imageless_records.append(
+                        (frame_key, video_frame_proto.SerializeToString()))
+
+            num_processed[video_name] += 1
+            if num_processed[video_name] == num_frames:
+                del label_indices[video_name]
+                completed_videos.append(video_name)
+            if len(records) >= stages['write']['batch_size']:
+                flush()
+            progress.update(1)
+        flush()
+    except KeyboardInterrupt:
+        logging.info('Parent received control-c, exiting.')
+        for process in dump_processes + load_processes:
+            process.terminate()
+        raise
+    progress.close()
+
+    missing_videos = sorted(set(video_names) - set(num_processed))
+    if missing_videos:
+        logging.error('No frames were written for %s videos:\n%s',
+                      len(missing_videos), '\n'.join(missing_videos))
+    if num_failed:
+        logging.error('Skipped %s frames that failed to load.', num_failed)
+    logging.info('Wrote %s frames from %s videos to %s',
+                 sum(num_processed.values()) - num_failed, len(num_processed),
+                 config['output_lmdb'])
+
+
+if __name__ == '__main__':
+    main()
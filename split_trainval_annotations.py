@@ -1,35 +1,139 @@
-# Split trainval annotations json into train annotations and val annotations.
+"""Split an annotations json into multiple annotation files by video.
+
+Annotations are read and written in a single streaming pass, so neither the
+input nor the outputs are held in memory. Splits can be given as lists of
+videos:
+
+    --train_vids_list train.txt --train_annotations_out train.json
+    --val_vids_list val.txt --val_annotations_out val.json
+    --split test.txt test.json
+
+or videos can be deterministically assigned to one of K folds by a hash of the
+filename:
+
+    --num_folds 5 --fold_output_pattern 'fold{}.json'
+
+These can be combined; an annotation is written to every split that contains
+its video.
+"""
 
 import argparse
+import hashlib
 import json
+import logging
 
-if __name__ == "__main__":
-    # Use first line of file docstring as description.
+from util.annotation import iter_annotations_json
+
+
+def fold_for_filename(filename, num_folds):
+    """Deterministically assign filename to a fold in [0, num_folds).
+
+    This is independent of util.sharding.shard_for_name, so that a sharded
+    job over a subset of folds still spreads its videos across shards.
+
+    >>> fold_for_filename('video_validation_0000051', 5)
+    1
+    """
+    digest = hashlib.md5(filename.encode('utf-8')).hexdigest()
+    return int(digest, 16) % num_folds
+
+
+class JsonListWriter(object):
+    """Write a JSON list to a file one element at a time."""
+
+    def __init__(self, path):
+        self.path = path
+        self.num_written = 0
+        self._file = open(path, 'w')
+        self._file.write('[')
+
+    def write(self, value):
+        if self.num_written:
+            self._file.write(', ')
+        json.dump(value, self._file)
+        self.num_written += 1
+
+    def close(self):
+        self._file.write(']')
+        self._file.close()
+
+
+def load_vids_list(path):
+    with open(path) as f:
+        return set(line.strip() for line in f if line.strip())
+
+
+def main():
     parser = argparse.ArgumentParser(
-        description=__doc__.split('\n')[0] if __doc__ else '',
+        description=__doc__.split('\n')[0],
         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument('--trainval_annotations', required=True)
-    parser.add_argument('--train_vids_list', required=True)
-    parser.add_argument('--val_vids_list', required=True)
-    parser.add_argument('--train_annotations_out', required=True)
-    parser.add_argument('--val_annotations_out', required=True)
-
+    parser.add_argument('--train_vids_list')
+    parser.add_argument('--val_vids_list')
+    parser.add_argument('--train_annotations_out')
+    parser.add_argument('--val_annotations_out')
+    parser.add_argument('--split',
+                        nargs=2,
+                        action='append',
+                        default=[],
+                        metavar=('VIDS_LIST', 'ANNOTATIONS_OUT'),
+                        help="""Write annotations for videos in VIDS_LIST to
+                        ANNOTATIONS_OUT. May be specified multiple times.""")
+    parser.add_argument('--num_folds',
+                        type=int,
+                        default=0,
+                        help="""If positive, assign each video to one of this
+                        many folds by a hash of its filename.""")
+    parser.add_argument('--fold_output_pattern',
+                        default='fold{}.json',
+                        help="""Output path for each fold; {} is replaced by
+                        the fold index.""")
     args = parser.parse_args()
 
-    with open(args.train_vids_list) as f:
-        train_vids = set([line.strip() for line in f.readlines()])
-    with open(args.val_vids_list) as f:
-        val_vids = set([line.strip() for line in f.readlines()])
-    with open(args.trainval_annotations) as f:
-        trainval_annotations = json.load(f)
-
-    train_annotations = [annotation
-                         for annotation in trainval_annotations
-                         if annotation['filename'] in train_vids]
-    val_annotations = [annotation
-                       for annotation in trainval_annotations
-                       if annotation['filename'] in val_vids]
-    with open(args.train_annotations_out, 'wb') as train_out:
-        json.dump(train_annotations, train_out)
-    with open(args.val_annotations_out, 'wb') as val_out:
-        json.dump(val_annotations, val_out)
+    logging.getLogger().setLevel(logging.INFO)
+    logging.basicConfig(format='%(asctime)s.%(msecs).03d: %(message)s',
+                        datefmt='%H:%M:%S')
+
+    splits = list(args.split)
+    for vids_list, output in ((args.train_vids_list,
+                               args.train_annotations_out),
+                              (args.val_vids_list, args.val_annotations_out)):
+        if (vids_list is None) != (output is None):
+            parser.error('Each of --train_vids_list and --val_vids_list must '
+                         'be specified with its --*_annotations_out.')
+        if vids_list is not None:
+            splits.append((vids_list, output))
+    if not splits and args.num_folds <= 0:
+        parser.error('No splits specified.')
+
+    # List of (set of videos, writer).
+    list_splits = [(load_vids_list(vids_list), JsonListWriter(output))
+                   for vids_list, output in splits]
+    fold_writers = [
+        JsonListWriter(args.fold_output_pattern.format(fold))
+        for fold in range(max(args.num_folds, 0))
+    ]
+    # Cache fold assignments, since annotations of a video are usually
+    # adjacent.
+    folds = {}
+    num_annotations = 0
+    for annotation in iter_annotations_json(args.trainval_annotations):
+        num_annotations += 1
+        filename = annotation['filename']
+        for videos, writer in list_splits:
+            if filename in videos:
+                writer.write(annotation)
+        if fold_writers:
+            if filename not in folds:
+                folds[filename] = fold_for_filename(filename, args.num_folds)
+            fold_writers[folds[filename]].write(annotation)
+
+    logging.info('Read %s annotations.', num_annotations)
+    for writer in [writer for _, writer in list_splits] + fold_writers:
+        writer.close()
+        logging.info('Wrote %s annotations to %s', writer.num_written,
+                     writer.path)
+
+
+if __name__ == "__main__":
+    main()
@@ -11,28 +11,37 @@ Annotation = collections.namedtuple(
                    'end_seconds', 'frames_per_second', 'category'])
 
 
-def load_annotations_json(annotations_json_path, filter_category=None):
+def load_annotations_json(annotations_json_path, filter_category=None,
+                          use_cache=False):
     """Load annotations into a dictionary mapping filenames to annotations.
 
     Args:
         annotations_json_path (str): Path to JSON file containing annotations.
         filter_category (str): If specified, only annotations for that category
             are returned.
+        use_cache (bool): If True, load annotations through the .npz cache
+            next to the JSON file (see util.annotation_table), creating it if
+            it is missing or out of date.
 
     Returns:
         annotations (dict): Maps annotation file name to a list of Annotation
             objects.
     """
-    with open(annotations_json_path) as f:
-        annotations_list = json.load(f)
     annotations = collections.defaultdict(list)
-    # Extract annotations for category
-    for annotation in annotations_list:
-        annotation = Annotation(**{
-            fieldname: annotation[fieldname]
-            for fieldname in Annotation._fields
-        })
-        annotations[annotation.filename].append(annotation)
+    if use_cache:
+        from util.annotation_table import AnnotationTable
+        table = AnnotationTable.load(annotations_json_path)
+        if filter_category is not None:
+            table = table.filter_category(filter_category)
+        annotations.update(table.to_dict())
+    else:
+        # Extract annotations for category
+        for annotation in iter_annotations_json(annotations_json_path):
+            annotation = Annotation(**{
+                fieldname: annotation[fieldname]
+                for fieldname in Annotation._fields
+            })
+            annotations[annotation.filename].append(annotation)
     if filter_category is not None:
         annotations = filter_annotations_by_category(annotations,
                                                      filter_category)
@@ -42,6 +51,68 @@ def load_annotations_json(annotations_json_path, filter_category=None):
     return annotations
 
 
+def iter_annotations_json(annotations_json_path, chunk_size=1 << 20):
+    """Yield the annotation dicts in a JSON list one at a time.
+
+    Unlike json.load, this reads the file in chunks of chunk_size characters
+    and only keeps the current chunk (and the annotation being parsed) in
+    memory, so arbitrarily large annotation files can be processed.
+
+    Args:
+        annotations_json_path (str): Path to JSON file containing a list of
+            annotations.
+        chunk_size (int)
+
+    Yields:
+        annotation (dict)
+    """
+    decoder = json.JSONDecoder()
+    with open(annotations_json_path) as f:
+        buffer = ''
+        position = 0
+        # One of 'start' (expecting '['), 'first' (expecting an annotation or
+        # ']'), 'value' (expecting an annotation) or 'separator' (expecting
+        # ',' or ']').
+        state = 'start'
+        while True:
+            while position < len(buffer) and buffer[position] in ' \t\n\r':
+                position += 1
+            if position == len(buffer):
+                buffer, position = f.read(chunk_size), 0
+                if not buffer:
+                    raise ValueError('Unexpected end of %s.' %
+                                     annotations_json_path)
+                continue
+            character = buffer[position]
+            if state == 'start':
+                if character != '[':
+                    raise ValueError('%s does not contain a JSON list.' %
+                                     annotations_json_path)
+                position += 1
+                state = 'first'
+            elif character == ']' and state in ('first', 'separator'):
+                return
+            elif state == 'separator':
+                if character != ',':
+                    raise ValueError('Expected "," in %s, found "%s".' %
+                                     (annotations_json_path, character))
+                position += 1
+                state = 'value'
+            else:
+                try:
+                    annotation, position = decoder.raw_decode(buffer,
+                                                              position)
+                except ValueError:
+                    # The annotation may continue in the next chunk.
+                    chunk = f.read(chunk_size)
+                    if not chunk:
+                        raise
+                    buffer, position = buffer[position:] + chunk, 0
+                    continue
+                state = 'separator'
+                yield annotation
+
+
 def filter_annotations_by_category(annotations, category):
     """
     Return only annotations that belong to category.
@@ -97,6 +168,51 @@ def annotations_to_frame_labels(annotations, num_frames):
     return frame_groundtruth.astype(int)
 
 
+def annotations_to_frame_label_matrix(file_annotations, num_frames,
+                                      class_list):
+    """
+    Convert annotations for one file to a binary (frame, class) label matrix.
+
+    Equivalent to stacking annotations_to_frame_labels for each category in
+    class_list, but computed in one pass over the annotations: each annotation
+    adds +1 at its start frame and -1 after its end frame in its category's
+    column, and a cumulative sum over frames gives the number of annotations
+    covering each frame.
+
+    Args:
+        file_annotations (list of Annotation): Annotations for exactly one
+            file. Annotations with categories not in class_list are ignored.
+        num_frames (int)
+        class_list (list of str): Category for each column of the output.
+
+    Returns:
+        frame_labels (np.array, shape (num_frames, len(class_list))): uint8
+            matrix indicating whether each frame is in an annotation of each
+            category.
+
+    >>> SimpleAnnotation = collections.namedtuple(
+    ...         'SimpleAnnotation', ['start_frame', 'end_frame', 'category'])
+    >>> annotations_to_frame_label_matrix(
+    ...     [SimpleAnnotation(1, 2, 'b'), SimpleAnnotation(2, 3, 'a'),
+    ...      SimpleAnnotation(3, 4, 'c')], 4, ['a', 'b']).tolist()
+    [[0, 0], [0, 1], [1, 1], [1, 0]]
+    """
+    column = {category: i for i, category in enumerate(class_list)}
+    annotations = [annotation for annotation in file_annotations
+                   if annotation.category in column]
+    coverage = np.zeros((num_frames + 1, len(class_list)), dtype=np.int32)
+    if annotations:
+        starts = np.clip([int(x.start_frame) for x in annotations], 0,
+                         num_frames)
+        ends = np.clip([int(x.end_frame) + 1 for x in annotations], 0,
+                       num_frames)
+        valid = starts < ends
+        columns = np.array([column[x.category] for x in annotations])[valid]
+        np.add.at(coverage, (starts[valid], columns), 1)
+        np.add.at(coverage, (ends[valid], columns), -1)
+    return (np.cumsum(coverage[:-1], axis=0) > 0).astype(np.uint8)
+
+
 def collect_frame_labels(file_annotations, frame_index, frames_per_second=None,
                          frame_step=None):
     """Collect list of labels that apply to a particular frame in a file.
@@ -131,6 +247,126 @@ def collect_frame_labels(file_annotations, frame_index, frames_per_second=None,
                                annotation.end_frame)))
 
 
+class FrameLabelIndex(object):
+    """Precomputed index of the labels that apply to each frame of a file.
+
+    Equivalent to calling collect_frame_labels for each frame, but the
+    annotations are only scanned once, when the index is built. The sorted
+    annotation boundaries split time into regions (each boundary itself, and
+    the open intervals between consecutive boundaries) that have a constant
+    set of labels; a query is a binary search for its region.
+
+    >>> SimpleAnnotation = collections.namedtuple(
+    ...         'SimpleAnnotation', ['start_frame', 'end_frame',
+    ...                              'start_seconds', 'end_seconds',
+    ...                              'category'])
+    >>> annotations = [SimpleAnnotation(2, 6, 0.2, 0.6, 'b'),
+    ...                SimpleAnnotation(4, 9, 0.4, 0.9, 'a'),
+    ...                SimpleAnnotation(6, 6, 0.6, 0.6, 'c')]
+    >>> index = FrameLabelIndex(annotations, frame_step=2)
+    >>> [index.labels(i) for i in range(6)]
+    [[], ['b'], ['a', 'b'], ['a', 'b', 'c'], ['a'], []]
+    >>> all(index.labels(i) == collect_frame_labels(annotations, i,
+    ...                                             frame_step=2)
+    ...     for i in range(6))
+    True
+    >>> index = FrameLabelIndex(annotations, frames_per_second=10)
+    >>> all(index.labels(i) == collect_frame_labels(annotations, i,
+    ...                                             frames_per_second=10)
+    ...     for i in range(12))
+    True
+    >>> index.label_matrix(4, {'a': 0, 'b': 1, 'c': 2}).tolist()
+    [[0, 0, 0], [0, 0, 0], [0, 1, 0], [0, 1, 0]]
+    """
+
+    def __init__(self, file_annotations, frames_per_second=None,
+                 frame_step=None):
+        """
+        Args:
+            file_annotations (list of Annotation): Annotations for a
+                particular file.
+            frames_per_second, frame_step (int): As in collect_frame_labels.
+        """
+        assert (frames_per_second is None) != (frame_step is None), (
+            "Exactly one of frames_per_second or frame_step must be "
+            "specified.")
+        self.frames_per_second = frames_per_second
+        self.frame_step = frame_step
+        if frames_per_second is not None:
+            intervals = [(annotation.start_seconds, annotation.end_seconds,
+                          annotation.category)
+                         for annotation in file_annotations]
+        else:
+            intervals = [(annotation.start_frame, annotation.end_frame,
+                          annotation.category)
+                         for annotation in file_annotations]
+        intervals = [x for x in intervals if x[0] <= x[1]]
+        self.categories = sorted(set(x[2] for x in intervals))
+        self.boundaries = np.asarray(
+            sorted(set([x[0] for x in intervals] + [x[1] for x in intervals])),
+            dtype=np.float64)
+
+        # Region 2 * i + 1 is the point boundaries[i]; region 2 * i is the
+        # open interval between boundaries[i - 1] and boundaries[i].
+        num_regions = 2 * len(self.boundaries) + 1
+        category_ids = {category: i
+                        for i, category in enumerate(self.categories)}
+        coverage = np.zeros((num_regions + 1, len(self.categories)),
+                            dtype=np.int64)
+        if intervals:
+            starts = 2 * np.searchsorted(self.boundaries,
+                                         [x[0] for x in intervals]) + 1
+            ends = 2 * np.searchsorted(self.boundaries,
+                                       [x[1] for x in intervals]) + 2
+            columns = [category_ids[x[2]] for x in intervals]
+            np.add.at(coverage, (starts, columns), 1)
+            np.add.at(coverage, (ends, columns), -1)
+        # (num_regions, num_categories) boolean matrix.
+        self.region_categories = np.cumsum(coverage, axis=0)[:-1] > 0
+        self.region_labels = [
+            [self.categories[i] for i in np.flatnonzero(row)]
+            for row in self.region_categories
+        ]
+
+    def _query(self, frame_indices):
+        frame_indices = np.asarray(frame_indices, dtype=np.float64)
+        if self.frames_per_second is not None:
+            return frame_indices / self.frames_per_second
+        return frame_indices * self.frame_step
+
+    def _regions(self, queries):
+        positions = np.searchsorted(self.boundaries, queries)
+        if not len(self.boundaries):
+            return 2 * positions
+        on_boundary = self.boundaries[np.minimum(
+            positions, len(self.boundaries) - 1)] == queries
+        return 2 * positions + on_boundary
+
+    def labels(self, frame_index):
+        """Return sorted list of labels for a frame; see
+        collect_frame_labels."""
+        region = self._regions(self._query([frame_index]))[0]
+        return list(self.region_labels[region])
+
+    def label_matrix(self, num_frames, label_ids):
+        """Compute labels for frame indices 0 to num_frames - 1 at once.
+
+        Args:
+            num_frames (int)
+            label_ids (dict): Maps label name to column index.
+
+        Returns:
+            labels (np.array, shape (num_frames, len(label_ids))): uint8
+                matrix; labels[i, label_ids[label]] is 1 if label applies to
+                frame index i.
+        """
+        labels = np.zeros((num_frames, len(label_ids)), dtype=np.uint8)
+        regions = self._regions(self._query(np.arange(num_frames)))
+        columns = [label_ids[category] for category in self.categories]
+        labels[:, columns] = self.region_categories[regions]
+        return labels
+
+
 def load_label_ids(class_mapping_path, one_indexed_labels=False):
     """
     Args:
@@ -155,7 +391,7 @@ def load_label_ids(class_mapping_path, one_indexed_labels=False):
             label_ids[label] = int(label_id)
             if one_indexed_labels:
                 label_ids[label] -= 1
-    assert sorted(label_ids.values()) == range(len(label_ids)), (
+    assert sorted(label_ids.values()) == list(range(len(label_ids))), (
         'Label ids must be consecutive and start at 0.')
     return label_ids
 
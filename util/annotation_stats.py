@@ -1,10 +1,10 @@
 """Helpers for computing statistics on annotations."""
 from __future__ import division
 import collections
+import multiprocessing as mp
 
 import numpy as np
-from annotation import (Annotation, annotations_to_frame_labels,
-                        filter_annotations_by_category, in_annotation)
+from util.annotation import annotations_to_frame_label_matrix
 
 
 def get_durations(annotations, in_seconds=False):
@@ -19,15 +19,16 @@ def get_durations(annotations, in_seconds=False):
     Returns:
         durations (np.array): List of durations for all annotations.
     """
-    durations = []
-    for annotations in annotations.values():
-        if in_seconds:
-            durations.extend([annotation.end_seconds - annotation.start_seconds
-                              for annotation in annotations])
-        else:
-            durations.extend([annotation.end_frame - annotation.start_frame + 1
-                              for annotation in annotations])
-    return np.asarray(durations)
+    all_annotations = [annotation
+                       for file_annotations in annotations.values()
+                       for annotation in file_annotations]
+    if in_seconds:
+        starts = np.array([x.start_seconds for x in all_annotations])
+        ends = np.array([x.end_seconds for x in all_annotations])
+        return ends - starts
+    starts = np.array([x.start_frame for x in all_annotations])
+    ends = np.array([x.end_frame for x in all_annotations])
+    return ends - starts + 1
 
 
 def compute_min_background_duration(annotations):
@@ -57,15 +58,15 @@ def compute_min_background_duration(annotations):
     """
     min_background_duration = float('inf')
     for filename, annotations in annotations.items():
-        sorted_annotations = sorted(annotations,
-                                    key=lambda x: (x.start_frame, x.end_frame))
+        starts = np.array([x.start_frame for x in annotations])
+        ends = np.array([x.end_frame for x in annotations])
+        order = np.lexsort((ends, starts))
+        starts, ends = starts[order], ends[order]
         min_background_duration = min(min_background_duration,
-                                      sorted_annotations[0].start_frame)
-        for i in range(len(annotations) - 1):
-            background_duration = (sorted_annotations[i + 1].start_frame -
-                                   sorted_annotations[i].end_frame)
-            min_background_duration = min(min_background_duration,
-                                          background_duration)
+                                      starts[0].item())
+        if len(starts) > 1:
+            min_background_duration = min(
+                min_background_duration, (starts[1:] - ends[:-1]).min().item())
     return min_background_duration
 
 
@@ -81,44 +82,136 @@ def compute_duration_mean_std(annotations):
     return durations.mean(), durations.std()
 
 
-def compute_priors(training_annotations, class_list, frame_counts):
+def count_category_frames(file_annotations, num_frames, class_list):
+    """Count the frames of a file labeled with each category.
+
+    Returns:
+        counts (np.array, shape (len(class_list), ))
+    """
+    return annotations_to_frame_label_matrix(file_annotations, num_frames,
+                                             class_list).sum(axis=0)
+
+
+def _count_category_frames_star(args):
+    return count_category_frames(*args)
+
+
+def compute_priors(training_annotations, class_list, frame_counts,
+                   num_processes=None):
     """Compute P(category) prior for each category.
 
     Args:
         training_annotations (dict): Maps filenames to list of Annotation
             objects.
         class_list (list of strings)
-        frame_counts (dict): Maps filename to number of frames.
+        frame_counts (dict): Maps filename to number of frames. Files without
+            annotations of a category in class_list may be missing.
+        num_processes (int): If specified, files are processed in parallel
+            with a pool of this many processes.
 
     Returns:
         priors (np.array, shape (len(class_list), )): Prior for each category.
+
+    >>> SimpleAnnotation = collections.namedtuple(
+    ...         'SimpleAnnotation', ['start_frame', 'end_frame', 'category'])
+    >>> compute_priors({'1': [SimpleAnnotation(0, 1, 'a'),
+    ...                       SimpleAnnotation(1, 4, 'b')],
+    ...                 '2': [SimpleAnnotation(0, 4, 'a')]},
+    ...                ['a', 'b', 'c'], {'1': 5, '2': 5}).tolist()
+    [0.7, 0.4, 0.0]
+    >>> compute_priors({'1': [SimpleAnnotation(0, 1, 'a')],
+    ...                 '2': [SimpleAnnotation(0, 4, 'd')]},
+    ...                ['a', 'b'], {'1': 4}).tolist()
+    [0.5, 0.0]
     """
     num_total_frames = sum(frame_counts.values())
-    priors = np.zeros(len(class_list))
-    for i, category in enumerate(class_list):
-        category_annotations = filter_annotations_by_category(
-            training_annotations, category)
-        frame_label_sequences = [
-            annotations_to_frame_labels(file_annotations,
-                                        frame_counts[filename])
-            for filename, file_annotations in category_annotations.items()
-        ]
-        num_category_frames = sum([sequence.sum()
-                                   for sequence in frame_label_sequences])
-        priors[i] = num_category_frames / num_total_frames
-    return priors
-
-
-def compute_overlap_counts(annotations):
+    classes = set(class_list)
+    tasks = []
+    for filename, file_annotations in training_annotations.items():
+        file_annotations = [annotation for annotation in file_annotations
+                            if annotation.category in classes]
+        if file_annotations:
+            tasks.append((file_annotations, frame_counts[filename],
+                          class_list))
+    if num_processes:
+        pool = mp.Pool(num_processes)
+        counts = pool.map(_count_category_frames_star, tasks, chunksize=64)
+        pool.close()
+    else:
+        counts = [_count_category_frames_star(task) for task in tasks]
+    num_category_frames = np.zeros(len(class_list))
+    for file_counts in counts:
+        num_category_frames += file_counts
+    return num_category_frames / num_total_frames
+
+
+def compute_file_overlap_counts(file_annotations, count_frames=False):
+    """Count overlaps within one file; see compute_overlap_counts.
+
+    Sweeps over the sorted start and end frames of the annotations, keeping
+    track of the categories of the annotations that are active at each
+    boundary frame, instead of rescanning every annotation at every boundary.
+
+    Returns:
+        overlap_instance_counts (collections.Counter)
+        overlap_frame_counts (collections.Counter): Only returned if
+            count_frames is True.
+    """
+    starts = collections.defaultdict(list)
+    ends = collections.defaultdict(list)
+    for annotation in file_annotations:
+        # Annotations that end before they start are never active, but their
+        # boundaries are still considered.
+        if annotation.start_frame <= annotation.end_frame:
+            starts[annotation.start_frame].append(annotation.category)
+            ends[annotation.end_frame].append(annotation.category)
+    frames_to_consider = sorted(list(
+        set([annotation.start_frame for annotation in file_annotations] +
+            [annotation.end_frame for annotation in file_annotations])))
+
+    overlap_counts = collections.Counter()
+    frame_counts = collections.Counter()
+    # Maps category to number of active annotations with that category.
+    active = collections.Counter()
+    for i, frame in enumerate(frames_to_consider):
+        active.update(starts[frame])
+        category_set = frozenset(category
+                                 for category, count in active.items()
+                                 if count > 0)
+        overlap_counts[category_set] += 1
+        active.subtract(ends[frame])
+        if count_frames:
+            if category_set:
+                frame_counts[category_set] += 1
+            # Frames strictly between this boundary and the next one have the
+            # categories active after this boundary's annotations end.
+            if i + 1 < len(frames_to_consider):
+                num_between = frames_to_consider[i + 1] - frame - 1
+                category_set = frozenset(category
+                                         for category, count in active.items()
+                                         if count > 0)
+                if category_set and num_between > 0:
+                    frame_counts[category_set] += num_between
+    if count_frames:
+        return overlap_counts, frame_counts
+    return overlap_counts
+
+
+def compute_overlap_counts(annotations, count_frames=False):
     """Count how often each action overlap occurs.
 
     Args:
         annotations (dict): Maps filename to list of Annotation objects.
+        count_frames (bool): If True, also count the number of frames covered
+            by each set of categories. Frames are assumed to be integers.
 
     Returns:
-        overlap_instance_counts (collections.Counter): Maps a set of categories
+        overlap_instance_counts (dict): Maps a set of categories
             to the number of instances where they overlapped (an instance is
             defined by the annotations that make up the overlap).
+        overlap_frame_counts (dict): Maps a set of categories to the number of
+            frames where exactly those categories are annotated. Only returned
+            if count_frames is True.
 
 
     >>> SimpleAnnotation = collections.namedtuple(
@@ -128,21 +221,22 @@ def compute_overlap_counts(annotations):
     >>> assert overlaps[frozenset('a')] == 1
     >>> assert overlaps[frozenset('b')] == 1
     >>> assert overlaps[frozenset(['a', 'b'])] == 2
+    >>> _, frames = compute_overlap_counts(
+    ...     {'1': [SimpleAnnotation(0, 2, 'a'), SimpleAnnotation(1, 3, 'b'),
+    ...            SimpleAnnotation(8, 12, 'a')]}, count_frames=True)
+    >>> assert frames[frozenset('a')] == 6
+    >>> assert frames[frozenset('b')] == 1
+    >>> assert frames[frozenset(['a', 'b'])] == 2
     """
-    # Maps category set to set of unique instances.
-    overlap_instances = collections.defaultdict(list)
+    overlap_counts = collections.Counter()
+    frame_counts = collections.Counter()
     for filename, file_annotations in annotations.items():
-        frames_to_consider = sorted(list(
-            set([annotation.start_frame for annotation in file_annotations] +
-                [annotation.end_frame for annotation in file_annotations])))
-        for frame in frames_to_consider:
-            current_annotations = [annotation
-                                   for annotation in file_annotations
-                                   if in_annotation(annotation, frame)]
-            category_set = frozenset(x.category for x in current_annotations)
-            instance = set((x.category, x.start_frame, x.end_frame)
-                           for x in current_annotations)
-            overlap_instances[category_set].append(instance)
-    overlap_counts = {categories: len(instances)
-                      for categories, instances in overlap_instances.items()}
-    return overlap_counts
+        file_counts = compute_file_overlap_counts(file_annotations,
+                                                  count_frames)
+        if count_frames:
+            file_counts, file_frame_counts = file_counts
+            frame_counts.update(file_frame_counts)
+        overlap_counts.update(file_counts)
+    if count_frames:
+        return dict(overlap_counts), dict(frame_counts)
+    return dict(overlap_counts)
@@ -0,0 +1,246 @@
+"""Columnar storage for annotations, with an on-disk cache.
+
+load_annotations_json builds one Annotation namedtuple per row, which is slow
+and memory hungry for large annotation files, and has to reparse the JSON
+every time. AnnotationTable instead stores each field as a NumPy array:
+
+    - start_frame, end_frame, start_seconds, end_seconds, frames_per_second
+    - file_codes, category_codes: indices into the filenames and categories
+      arrays.
+
+Rows are sorted by file, and file_offsets[i]:file_offsets[i + 1] is the range
+of rows for filenames[i], so per-file access is a slice. Tables are cached
+next to the JSON file in a .npz file, which is rebuilt whenever the JSON
+file's modification time or size changes.
+
+    >>> table = AnnotationTable.from_annotations_list([
+    ...     {'filename': 'b', 'start_frame': 1, 'end_frame': 3,
+    ...      'start_seconds': 0.1, 'end_seconds': 0.3,
+    ...      'frames_per_second': 10, 'category': 'jump'},
+    ...     {'filename': 'a', 'start_frame': 2, 'end_frame': 4,
+    ...      'start_seconds': 0.2, 'end_seconds': 0.4,
+    ...      'frames_per_second': 10, 'category': 'run'},
+    ...     {'filename': 'b', 'start_frame': 5, 'end_frame': 9,
+    ...      'start_seconds': 0.5, 'end_seconds': 0.9,
+    ...      'frames_per_second': 10, 'category': 'run'}])
+    >>> len(table), table.file_list()
+    (3, ['a', 'b'])
+    >>> [x.start_frame for x in table.file_annotations('b')]
+    [1, 5]
+    >>> sorted(table.filter_category('run').to_dict().keys())
+    ['a', 'b']
+    >>> list(table.filter_category('jump').to_dict().keys())
+    ['b']
+
+Columns that mix ints and floats, or contain None, keep their Python values:
+
+    >>> table = AnnotationTable.from_annotations_list([
+    ...     {'filename': 'a', 'start_frame': 1, 'end_frame': 3,
+    ...      'start_seconds': 0, 'end_seconds': 0.3,
+    ...      'frames_per_second': None, 'category': 'jump'},
+    ...     {'filename': 'a', 'start_frame': 5, 'end_frame': 9,
+    ...      'start_seconds': 0.5, 'end_seconds': 1,
+    ...      'frames_per_second': None, 'category': 'run'}])
+    >>> [(x.start_seconds, x.end_seconds, x.frames_per_second)
+    ...  for x in table.file_annotations('a')]
+    [(0, 0.3, None), (0.5, 1, None)]
+"""
+
+import os
+
+import numpy as np
+
+from util.annotation import Annotation, iter_annotations_json
+
+# Bump when the cache format changes.
+CACHE_VERSION = 2
+NUMERIC_FIELDS = ('start_frame', 'end_frame', 'start_seconds', 'end_seconds',
+                  'frames_per_second')
+
+
+def _column_array(values):
+    """Convert the values of a field to an array, preserving their types.
+
+    Columns of only ints or only floats are stored as int64 or float64 arrays.
+    Other columns (e.g. mixing ints and floats, or containing None) are stored
+    as object arrays, so that annotations read from the table match those
+    parsed from the JSON.
+    """
+    types = set(type(x) for x in values)
+    if types <= {int}:
+        dtype = np.int64
+    elif types == {float}:
+        dtype = np.float64
+    else:
+        dtype = object
+    return np.array(values, dtype=dtype)
+
+
+class AnnotationTable(object):
+    """Annotations stored as NumPy columns; see module docstring."""
+
+    def __init__(self, filenames, categories, file_codes, category_codes,
+                 columns):
+        """
+        Args:
+            filenames (np.array of str): Unique filenames, sorted.
+            categories (np.array of str): Unique categories, sorted.
+            file_codes, category_codes (np.array of int): Index into filenames
+                and categories for each row. Rows must be sorted by file_code.
+            columns (dict): Maps each field in NUMERIC_FIELDS to an array with
+                one entry per row.
+        """
+        self.filenames = filenames
+        self.categories = categories
+        self.file_codes = file_codes
+        self.category_codes = category_codes
+        self.columns = columns
+        self.file_offsets = np.searchsorted(file_codes,
+                                            np.arange(len(filenames) + 1))
+        self._file_index = None
+        self._category_index = None
+
+    @classmethod
+    def from_annotations_list(cls, annotations_list):
+        """Create a table from a list of annotation dicts (as in the JSON).
+
+        Args:
+            annotations_list (iterable of dict): Each dict must contain the
+                fields of util.annotation.Annotation.
+        """
+        filenames = []
+        categories = []
+        values = {field: [] for field in NUMERIC_FIELDS}
+        for annotation in annotations_list:
+            filenames.append(annotation['filename'])
+            categories.append(annotation['category'])
+            for field in NUMERIC_FIELDS:
+                values[field].append(annotation[field])
+        unique_filenames, file_codes = np.unique(
+            np.array(filenames, dtype=np.str_), return_inverse=True)
+        unique_categories, category_codes = np.unique(
+            np.array(categories, dtype=np.str_), return_inverse=True)
+        order = np.argsort(file_codes, kind='mergesort')
+        columns = {}
+        for field in NUMERIC_FIELDS:
+            columns[field] = _column_array(values[field])[order]
+        return cls(unique_filenames, unique_categories,
+                   file_codes[order].astype(np.int32),
+                   category_codes[order].astype(np.int32), columns)
+
+    @classmethod
+    def load(cls, annotations_json_path, cache_path=None, use_cache=True):
+        """Load annotations from JSON, using a cache if it is up to date.
+
+        Args:
+            annotations_json_path (str)
+            cache_path (str): Defaults to annotations_json_path + '.npz'.
+            use_cache (bool): If False, always parse the JSON and do not write
+                a cache.
+        """
+        if cache_path is None:
+            cache_path = annotations_json_path + '.npz'
+        stat = os.stat(annotations_json_path)
+        source_info = np.array([CACHE_VERSION, stat.st_mtime, stat.st_size],
+                               dtype=np.float64)
+        if use_cache and os.path.isfile(cache_path):
+            try:
+                # Object columns are pickled; the cache is only ever written
+                # by save.
+                with np.load(cache_path, allow_pickle=True) as cache:
+                    if np.array_equal(cache['source_info'], source_info):
+                        return cls(
+                            cache['filenames'], cache['categories'],
+                            cache['file_codes'], cache['category_codes'],
+                            {field: cache[field] for field in NUMERIC_FIELDS})
+            except (IOError, KeyError, ValueError):
+                pass  # Corrupt or outdated cache; rebuild it.
+        table = cls.from_annotations_list(
+            iter_annotations_json(annotations_json_path))
+        if use_cache:
+            table.save(cache_path, source_info)
+        return table
+
+    def save(self, cache_path, source_info):
+        # Write to a temporary file and rename, so that concurrent readers
+        # never see a partially written cache.
+        temporary_path = '%s.%s.tmp.npz' % (cache_path, os.getpid())
+        np.savez(temporary_path,
+                 source_info=source_info,
+                 filenames=self.filenames,
+                 categories=self.categories,
+                 file_codes=self.file_codes,
+                 category_codes=self.category_codes,
+                 **self.columns)
+        os.rename(temporary_path, cache_path)
+
+    def __len__(self):
+        return len(self.file_codes)
+
+    def file_list(self):
+        """Return the filenames that have at least one annotation."""
+        counts = np.diff(self.file_offsets)
+        return [str(x) for x in self.filenames[counts > 0]]
+
+    def category_code(self, category):
+        if self._category_index is None:
+            self._category_index = {
+                str(x): i for i, x in enumerate(self.categories)}
+        return self._category_index.get(category)
+
+    def file_code(self, filename):
+        if self._file_index is None:
+            self._file_index = {str(x): i for i, x in enumerate(self.filenames)}
+        return self._file_index.get(filename)
+
+    def file_rows(self, filename):
+        """Return the slice of rows for a file (empty if it is missing)."""
+        code = self.file_code(filename)
+        if code is None:
+            return slice(0, 0)
+        return slice(self.file_offsets[code], self.file_offsets[code + 1])
+
+    def _subset(self, mask):
+        return AnnotationTable(
+            self.filenames, self.categories, self.file_codes[mask],
+            self.category_codes[mask],
+            {field: column[mask] for field, column in self.columns.items()})
+
+    def filter_category(self, categories):
+        """Return only annotations with the given category (or categories).
+
+        Vectorized replacement for filter_annotations_by_category.
+        """
+        if isinstance(categories, str):
+            categories = [categories]
+        codes = [self.category_code(x) for x in categories]
+        codes = [x for x in codes if x is not None]
+        return self._subset(np.isin(self.category_codes, codes))
+
+    def filter_files(self, filenames):
+        """Return only annotations for the given filenames."""
+        codes = [self.file_code(x) for x in filenames]
+        codes = [x for x in codes if x is not None]
+        return self._subset(np.isin(self.file_codes, codes))
+
+    def _annotations(self, rows):
+        columns = [self.columns[field][rows].tolist()
+                   for field in NUMERIC_FIELDS]
+        filenames = self.filenames[self.file_codes[rows]].tolist()
+        categories = self.categories[self.category_codes[rows]].tolist()
+        return [Annotation(filename, start_frame, end_frame, start_seconds,
+                           end_seconds, frames_per_second, category)
+                for (filename, start_frame, end_frame, start_seconds,
+                     end_seconds, frames_per_second, category) in zip(
+                         filenames, *(columns + [categories]))]
+
+    def file_annotations(self, filename):
+        """Return a list of Annotation objects for one file."""
+        return self._annotations(self.file_rows(filename))
+
+    def to_dict(self):
+        """Convert to the dict of lists returned by load_annotations_json."""
+        return {
+            filename: self.file_annotations(filename)
+            for filename in self.file_list()
+        }
@@ -0,0 +1,226 @@
+"""On-disk cache of decoded and resized frames.
+
+Rebuilding an LMDB from the same frames (e.g. with new annotations or class
+mappings) otherwise decodes and resizes every image again. With a cache, the
+(channels, height, width) BGR arrays returned by frame_loader_util.load_image
+are stored once and read back on later runs, so such rebuilds are bound by
+I/O instead of image decoding.
+
+Entries are keyed by the frame's absolute path, size, modification time, and
+resize arguments, so a changed frame or different resize is a cache miss.
+Arrays are appended to large blob files (blob-<id>.bin), and a sqlite index
+(index.sqlite) maps each key to its blob, offset and shape. Blobs are never
+modified once written; when the cache grows past its size cap, the least
+recently used blobs are deleted as a whole.
+
+The cache may be shared by many processes: writes are serialized with a lock
+file, and each process opens its own index connection (so a FrameCache can be
+passed to forked or pickled workers).
+
+Example:
+
+    cache = FrameCache('/scratch/frame_cache', max_bytes=100 * 2**30)
+    image = load_image(frame_path, shorter_side=256, frame_cache=cache)
+"""
+
+import fcntl
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+# Blobs are closed to new entries once they reach this size.
+DEFAULT_BLOB_BYTES = 1 << 28
+# Blob access times are updated at most this often per process, to avoid a
+# write to the index for every read.
+TOUCH_INTERVAL_SECONDS = 60
+
+
+class FrameCache(object):
+    def __init__(self, cache_dir, max_bytes, blob_bytes=DEFAULT_BLOB_BYTES):
+        """
+        Args:
+            cache_dir (str): Directory for the index and blobs. Created if it
+                does not exist.
+            max_bytes (int): Size cap for the blobs. The cache may exceed
+                this by up to blob_bytes.
+            blob_bytes (int): Size at which a new blob is started.
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.blob_bytes = blob_bytes
+        if not os.path.isdir(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:  # Created by another process.
+                if not os.path.isdir(cache_dir):
+                    raise
+        self._pid = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key in ('_connection', '_lock_file', '_touched'):
+            state.pop(key, None)
+        state['_pid'] = None
+        return state
+
+    def _connect(self):
+        """Return this process's index connection, opening it if needed."""
+        if self._pid != os.getpid():
+            connection = sqlite3.connect(
+                os.path.join(self.cache_dir, 'index.sqlite'), timeout=600)
+            connection.execute('PRAGMA journal_mode=WAL')
+            with connection:
+                connection.execute(
+                    'CREATE TABLE IF NOT EXISTS frames (key TEXT PRIMARY KEY, '
+                    'blob INTEGER, offset INTEGER, length INTEGER, '
+                    'shape TEXT)')
+                connection.execute('CREATE INDEX IF NOT EXISTS frames_blob '
+                                   'ON frames (blob)')
+                connection.execute(
+                    'CREATE TABLE IF NOT EXISTS blobs (id INTEGER PRIMARY '
+                    'KEY, size INTEGER, last_used REAL)')
+            self._connection = connection
+            self._lock_file = open(os.path.join(self.cache_dir, 'lock'), 'a')
+            # Maps blob id to the last time this process updated its
+            # last_used.
+            self._touched = {}
+            self._pid = os.getpid()
+        return self._connection
+
+    @contextmanager
+    def _locked(self):
+        self._connect()
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+        try:
+            yield self._connection
+        finally:
+            fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def _blob_path(self, blob):
+        return os.path.join(self.cache_dir, 'blob-{:06d}.bin'.format(blob))
+
+    @staticmethod
+    def key(image_path, resize_arguments):
+        """Cache key for an image loaded with resize_arguments.
+
+        Resize arguments that are None or 0 are ignored, since they mean the
+        same as not specifying the argument.
+        """
+        stat = os.stat(image_path)
+        description = json.dumps([
+            os.path.abspath(image_path), stat.st_size, stat.st_mtime,
+            sorted((name, value) for name, value in resize_arguments.items()
+                   if value)
+        ])
+        return hashlib.sha1(description.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """Return the cached array for key, or None if it is not cached."""
+        connection = self._connect()
+        row = connection.execute(
+            'SELECT blob, offset, length, shape FROM frames WHERE key = ?',
+            (key, )).fetchone()
+        if row is None:
+            return None
+        blob, offset, length, shape = row
+        array = np.empty([int(x) for x in shape.split(',')], dtype=np.uint8)
+        try:
+            with open(self._blob_path(blob), 'rb') as f:
+                f.seek(offset)
+                num_read = f.readinto(array.reshape(-1))
+        except (IOError, OSError):  # Blob was evicted after the lookup.
+            return None
+        if num_read != length:
+            return None
+
+        now = time.time()
+        if now - self._touched.get(blob, 0) > TOUCH_INTERVAL_SECONDS:
+            self._touched[blob] = now
+            with connection:
+                connection.execute(
+                    'UPDATE blobs SET last_used = ? WHERE id = ?', (now, blob))
+        return array
+
+    def put(self, key, array):
+        """Append array to the cache, evicting blobs if over the size cap."""
+        data = np.ascontiguousarray(array, dtype=np.uint8).tobytes()
+        shape = ','.join(str(x) for x in array.shape)
+        now = time.time()
+        with self._locked() as connection:
+            row = connection.execute(
+                'SELECT id, size FROM blobs ORDER BY id DESC LIMIT 1'
+            ).fetchone()
+            started_blob = (row is None or
+                            (row[1] and row[1] + len(data) > self.blob_bytes))
+            if started_blob:
+                blob = 0 if row is None else row[0] + 1
+                with connection:
+                    connection.execute(
+                        'INSERT INTO blobs (id, size, last_used) '
+                        'VALUES (?, 0, ?)', (blob, now))
+            else:
+                blob = row[0]
+            with open(self._blob_path(blob), 'ab') as f:
+                # Use the file's size rather than the index's, in case a
+                # previous write was interrupted before updating the index.
+                f.seek(0, os.SEEK_END)
+                offset = f.tell()
+                f.write(data)
+            with connection:
+                connection.execute(
+                    'INSERT OR REPLACE INTO frames (key, blob, offset, length, '
+                    'shape) VALUES (?, ?, ?, ?, ?)',
+                    (key, blob, offset, len(data), shape))
+                connection.execute(
+                    'UPDATE blobs SET size = ?, last_used = ? WHERE id = ?',
+                    (offset + len(data), now, blob))
+            if started_blob:
+                self._evict(connection, blob)
+
+    def _evict(self, connection, current_blob):
+        """Delete least recently used blobs until under the size cap.
+
+        Must be called with the lock held. The blob being appended to is
+        never evicted."""
+        total_bytes = connection.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM blobs').fetchone()[0]
+        while total_bytes > self.max_bytes:
+            row = connection.execute(
+                'SELECT id, size FROM blobs WHERE id != ? '
+                'ORDER BY last_used LIMIT 1', (current_blob, )).fetchone()
+            if row is None:
+                break
+            blob, size = row
+            with connection:
+                connection.execute('DELETE FROM frames WHERE blob = ?',
+                                   (blob, ))
+                connection.execute('DELETE FROM blobs WHERE id = ?', (blob, ))
+            try:
+                os.remove(self._blob_path(blob))
+            except OSError:
+                pass
+            total_bytes -= size
+
+
+def add_frame_cache_arguments(parser):
+    parser.add_argument('--frame_cache_dir',
+                        help="""If specified, cache decoded and resized frames
+                        in this directory, and reuse them on later runs. See
+                        util/frame_cache.py.""")
+    parser.add_argument('--frame_cache_max_gb',
+                        default=100,
+                        type=float,
+                        help='Size cap for --frame_cache_dir.')
+
+
+def frame_cache_from_args(args):
+    """Return a FrameCache from add_frame_cache_arguments, or None."""
+    if not args.frame_cache_dir:
+        return None
+    return FrameCache(args.frame_cache_dir,
+                      max_bytes=int(args.frame_cache_max_gb * 2**30))
@@ -0,0 +1,302 @@
+"""Apply a function to every record of an LMDB, writing the results to a new
+LMDB.
+
+This is the shared engine behind scripts that rewrite frame LMDBs (e.g.
+remove_images_from_labeled_video_frames.py). It handles:
+
+    - Partitioning: the key space is split into ranges of range_size keys,
+      which are transformed in worker processes.
+    - Ordered output: results are appended, in key order, to the output LMDB
+      from the main process, so writes use LMDB's append mode.
+    - Resuming: the output LMDB is its own checkpoint. Each range is committed
+      in one transaction, so if a job is interrupted it can be rerun and will
+      continue after the last key in the output.
+    - Progress: a tqdm progress bar, and periodic logging of records/s and
+      MB/s read and written.
+
+Transform functions must be defined at module level (so that they can be
+pickled), and are called as
+
+    transform(key, value, *transform_args)
+
+where key is a bytes object and value is a buffer that is only valid during
+the call. They return the output value (bytes), or None to drop the record.
+
+With batched=True, transforms are instead called once per range as
+
+    transform(keys, values, *transform_args)
+
+and return a list with one output per record, which allows vectorizing work
+across records.
+
+If output_lmdb is a list of paths, each output must be a tuple with one value
+(or None) per output LMDB, so that one pass over the input can write several
+LMDBs.
+"""
+from __future__ import division
+
+import collections
+import json
+import logging
+import multiprocessing as mp
+import time
+
+import lmdb
+from tqdm import tqdm
+
+from util.video_frames_reader import open_readonly_lmdb
+
+# Set in each worker by _initialize_worker.
+_worker_transform = None
+
+
+def key_ranges(lmdb_path, range_size, start_after=None):
+    """Split the keys of an LMDB into consecutive ranges.
+
+    Only keys are read, so this does not touch the values.
+
+    Args:
+        lmdb_path (str)
+        range_size (int): Number of keys per range.
+        start_after (bytes): If specified, only keys strictly greater than
+            this key are included.
+
+    Returns:
+        ranges (list of (start_key, num_keys) tuples)
+    """
+    ranges = []
+    with open_readonly_lmdb(lmdb_path).begin() as transaction:
+        cursor = transaction.cursor()
+        if start_after is None:
+            positioned = cursor.first()
+        else:
+            positioned = cursor.set_range(start_after)
+            if positioned and cursor.key() == start_after:
+                positioned = cursor.next()
+        if not positioned:
+            return ranges
+        for i, key in enumerate(cursor.iternext(keys=True, values=False)):
+            if i % range_size == 0:
+                ranges.append((key, 0))
+            ranges[-1] = (ranges[-1][0], ranges[-1][1] + 1)
+    return ranges
+
+
+def last_key(lmdb_path):
+    """Return the last key in an LMDB, or None if it is empty or missing."""
+    try:
+        environment = lmdb.open(lmdb_path, readonly=True, lock=False)
+    except lmdb.Error:
+        return None
+    try:
+        with environment.begin() as transaction:
+            cursor = transaction.cursor()
+            return cursor.key() if cursor.last() else None
+    finally:
+        environment.close()
+
+
+def _initialize_worker(transform, transform_args, batched, single_output):
+    global _worker_transform
+    _worker_transform = (transform, transform_args, batched, single_output)
+
+
+def _transform_range(args):
+    """Transform num_keys records starting at start_key.
+
+    Returns:
+        records (list of (key, outputs) tuples): outputs contains one value
+            (or None) per output LMDB.
+        bytes_read (int)
+    """
+    input_lmdb, start_key, num_keys = args
+    transform, transform_args, batched, single_output = _worker_transform
+    keys = []
+    values = []
+    bytes_read = 0
+    with open_readonly_lmdb(input_lmdb).begin(buffers=True) as transaction:
+        cursor = transaction.cursor()
+        if not cursor.set_key(start_key):
+            raise KeyError(start_key)
+        for i, (key, value) in enumerate(cursor):
+            if i == num_keys:
+                break
+            keys.append(bytes(key))
+            values.append(value)
+            bytes_read += len(value)
+        if batched:
+            outputs = transform(keys, values, *transform_args)
+        else:
+            outputs = [transform(key, value, *transform_args)
+                       for key, value in zip(keys, values)]
+    if single_output:
+        outputs = [(output, ) for output in outputs]
+    return list(zip(keys, outputs)), bytes_read
+
+
+class _Metrics(object):
+    """Tracks throughput and logs it every log_interval seconds."""
+
+    def __init__(self, log_interval):
+        self.log_interval = log_interval
+        self.start_time = time.time()
+        self.last_log_time = self.start_time
+        self.records_read = 0
+        self.records_written = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+    def update(self, num_read, num_written, bytes_read, bytes_written):
+        self.records_read += num_read
+        self.records_written += num_written
+        self.bytes_read += bytes_read
+        self.bytes_written += bytes_written
+        if time.time() - self.last_log_time > self.log_interval:
+            self.log()
+
+    def summary(self):
+        elapsed = max(time.time() - self.start_time, 1e-6)
+        return collections.OrderedDict([
+            ('records_read', self.records_read),
+            ('records_written', self.records_written),
+            ('bytes_read', self.bytes_read),
+            ('bytes_written', self.bytes_written),
+            ('seconds', elapsed),
+            ('records_per_second', self.records_read / elapsed),
+            ('read_mb_per_second', self.bytes_read / elapsed / 1e6),
+            ('write_mb_per_second', self.bytes_written / elapsed / 1e6),
+        ])
+
+    def log(self):
+        self.last_log_time = time.time()
+        summary = self.summary()
+        logging.info('Read %d records, wrote %d (%.1f records/s, read %.1f '
+                     'MB/s, wrote %.1f MB/s)', summary['records_read'],
+                     summary['records_written'],
+                     summary['records_per_second'],
+                     summary['read_mb_per_second'],
+                     summary['write_mb_per_second'])
+
+
+def write_records(environment, records, append=True):
+    """Write records to environment in one transaction, growing the map if
+    needed.
+
+    If append is True, keys must be sorted and greater than every key already
+    in environment, which lets LMDB skip searching the tree for each key.
+    """
+    while True:
+        try:
+            with environment.begin(write=True) as transaction:
+                transaction.cursor().putmulti(records, append=append)
+            return
+        except lmdb.MapFullError:
+            new_size = environment.info()['map_size'] * 2
+            logging.info('Map full, increasing map size to %s', new_size)
+            environment.set_mapsize(new_size)
+
+
+def transform_lmdb(input_lmdb,
+                   output_lmdb,
+                   transform,
+                   transform_args=(),
+                   num_processes=8,
+                   range_size=5000,
+                   map_size=int(500e9),
+                   resume=True,
+                   log_interval=60,
+                   batched=False):
+    """Write transform(key, value) for each record in input_lmdb to output_lmdb.
+
+    Args:
+        input_lmdb (str): Path to LMDB.
+        output_lmdb (str or list of str): Path(s) to output LMDB(s).
+        transform (function): Module-level function; see module docstring.
+        transform_args (tuple): Extra arguments for transform. These are sent
+            to each worker once, not once per record.
+        num_processes (int): Number of worker processes.
+        range_size (int): Number of records per task and per output
+            transaction.
+        map_size (int): Initial map size of output LMDB.
+        resume (bool): If True and output_lmdb already contains records,
+            continue after its last key. If False, output_lmdb must be empty
+            or not exist.
+        log_interval (float): Seconds between progress log messages.
+        batched (bool): Whether transform operates on lists of records; see
+            module docstring.
+
+    Returns:
+        summary (OrderedDict): Throughput statistics, also written as JSON to
+            <output_lmdb>.transform.json for each output.
+    """
+    single_output = not isinstance(output_lmdb, (list, tuple))
+    output_lmdbs = [output_lmdb] if single_output else list(output_lmdb)
+    # Each output is resumed separately, since a run may have been
+    # interrupted between committing to one output and the next.
+    output_last_keys = [last_key(path) for path in output_lmdbs]
+    start_after = None
+    if any(key is not None for key in output_last_keys):
+        if not resume:
+            raise ValueError('Output LMDB(s) %s are not empty.' %
+                             output_lmdbs)
+        if all(key is not None for key in output_last_keys):
+            start_after = min(output_last_keys)
+        logging.info('Resuming after key %s', start_after)
+    ranges = key_ranges(input_lmdb, range_size, start_after)
+    num_records = sum(num_keys for _, num_keys in ranges)
+    logging.info('Transforming %d records in %d ranges', num_records,
+                 len(ranges))
+
+    progress = tqdm(total=num_records)
+    metrics = _Metrics(log_interval)
+    pool = mp.Pool(num_processes,
+                   initializer=_initialize_worker,
+                   initargs=(transform, transform_args, batched,
+                             single_output))
+    output_environments = [lmdb.open(path, map_size=map_size)
+                           for path in output_lmdbs]
+
+    def write_next():
+        async_result, num_keys = pending.popleft()
+        records, bytes_read = async_result.get()
+        num_written = bytes_written = 0
+        for i, environment in enumerate(output_environments):
+            output_records = [
+                (key, outputs[i]) for key, outputs in records
+                if outputs[i] is not None and (output_last_keys[i] is None or
+                                               key > output_last_keys[i])
+            ]
+            write_records(environment, output_records)
+            num_written += len(output_records)
+            bytes_written += sum(len(value) for _, value in output_records)
+        progress.update(num_keys)
+        metrics.update(num_keys, num_written, bytes_read, bytes_written)
+
+    # Limit the number of ranges in flight so that memory use is bounded
+    # regardless of the size of the input.
+    pending = collections.deque()
+    try:
+        for start_key, num_keys in ranges:
+            pending.append((pool.apply_async(
+                _transform_range, ((input_lmdb, start_key, num_keys), )),
+                            num_keys))
+            if len(pending) >= 2 * num_processes:
+                write_next()
+        while pending:
+            write_next()
+        pool.close()
+    finally:
+        pool.terminate()
+        for environment in output_environments:
+            environment.close()
+        progress.close()
+
+    metrics.log()
+    summary = metrics.summary()
+    summary['input_lmdb'] = input_lmdb
+    summary['resumed_after_key'] = (start_after.decode('utf-8', 'replace')
+                                    if start_after is not None else None)
+    for path in output_lmdbs:
+        with open(path + '.transform.json', 'w') as f:
+            json.dump(summary, f, indent=2)
+    return summary
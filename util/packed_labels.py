@@ -0,0 +1,122 @@
+"""Per-video bit-packed label matrices, as written by
+frame_labels_hdf5_to_lmdb.py --packed.
+
+Storing a few bytes of labels under a separate key per frame wastes most of an
+LMDB's space on per-key overhead. Instead, the packed format stores one value
+per video, keyed by the video name:
+
+    header: num_frames, num_labels as little-endian uint32
+    data: np.packbits(labels, axis=1), i.e. ceil(num_labels / 8) bytes per
+        frame, row major.
+
+Rows are contiguous, so the labels of a range of frames can be sliced out of
+the value without unpacking the whole video.
+
+    >>> labels = np.array([[1, 0, 1], [0, 0, 0], [1, 1, 1]], dtype=np.uint8)
+    >>> value = pack_labels(labels)
+    >>> len(value)  # 8 byte header + 3 rows of 1 byte.
+    11
+    >>> unpack_labels(value).tolist()
+    [[1, 0, 1], [0, 0, 0], [1, 1, 1]]
+    >>> unpack_labels(value, 1, 3).tolist()
+    [[0, 0, 0], [1, 1, 1]]
+"""
+
+import struct
+
+import numpy as np
+
+from util.video_frames_reader import open_readonly_lmdb
+
+HEADER = struct.Struct('<II')
+
+
+def packed_row_size(num_labels):
+    return (num_labels + 7) // 8
+
+
+def pack_header(num_frames, num_labels):
+    return HEADER.pack(num_frames, num_labels)
+
+
+def pack_rows(labels):
+    """Pack a (num_frames, num_labels) binary matrix, without a header.
+
+    Packed rows of consecutive chunks of a video can be concatenated."""
+    return np.packbits(np.asarray(labels) != 0, axis=1).tobytes()
+
+
+def pack_labels(labels):
+    """Pack a (num_frames, num_labels) binary matrix with a header."""
+    labels = np.asarray(labels)
+    return pack_header(*labels.shape) + pack_rows(labels)
+
+
+def unpack_labels(value, start=None, end=None):
+    """Unpack rows [start, end) of a packed label matrix.
+
+    Args:
+        value (bytes or buffer): Packed value, including header.
+        start, end (int): Row range; defaults to all rows.
+
+    Returns:
+        labels (np.array, shape (end - start, num_labels), dtype np.uint8)
+    """
+    num_frames, num_labels = HEADER.unpack_from(value)
+    start, end, _ = slice(start, end).indices(num_frames)
+    end = max(start, end)
+    row_size = packed_row_size(num_labels)
+    packed = np.frombuffer(value, dtype=np.uint8,
+                           count=(end - start) * row_size,
+                           offset=HEADER.size + start * row_size)
+    return np.unpackbits(packed.reshape(end - start, row_size),
+                         axis=1)[:, :num_labels]
+
+
+class PackedLabelsReader(object):
+    """Read frame labels from an LMDB of packed per-video label matrices."""
+
+    def __init__(self, lmdb_path):
+        self.lmdb_path = lmdb_path
+
+    @property
+    def environment(self):
+        return open_readonly_lmdb(self.lmdb_path)
+
+    def video_names(self):
+        with self.environment.begin() as transaction:
+            return [bytes(key).decode('utf-8')
+                    for key in transaction.cursor().iternext(values=False)]
+
+    def shape(self, video_name):
+        """Return (num_frames, num_labels) for a video."""
+        with self.environment.begin(buffers=True) as transaction:
+            return HEADER.unpack_from(
+                transaction.get(video_name.encode('utf-8')))
+
+    def labels(self, video_name, start_frame=1, end_frame=None):
+        """Return labels for frames [start_frame, end_frame).
+
+        Frame numbers are 1-indexed, as in the per-frame format; end_frame
+        defaults to the last frame of the video, inclusive.
+
+        Returns:
+            labels (np.array, shape (num_frames, num_labels))
+
+        Raises:
+            ValueError: If start_frame or end_frame is less than 1.
+        """
+        if start_frame < 1 or (end_frame is not None and end_frame < 1):
+            raise ValueError('Frame numbers are 1-indexed; got [%s, %s)' %
+                             (start_frame, end_frame))
+        with self.environment.begin(buffers=True) as transaction:
+            value = transaction.get(video_name.encode('utf-8'))
+            if value is None:
+                raise KeyError(video_name)
+            return unpack_labels(
+                value, start_frame - 1,
+                end_frame - 1 if end_frame is not None else None)
+
+    def frame_labels(self, video_name, frame_number):
+        """Return the label vector of one (1-indexed) frame."""
+        return self.labels(video_name, frame_number, frame_number + 1)[0]
@@ -0,0 +1,157 @@
+"""Split work across independent jobs by video.
+
+Scripts that accept --shard-index and --num-shards (see add_shard_arguments)
+only process videos in their shard. Videos are assigned to shards by a salted
+hash of the video name, so the assignment is deterministic, a video is never
+split across shards, and every stage of the pipeline (dump_frames.py,
+resize_images.py, frames_to_*_lmdb.py) assigns a video to the same shard.
+Shards are independent of the folds of split_trainval_annotations.py.
+
+Each shard writes a completion marker next to its output when it finishes.
+Missing shards can be listed without any coordinator with
+
+    python -m util.sharding <output> --num-shards <num_shards>
+
+which prints the index of each shard without a completion marker, so that
+only those shards need to be re-run.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import socket
+import sys
+import time
+
+
+def shard_for_name(name, num_shards):
+    """Deterministically assign name to a shard in [0, num_shards).
+
+    The hash is salted, so that shards are independent of the folds assigned
+    by split_trainval_annotations.py (which hashes the unsalted name);
+    otherwise, with as many shards as folds, each shard would hold exactly
+    one fold.
+
+    >>> shard_for_name('video_validation_0000051', 5)
+    4
+    """
+    digest = hashlib.md5(('shard:' + name).encode('utf-8')).hexdigest()
+    return int(digest, 16) % num_shards
+
+
+def in_shard(name, shard_index, num_shards):
+    """
+    >>> in_shard('video_validation_0000051', 0, 1)
+    True
+    >>> in_shard('video_validation_0000051', 0, 5)
+    False
+    """
+    return num_shards == 1 or shard_for_name(name, num_shards) == shard_index
+
+
+def add_shard_arguments(parser):
+    parser.add_argument('--shard-index',
+                        default=0,
+                        type=int,
+                        help='Index of the shard of videos to process.')
+    parser.add_argument('--num-shards',
+                        default=1,
+                        type=int,
+                        help="""Number of shards to split videos into. Each
+                        video is assigned to a shard by a hash of its
+                        name.""")
+
+
+def check_shard_arguments(parser, args):
+    """Call parser.error if the arguments from add_shard_arguments are
+    invalid."""
+    if args.num_shards < 1:
+        parser.error('--num-shards must be positive.')
+    if not 0 <= args.shard_index < args.num_shards:
+        parser.error('--shard-index must be in [0, --num-shards).')
+
+
+def _shard_suffix(shard_index, num_shards):
+    return '{:05d}-of-{:05d}'.format(shard_index, num_shards)
+
+
+def shard_output_path(output_path, shard_index, num_shards):
+    """Path for a shard's output, for outputs that cannot be shared between
+    shards (e.g. LMDBs).
+
+    >>> shard_output_path('frames.lmdb', 3, 10)
+    'frames.lmdb-00003-of-00010'
+    >>> shard_output_path('frames.lmdb', 0, 1)
+    'frames.lmdb'
+    """
+    if num_shards == 1:
+        return output_path
+    return '{}-{}'.format(output_path, _shard_suffix(shard_index, num_shards))
+
+
+def completion_marker_path(output_path, shard_index, num_shards):
+    """
+    >>> completion_marker_path('frames/', 3, 10)
+    'frames.shard-00003-of-00010.done'
+    """
+    return '{}.shard-{}.done'.format(output_path.rstrip(os.sep),
+                                     _shard_suffix(shard_index, num_shards))
+
+
+def write_completion_marker(output_path, shard_index, num_shards, **info):
+    """Mark a shard as complete.
+
+    The marker is a JSON file containing the shard, host, time, and info. It
+    is also written for unsharded runs (num_shards of 1), so that
+    missing_shards reports them correctly.
+
+    Args:
+        output_path (str): Output of the script, without the suffix added by
+            shard_output_path.
+        shard_index, num_shards (int)
+        info: Additional JSON-serializable values to store, e.g. number of
+            videos or frames written.
+    """
+    marker_path = completion_marker_path(output_path, shard_index,
+                                         num_shards)
+    info.update({
+        'shard_index': shard_index,
+        'num_shards': num_shards,
+        'host': socket.gethostname(),
+        'time': time.strftime('%Y-%m-%d %H:%M:%S')
+    })
+    # Write to a temporary file and rename, so that a marker is never
+    # partially written.
+    temporary_path = '{}.{}.tmp'.format(marker_path, os.getpid())
+    with open(temporary_path, 'w') as f:
+        json.dump(info, f)
+    os.rename(temporary_path, marker_path)
+
+
+def missing_shards(output_path, num_shards):
+    """Return indices of shards that have not written a completion marker."""
+    return [
+        shard_index for shard_index in range(num_shards)
+        if not os.path.exists(
+            completion_marker_path(output_path, shard_index, num_shards))
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='List shards that have not written a completion marker.')
+    parser.add_argument('output_path',
+                        help="""Output passed to the sharded script (without
+                        the suffix added to per-shard outputs).""")
+    parser.add_argument('--num-shards', required=True, type=int)
+    args = parser.parse_args()
+
+    missing = missing_shards(args.output_path, args.num_shards)
+    for shard_index in missing:
+        print(shard_index)
+    sys.exit(1 if missing else 0)
+
+
+if __name__ == '__main__':
+    main()
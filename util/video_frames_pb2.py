@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+# Generated by the protocol buffer compiler.  DO NOT EDIT!
+# source: util/video_frames.proto
+"""Generated protocol buffer code."""
+from google.protobuf.internal import builder as _builder
+from google.protobuf import descriptor as _descriptor
+from google.protobuf import descriptor_pool as _descriptor_pool
+from google.protobuf import symbol_database as _symbol_database
+# @@protoc_insertion_point(imports)
+
+_sym_db = _symbol_database.Default()
+
+
+
+
+DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\x17util/video_frames.proto\"F\n\x05Image\x12\x10\n\x08\x63hannels\x18\x01 \x01(\x05\x12\x0e\n\x06height\x18\x02 \x01(\x05\x12\r\n\x05width\x18\x03 \x01(\x05\x12\x0c\n\x04\x64\x61ta\x18\x04 \x01(\x0c\"L\n\nVideoFrame\x12\x12\n\nvideo_name\x18\x01 \x01(\t\x12\x13\n\x0b\x66rame_index\x18\x02 \x01(\x03\x12\x15\n\x05image\x18\x03 \x01(\x0b\x32\x06.Image\"F\n\x11LabeledVideoFrame\x12\x1a\n\x05\x66rame\x18\x01 \x01(\x0b\x32\x0b.VideoFrame\x12\x15\n\x05label\x18\x02 \x03(\x0b\x32\x06.Label\"!\n\x05Label\x12\x0c\n\x04name\x18\x01 \x01(\t\x12\n\n\x02id\x18\x02 \x01(\x05\"\xb6\x01\n\x0eVideoFrameClip\x12\x12\n\nvideo_name\x18\x01 \x01(\t\x12\x19\n\x11start_frame_index\x18\x02 \x01(\x03\x12\x12\n\nnum_frames\x18\x03 \x01(\x05\x12\x10\n\x08\x63hannels\x18\x04 \x01(\x05\x12\x0e\n\x06height\x18\x05 \x01(\x05\x12\r\n\x05width\x18\x06 \x01(\x05\x12\x0c\n\x04\x64\x61ta\x18\x07 \x01(\x0c\x12\"\n\x0c\x66rame_labels\x18\x08 \x03(\x0b\x32\x0c.FrameLabels\"$\n\x0b\x46rameLabels\x12\x15\n\x05label\x18\x01 \x03(\x0b\x32\x06.Label')
+
+_builder.BuildMessageAndEnumDescriptors(DESCRIPTOR, globals())
+_builder.BuildTopDescriptorsAndMessages(DESCRIPTOR, 'util.video_frames_pb2', globals())
+if _descriptor._USE_C_DESCRIPTORS == False:
+
+  DESCRIPTOR._options = None
+  _IMAGE._serialized_start=27
+  _IMAGE._serialized_end=97
+  _VIDEOFRAME._serialized_start=99
+  _VIDEOFRAME._serialized_end=175
+  _LABELEDVIDEOFRAME._serialized_start=177
+  _LABELEDVIDEOFRAME._serialized_end=247
+  _LABEL._serialized_start=249
+  _LABEL._serialized_end=282
+  _VIDEOFRAMECLIP._serialized_start=285
+  _VIDEOFRAMECLIP._serialized_end=467
+  _FRAMELABELS._serialized_start=469
+  _FRAMELABELS._serialized_end=505
+# @@protoc_insertion_point(module_scope)
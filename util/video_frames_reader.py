@@ -0,0 +1,503 @@
+"""Read LabeledVideoFrame / VideoFrame LMDBs for training.
+
+The LMDBs are keyed by "<video_name>-<frame_index>" (see
+frames_to_labeled_video_frames_lmdb.py). This module provides:
+
+    - open_readonly_lmdb: A per-process cache of read-only environments. It is
+      safe to use from processes forked after the reader was created (e.g. data
+      loader workers); each process opens its own environment on first use.
+    - VideoFramesReader: Reads frames and fixed-length clips. Image bytes are
+      located in the LMDB memory map with the wire-level helpers in
+      video_frames_wire and viewed with np.frombuffer, so the only copy made is
+      into the output clip array.
+    - VideoFrameClipsReader: Like VideoFramesReader, for LMDBs of
+      VideoFrameClips (see --clip_length in
+      frames_to_labeled_video_frames_lmdb.py), which store runs of
+      consecutive frames under one key.
+    - ClipSampler: Samples fixed-length temporal clips per video.
+    - prefetch: Runs an iterator (e.g. of batches) on a background thread.
+
+Example:
+
+    reader = VideoFramesReader('/data/train_lmdb', num_classes=65)
+    sampler = ClipSampler(reader.video_frames, clip_length=16, frame_stride=2)
+    for clips, labels, _ in prefetch(reader.iter_batches(sampler, 32)):
+        ...
+"""
+
+import bisect
+import collections
+import os
+import random
+import threading
+
+import lmdb
+import numpy as np
+
+from util.video_frames_wire import (parse_clip, parse_clip_labels,
+                                    parse_frame, parse_labels)
+
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+# Maps lmdb path to (pid, environment).
+_ENVIRONMENTS = {}
+_ENVIRONMENTS_LOCK = threading.Lock()
+
+
+def open_readonly_lmdb(lmdb_path, **kwargs):
+    """Return a read-only environment for lmdb_path, opened once per process.
+
+    LMDB environments must not be used across fork(), so the cache is keyed by
+    process id: a forked child transparently opens its own environment instead
+    of reusing its parent's.
+
+    Args:
+        lmdb_path (str)
+        **kwargs: Passed to lmdb.open the first time the environment is opened
+            in this process.
+    """
+    pid = os.getpid()
+    with _ENVIRONMENTS_LOCK:
+        cached = _ENVIRONMENTS.get(lmdb_path)
+        if cached is not None:
+            if cached[0] == pid:
+                return cached[1]
+            # Inherited from our parent. Environments are opened without the
+            # lock file, so closing the child's copy only unmaps it here; this
+            # is required since lmdb refuses to open one path twice in a
+            # process.
+            cached[1].close()
+        options = dict(readonly=True, lock=False, readahead=False,
+                       max_readers=512)
+        options.update(kwargs)
+        environment = lmdb.open(lmdb_path, **options)
+        _ENVIRONMENTS[lmdb_path] = (pid, environment)
+        return environment
+
+
+def frame_key(video_name, frame_index):
+    return '{}-{}'.format(video_name, frame_index).encode('utf-8')
+
+
+def parse_frame_key(key):
+    """Convert a "<video_name>-<frame_index>" key to a (video, index) tuple.
+
+    >>> parse_frame_key(b'video_1-23')
+    ('video_1', 23)
+    """
+    video_name, frame_index = bytes(key).decode('utf-8').rsplit('-', 1)
+    return video_name, int(frame_index)
+
+
+def load_video_frames(environment):
+    """Collect the frame indices of each video from the keys of an LMDB.
+
+    Only keys are read, so this does not touch the image data.
+
+    Returns:
+        video_frames (OrderedDict): Maps video name to a sorted list of frame
+            indices, in sorted order of video names.
+    """
+    video_frames = collections.defaultdict(list)
+    with environment.begin(buffers=True) as transaction:
+        for key in transaction.cursor().iternext(keys=True, values=False):
+            video_name, frame_index = parse_frame_key(key)
+            video_frames[video_name].append(frame_index)
+    return collections.OrderedDict(
+        (video_name, sorted(video_frames[video_name]))
+        for video_name in sorted(video_frames))
+
+
+class VideoFramesReader(object):
+    """Read frames and clips from a VideoFrame or LabeledVideoFrame LMDB."""
+
+    def __init__(self, lmdb_path, labeled=True, num_classes=None,
+                 labels_lmdb=None):
+        """
+        Args:
+            lmdb_path (str)
+            labeled (bool): Whether values are LabeledVideoFrames (as opposed
+                to VideoFrames).
+            num_classes (int): If specified, labels are returned as multi-hot
+                arrays of this length. Otherwise, labels are returned as lists
+                of label ids.
+            labels_lmdb (str): If specified, labels are read from this
+                labels-only LMDB (see relabel_labeled_video_frames_lmdb.py)
+                instead of from lmdb_path. lmdb_path may then contain
+                VideoFrames or LabeledVideoFrames.
+        """
+        self.lmdb_path = lmdb_path
+        self.labeled = labeled
+        self.num_classes = num_classes
+        self.labels_lmdb = labels_lmdb
+        self._video_frames = None
+
+    @property
+    def environment(self):
+        return open_readonly_lmdb(self.lmdb_path)
+
+    @property
+    def video_frames(self):
+        """Maps video name to sorted list of frame indices.
+
+        Computed on first access; access it before forking workers so that it
+        is shared rather than recomputed by every worker.
+        """
+        if self._video_frames is None:
+            self._video_frames = load_video_frames(self.environment)
+        return self._video_frames
+
+    def __len__(self):
+        return self.environment.stat()['entries']
+
+    @property
+    def has_labels(self):
+        return self.labeled or self.labels_lmdb is not None
+
+    def _decode(self, value, image_out, labels_value=None):
+        """Copy the image in value into image_out, return its labels.
+
+        Labels are parsed from labels_value if specified, else from value.
+        """
+        frame = parse_frame(value, self.labeled)
+        image = frame.image
+        if image is None:
+            raise ValueError('Frame %s-%s has no image.' %
+                             (frame.video_name, frame.frame_index))
+        size = image.data_end - image.data_start
+        if size != image_out.size:
+            raise ValueError(
+                'Frame %s-%s has %s image bytes, expected %s.' %
+                (frame.video_name, frame.frame_index, size, image_out.size))
+        image_out[...] = np.frombuffer(
+            value, dtype=np.uint8, count=size,
+            offset=image.data_start).reshape(image_out.shape)
+        if labels_value is not None:
+            value = labels_value
+        elif not self.labeled:
+            return None
+        return self._format_labels(parse_labels(value))
+
+    def _format_labels(self, labels):
+        """Convert (name, id) pairs to the output format for labels."""
+        label_ids = [label_id for _, label_id in labels]
+        if self.num_classes is None:
+            return label_ids
+        labels = np.zeros(self.num_classes, dtype=np.uint8)
+        labels[label_ids] = 1
+        return labels
+
+    def image_shape(self):
+        """Return the (channels, height, width) of the first frame."""
+        with self.environment.begin(buffers=True) as transaction:
+            cursor = transaction.cursor()
+            if not cursor.first():
+                raise ValueError('LMDB at %s is empty.' % self.lmdb_path)
+            image = parse_frame(cursor.value(), self.labeled).image
+            return image.channels, image.height, image.width
+
+    def read_frames(self, keys, out=None):
+        """Read images and labels for a list of keys.
+
+        Args:
+            keys (list of (video_name, frame_index) tuples)
+            out (np.array, shape (len(keys), channels, height, width)): If
+                specified, images are written into this array. All frames must
+                have the same shape.
+
+        Returns:
+            images (np.array, shape (len(keys), channels, height, width))
+            labels (list): Labels for each frame (see num_classes in
+                __init__), or None if the LMDB is unlabeled.
+        """
+        if out is None:
+            out = np.empty((len(keys), ) + self.image_shape(), dtype=np.uint8)
+        labels = []
+        labels_transaction = None
+        if self.labels_lmdb is not None:
+            labels_transaction = open_readonly_lmdb(self.labels_lmdb).begin(
+                buffers=True)
+        try:
+            with self.environment.begin(buffers=True) as transaction:
+                for i, (video_name, frame_index) in enumerate(keys):
+                    key = frame_key(video_name, frame_index)
+                    value = transaction.get(key)
+                    if value is None:
+                        raise KeyError(key)
+                    labels_value = None
+                    if labels_transaction is not None:
+                        labels_value = labels_transaction.get(key)
+                        if labels_value is None:
+                            raise KeyError(key)
+                    # value is only valid inside this transaction, so decode
+                    # it (copying the image into out) before moving on.
+                    labels.append(self._decode(value, out[i], labels_value))
+        finally:
+            if labels_transaction is not None:
+                labels_transaction.abort()
+        if not self.has_labels:
+            labels = None
+        elif self.num_classes is not None:
+            labels = np.stack(labels)
+        return out, labels
+
+    def read_clip(self, video_name, frame_indices, out=None):
+        """Read a clip; see read_frames."""
+        return self.read_frames([(video_name, frame_index)
+                                 for frame_index in frame_indices], out)
+
+    def iter_batches(self, clip_sampler, batch_size, drop_last=False):
+        """Yield batches of clips sampled by clip_sampler.
+
+        Yields:
+            clips (np.array, shape (batch_size, clip_length, channels, height,
+                width))
+            labels (list or np.array): Per-clip labels, as returned by
+                read_clip.
+            clip_keys (list of (video_name, frame_indices))
+        """
+        image_shape = self.image_shape()
+        batch_keys = []
+
+        def make_batch(batch_keys):
+            clips = np.empty((len(batch_keys), clip_sampler.clip_length) +
+                             image_shape, dtype=np.uint8)
+            labels = [self.read_clip(video_name, frame_indices, clips[i])[1]
+                      for i, (video_name, frame_indices) in
+                      enumerate(batch_keys)]
+            if self.has_labels and self.num_classes is not None:
+                labels = np.stack(labels)
+            return clips, labels, batch_keys
+
+        for clip_key in clip_sampler:
+            batch_keys.append(clip_key)
+            if len(batch_keys) == batch_size:
+                yield make_batch(batch_keys)
+                batch_keys = []
+        if batch_keys and not drop_last:
+            yield make_batch(batch_keys)
+
+
+class VideoFrameClipsReader(VideoFramesReader):
+    """Read frames and clips from an LMDB of VideoFrameClips.
+
+    Each value holds a run of consecutive frames of a video, keyed by
+    "<video_name>-<first frame index>". Frames are addressed by (video_name,
+    frame_index) as in VideoFramesReader, so the clips read (e.g. from
+    ClipSampler) are independent of how frames were packed and may span
+    several stored clips. Each stored clip is looked up and parsed once per
+    read_frames call, however many of its frames are read.
+
+    Example:
+
+        reader = VideoFrameClipsReader('/data/train_clips_lmdb',
+                                       num_classes=65)
+        images, labels = reader.read_clip('video_1', range(10, 26))
+    """
+
+    def __init__(self, lmdb_path, num_classes=None):
+        """
+        Args:
+            lmdb_path (str)
+            num_classes (int): As in VideoFramesReader.
+        """
+        VideoFramesReader.__init__(self, lmdb_path, labeled=True,
+                                   num_classes=num_classes)
+        # Maps video name to sorted list of stored clip start indices.
+        self._clip_starts = None
+
+    def _load_clips(self):
+        """Read the clip keys, and the header of each video's last clip."""
+        clip_starts = collections.defaultdict(list)
+        video_frames = collections.OrderedDict()
+        with self.environment.begin(buffers=True) as transaction:
+            for key in transaction.cursor().iternext(keys=True, values=False):
+                video_name, start = parse_frame_key(key)
+                clip_starts[video_name].append(start)
+            for video_name in sorted(clip_starts):
+                starts = sorted(clip_starts[video_name])
+                clip_starts[video_name] = starts
+                last_clip = parse_clip(
+                    transaction.get(frame_key(video_name, starts[-1])))
+                video_frames[video_name] = list(
+                    range(starts[0],
+                          last_clip.start_frame_index + last_clip.num_frames))
+        self._clip_starts = clip_starts
+        self._video_frames = video_frames
+
+    @property
+    def video_frames(self):
+        """Maps video name to sorted list of frame indices; see
+        VideoFramesReader.video_frames."""
+        if self._video_frames is None:
+            self._load_clips()
+        return self._video_frames
+
+    def __len__(self):
+        return sum(len(frames) for frames in self.video_frames.values())
+
+    def image_shape(self):
+        with self.environment.begin(buffers=True) as transaction:
+            cursor = transaction.cursor()
+            if not cursor.first():
+                raise ValueError('LMDB at %s is empty.' % self.lmdb_path)
+            clip = parse_clip(cursor.value())
+            return clip.channels, clip.height, clip.width
+
+    def clip_start(self, video_name, frame_index):
+        """Return the start index of the stored clip containing a frame."""
+        if self._clip_starts is None:
+            self._load_clips()
+        starts = self._clip_starts.get(video_name)
+        position = bisect.bisect_right(starts, frame_index) if starts else 0
+        if position == 0:
+            raise KeyError(frame_key(video_name, frame_index))
+        return starts[position - 1]
+
+    def read_frames(self, keys, out=None):
+        """Read images and labels for a list of (video_name, frame_index)
+        keys; see VideoFramesReader.read_frames."""
+        if out is None:
+            out = np.empty((len(keys), ) + self.image_shape(), dtype=np.uint8)
+        labels = []
+        # Maps (video_name, clip start) to (frames, frame labels) for clips
+        # read so far.
+        clips = {}
+        with self.environment.begin(buffers=True) as transaction:
+            for i, (video_name, frame_index) in enumerate(keys):
+                start = self.clip_start(video_name, frame_index)
+                if (video_name, start) not in clips:
+                    value = transaction.get(frame_key(video_name, start))
+                    clip = parse_clip(value)
+                    shape = (clip.num_frames, clip.channels, clip.height,
+                             clip.width)
+                    if shape[1:] != out.shape[1:]:
+                        raise ValueError(
+                            'Clip %s-%s has frames of shape %s, expected %s.'
+                            % (video_name, start, shape[1:], out.shape[1:]))
+                    # value is only valid inside this transaction; frames are
+                    # copied into out below.
+                    frames = np.frombuffer(
+                        value, dtype=np.uint8,
+                        count=clip.data_end - clip.data_start,
+                        offset=clip.data_start).reshape(shape)
+                    clips[(video_name, start)] = (frames,
+                                                  parse_clip_labels(value))
+                frames, frame_labels = clips[(video_name, start)]
+                offset = frame_index - start
+                if offset >= len(frames):
+                    raise KeyError(frame_key(video_name, frame_index))
+                out[i] = frames[offset]
+                labels.append(self._format_labels(frame_labels[offset]))
+        if self.num_classes is not None:
+            labels = np.stack(labels)
+        return out, labels
+
+
+class ClipSampler(object):
+    """Sample fixed-length clips of frames from each video.
+
+    A clip is clip_length frames, taken every frame_stride frames from the
+    sorted list of a video's frame indices. Videos with too few frames for one
+    clip are skipped. Iterating over the sampler yields one epoch of
+    (video_name, frame_indices) tuples.
+    """
+
+    def __init__(self, video_frames, clip_length, frame_stride=1,
+                 clips_per_video=1, shuffle=True, seed=None):
+        """
+        Args:
+            video_frames (dict): Maps video name to sorted list of frame
+                indices, e.g. VideoFramesReader.video_frames.
+            clip_length (int): Number of frames per clip.
+            frame_stride (int): Step between consecutive frames of a clip.
+            clips_per_video (int): Number of clips sampled per video per epoch.
+            shuffle (bool): If True, clip start frames are sampled at random
+                and clips are shuffled across videos. If False, clips_per_video
+                clips are evenly spaced in each video, in video order.
+            seed (int): Seed for the random number generator.
+        """
+        self.video_frames = video_frames
+        self.clip_length = clip_length
+        self.frame_stride = frame_stride
+        self.clips_per_video = clips_per_video
+        self.shuffle = shuffle
+        self.random = random.Random(seed)
+        self.clip_span = (clip_length - 1) * frame_stride + 1
+
+    def _clip_starts(self, num_frames):
+        num_starts = num_frames - self.clip_span + 1
+        if num_starts <= 0:
+            return []
+        if self.shuffle:
+            return [self.random.randrange(num_starts)
+                    for _ in range(self.clips_per_video)]
+        if self.clips_per_video == 1:
+            return [num_starts // 2]
+        return [int(round(x)) for x in np.linspace(0, num_starts - 1,
+                                                   self.clips_per_video)]
+
+    def __iter__(self):
+        clips = []
+        for video_name, frame_indices in self.video_frames.items():
+            for start in self._clip_starts(len(frame_indices)):
+                clips.append((video_name, frame_indices[
+                    start:start + self.clip_span:self.frame_stride]))
+        if self.shuffle:
+            self.random.shuffle(clips)
+        return iter(clips)
+
+    def __len__(self):
+        return sum(self.clips_per_video
+                   for frame_indices in self.video_frames.values()
+                   if len(frame_indices) >= self.clip_span)
+
+
+def prefetch(iterable, buffer_size=4):
+    """Iterate over iterable on a background thread.
+
+    Up to buffer_size items are computed ahead of the consumer. LMDB reads and
+    large numpy copies release the GIL, so this overlaps reading the next
+    batch with the training step on the current one.
+
+    Exceptions raised by iterable are re-raised in the consumer.
+    """
+    items = queue.Queue(maxsize=buffer_size)
+    finished = object()
+    stop = threading.Event()
+
+    def put(value):
+        """Queue value unless the consumer stops; return whether queued."""
+        while not stop.is_set():
+            try:
+                items.put(value, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((True, item)):
+                    return
+            put((True, finished))
+        except Exception as e:  # Re-raised in consumer.
+            put((False, e))
+
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            success, item = items.get()
+            if not success:
+                raise item
+            if item is finished:
+                return
+            yield item
+    finally:
+        stop.set()
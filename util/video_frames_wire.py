@@ -0,0 +1,389 @@
+"""Wire-level access to serialized messages from video_frames.proto.
+
+Parsing a LabeledVideoFrame with protobuf copies the image bytes into a new
+string, which dominates the cost of reading (and rewriting) frame LMDBs. The
+helpers here walk the protobuf wire format directly, so that callers can locate
+the image bytes inside a buffer (e.g. a memoryview from an LMDB transaction
+opened with buffers=True) without copying them, and rewrite individual fields
+while passing the rest of the message through untouched.
+
+Only the subset of the wire format used by video_frames.proto is supported.
+Field numbers below must be kept in sync with video_frames.proto.
+"""
+
+import collections
+
+WIRETYPE_VARINT = 0
+WIRETYPE_FIXED64 = 1
+WIRETYPE_LENGTH_DELIMITED = 2
+WIRETYPE_FIXED32 = 5
+
+# LabeledVideoFrame
+LABELED_FRAME_FIELD = 1
+LABELED_LABEL_FIELD = 2
+# VideoFrame
+FRAME_VIDEO_NAME_FIELD = 1
+FRAME_INDEX_FIELD = 2
+FRAME_IMAGE_FIELD = 3
+# Image
+IMAGE_CHANNELS_FIELD = 1
+IMAGE_HEIGHT_FIELD = 2
+IMAGE_WIDTH_FIELD = 3
+IMAGE_DATA_FIELD = 4
+# Label
+LABEL_NAME_FIELD = 1
+LABEL_ID_FIELD = 2
+# VideoFrameClip
+CLIP_VIDEO_NAME_FIELD = 1
+CLIP_START_FRAME_INDEX_FIELD = 2
+CLIP_NUM_FRAMES_FIELD = 3
+CLIP_CHANNELS_FIELD = 4
+CLIP_HEIGHT_FIELD = 5
+CLIP_WIDTH_FIELD = 6
+CLIP_DATA_FIELD = 7
+CLIP_FRAME_LABELS_FIELD = 8
+# FrameLabels
+FRAME_LABELS_LABEL_FIELD = 1
+
+ImageSpan = collections.namedtuple(
+    'ImageSpan', ['channels', 'height', 'width', 'data_start', 'data_end'])
+
+FrameInfo = collections.namedtuple(
+    'FrameInfo', ['video_name', 'frame_index', 'image'])
+
+ClipInfo = collections.namedtuple('ClipInfo', [
+    'video_name', 'start_frame_index', 'num_frames', 'channels', 'height',
+    'width', 'data_start', 'data_end'
+])
+
+
+def read_varint(buf, pos):
+    """Decode a varint starting at buf[pos].
+
+    Returns:
+        value (int), next_pos (int)
+
+    >>> read_varint(b'\\xac\\x02', 0)
+    (300, 2)
+    """
+    result = 0
+    shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+
+def encode_varint(value):
+    """Encode a non-negative (or int64 two's complement) integer as a varint.
+
+    >>> encode_varint(300) == b'\\xac\\x02'
+    True
+    """
+    if value < 0:
+        value += 1 << 64
+    pieces = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            pieces.append(byte | 0x80)
+        else:
+            pieces.append(byte)
+            return bytes(pieces)
+
+
+def to_signed64(value):
+    """Interpret an unsigned varint as an int64/int32 value."""
+    if value >= 1 << 63:
+        value -= 1 << 64
+    return value
+
+
+def iter_fields(buf, start=0, end=None):
+    """Iterate over the fields of a serialized message.
+
+    Args:
+        buf (bytes-like): Buffer containing the message.
+        start, end (int): Byte range of the message within buf.
+
+    Yields:
+        (field_number, wire_type, field_start, value_start, field_end): For
+            length-delimited fields, buf[value_start:field_end] is the payload.
+            For varints, the value can be decoded with
+            read_varint(buf, value_start). buf[field_start:field_end] is the
+            whole field, including its tag.
+    """
+    if end is None:
+        end = len(buf)
+    pos = start
+    while pos < end:
+        field_start = pos
+        tag, pos = read_varint(buf, pos)
+        field_number, wire_type = tag >> 3, tag & 0x7
+        value_start = pos
+        if wire_type == WIRETYPE_VARINT:
+            _, pos = read_varint(buf, pos)
+        elif wire_type == WIRETYPE_LENGTH_DELIMITED:
+            length, value_start = read_varint(buf, pos)
+            pos = value_start + length
+        elif wire_type == WIRETYPE_FIXED64:
+            pos += 8
+        elif wire_type == WIRETYPE_FIXED32:
+            pos += 4
+        else:
+            raise ValueError('Unsupported wire type %s at offset %s' %
+                             (wire_type, field_start))
+        if pos > end:
+            raise ValueError('Truncated field %s at offset %s' %
+                             (field_number, field_start))
+        yield field_number, wire_type, field_start, value_start, pos
+
+
+def encode_tag(field_number, wire_type):
+    return encode_varint((field_number << 3) | wire_type)
+
+
+def encode_length_delimited(field_number, payload):
+    return b''.join([encode_tag(field_number, WIRETYPE_LENGTH_DELIMITED),
+                     encode_varint(len(payload)), bytes(payload)])
+
+
+def encode_varint_field(field_number, value):
+    return encode_tag(field_number, WIRETYPE_VARINT) + encode_varint(value)
+
+
+def encode_image(channels, height, width, data):
+    """Serialize an Image message.
+
+    Equivalent to setting the fields on video_frames_pb2.Image() and calling
+    SerializeToString(), without copying data through protobuf.
+    """
+    return b''.join([
+        encode_varint_field(IMAGE_CHANNELS_FIELD, channels),
+        encode_varint_field(IMAGE_HEIGHT_FIELD, height),
+        encode_varint_field(IMAGE_WIDTH_FIELD, width),
+        encode_length_delimited(IMAGE_DATA_FIELD, data)
+    ])
+
+
+def encode_label(name, label_id):
+    """Serialize a Label as a LabeledVideoFrame.label field (tag included)."""
+    label = (encode_length_delimited(LABEL_NAME_FIELD, name.encode('utf-8')) +
+             encode_varint_field(LABEL_ID_FIELD, label_id))
+    return encode_length_delimited(LABELED_LABEL_FIELD, label)
+
+
+def frame_span(buf, labeled=True):
+    """Return the (start, end) byte range of the VideoFrame within buf.
+
+    Args:
+        buf (bytes-like): Serialized LabeledVideoFrame (if labeled) or
+            VideoFrame.
+        labeled (bool): Whether buf is a LabeledVideoFrame.
+    """
+    if not labeled:
+        return 0, len(buf)
+    span = None
+    for field, wire_type, _, value_start, field_end in iter_fields(buf):
+        if field == LABELED_FRAME_FIELD:
+            span = (value_start, field_end)
+    if span is None:
+        raise ValueError('LabeledVideoFrame has no frame.')
+    return span
+
+
+def parse_image(buf, start, end):
+    """Parse an Image message without copying its data.
+
+    Returns:
+        ImageSpan: buf[data_start:data_end] contains the image bytes.
+    """
+    channels = height = width = 0
+    data_start = data_end = start
+    for field, wire_type, _, value_start, field_end in iter_fields(buf, start,
+                                                                   end):
+        if field == IMAGE_CHANNELS_FIELD:
+            channels = read_varint(buf, value_start)[0]
+        elif field == IMAGE_HEIGHT_FIELD:
+            height = read_varint(buf, value_start)[0]
+        elif field == IMAGE_WIDTH_FIELD:
+            width = read_varint(buf, value_start)[0]
+        elif field == IMAGE_DATA_FIELD:
+            data_start, data_end = value_start, field_end
+    return ImageSpan(channels, height, width, data_start, data_end)
+
+
+def parse_frame(buf, labeled=True):
+    """Parse the VideoFrame in buf without copying image data.
+
+    Returns:
+        FrameInfo: image is an ImageSpan, or None if the frame has no image.
+    """
+    start, end = frame_span(buf, labeled)
+    video_name = None
+    frame_index = 0
+    image = None
+    for field, wire_type, _, value_start, field_end in iter_fields(buf, start,
+                                                                   end):
+        if field == FRAME_VIDEO_NAME_FIELD:
+            video_name = bytes(buf[value_start:field_end]).decode('utf-8')
+        elif field == FRAME_INDEX_FIELD:
+            frame_index = to_signed64(read_varint(buf, value_start)[0])
+        elif field == FRAME_IMAGE_FIELD:
+            image = parse_image(buf, value_start, field_end)
+    return FrameInfo(video_name, frame_index, image)
+
+
+def parse_labels(buf, start=0, end=None, label_field=LABELED_LABEL_FIELD):
+    """Return the (name, id) pairs of the labels in a LabeledVideoFrame.
+
+    Args:
+        buf (bytes-like)
+        start, end (int): Byte range of the message within buf.
+        label_field (int): Field number of the repeated Label field, for
+            messages other than LabeledVideoFrame (e.g. FrameLabels).
+    """
+    labels = []
+    for field, wire_type, _, value_start, field_end in iter_fields(
+            buf, start, end):
+        if field != label_field:
+            continue
+        name, label_id = None, 0
+        for label_field_number, _, _, label_start, label_end in iter_fields(
+                buf, value_start, field_end):
+            if label_field_number == LABEL_NAME_FIELD:
+                name = bytes(buf[label_start:label_end]).decode('utf-8')
+            elif label_field_number == LABEL_ID_FIELD:
+                label_id = to_signed64(read_varint(buf, label_start)[0])
+        labels.append((name, label_id))
+    return labels
+
+
+def parse_clip(buf):
+    """Parse a VideoFrameClip without copying its data.
+
+    Returns:
+        ClipInfo: buf[data_start:data_end] contains the frames.
+    """
+    values = {
+        CLIP_START_FRAME_INDEX_FIELD: 0,
+        CLIP_NUM_FRAMES_FIELD: 0,
+        CLIP_CHANNELS_FIELD: 0,
+        CLIP_HEIGHT_FIELD: 0,
+        CLIP_WIDTH_FIELD: 0
+    }
+    video_name = None
+    data_start = data_end = 0
+    for field, wire_type, _, value_start, field_end in iter_fields(buf):
+        if field == CLIP_VIDEO_NAME_FIELD:
+            video_name = bytes(buf[value_start:field_end]).decode('utf-8')
+        elif field == CLIP_DATA_FIELD:
+            data_start, data_end = value_start, field_end
+        elif field in values:
+            values[field] = to_signed64(read_varint(buf, value_start)[0])
+    return ClipInfo(video_name, values[CLIP_START_FRAME_INDEX_FIELD],
+                    values[CLIP_NUM_FRAMES_FIELD], values[CLIP_CHANNELS_FIELD],
+                    values[CLIP_HEIGHT_FIELD], values[CLIP_WIDTH_FIELD],
+                    data_start, data_end)
+
+
+def parse_clip_labels(buf):
+    """Return a list of (name, id) label pairs for each frame of a clip."""
+    return [
+        parse_labels(buf, value_start, field_end, FRAME_LABELS_LABEL_FIELD)
+        for field, _, _, value_start, field_end in iter_fields(buf)
+        if field == CLIP_FRAME_LABELS_FIELD
+    ]
+
+
+def replace_image(buf, image_bytes, labeled=True):
+    """Return a copy of buf with the frame's Image replaced by image_bytes.
+
+    All other fields are copied through byte for byte; only the Image payload
+    is rewritten, and only the length prefixes that enclose it are
+    re-encoded.
+
+    Args:
+        buf (bytes-like): Serialized LabeledVideoFrame (if labeled) or
+            VideoFrame.
+        image_bytes (bytes): Serialized Image message, e.g. from encode_image.
+        labeled (bool): Whether buf is a LabeledVideoFrame.
+
+    Returns:
+        bytes
+    """
+    def rewrite_frame(start, end):
+        pieces = []
+        for field, _, field_start, _, field_end in iter_fields(buf, start,
+                                                               end):
+            if field != FRAME_IMAGE_FIELD:
+                pieces.append(buf[field_start:field_end])
+        pieces.append(encode_length_delimited(FRAME_IMAGE_FIELD, image_bytes))
+        return b''.join(pieces)
+
+    if not labeled:
+        return rewrite_frame(0, len(buf))
+    pieces = []
+    for field, _, field_start, value_start, field_end in iter_fields(buf):
+        if field == LABELED_FRAME_FIELD:
+            pieces.append(encode_length_delimited(
+                LABELED_FRAME_FIELD, rewrite_frame(value_start, field_end)))
+        else:
+            pieces.append(buf[field_start:field_end])
+    return b''.join(pieces)
+
+
+def strip_image_data(buf, labeled=True):
+    """Return a copy of buf with the image bytes cleared.
+
+    The image header (channels, height, width) is kept. The output is
+    identical to parsing buf, setting frame.image.data = '' and reserializing,
+    but the image bytes are never copied.
+    """
+    start, end = frame_span(buf, labeled)
+    image = None
+    for field, _, _, value_start, field_end in iter_fields(buf, start, end):
+        if field == FRAME_IMAGE_FIELD:
+            image = parse_image(buf, value_start, field_end)
+    if image is None:
+        return bytes(buf)
+    return replace_image(buf,
+                         encode_image(image.channels, image.height,
+                                      image.width, b''),
+                         labeled=labeled)
+
+
+def encode_labels(labels, label_ids):
+    """Serialize labels as the label fields of a LabeledVideoFrame.
+
+    Args:
+        labels (list of str): Label names, in output order.
+        label_ids (dict): Maps label name to id.
+
+    Returns:
+        bytes: A serialized LabeledVideoFrame containing only labels. It can
+            be appended to a serialized frame field (see replace_labels), or
+            stored on its own and read with parse_labels.
+    """
+    return b''.join(encode_label(label, label_ids[label]) for label in labels)
+
+
+def replace_labels(buf, labels_bytes):
+    """Return a copy of a LabeledVideoFrame with its labels replaced.
+
+    The frame (including the image bytes) is copied through without being
+    parsed.
+
+    Args:
+        buf (bytes-like): Serialized LabeledVideoFrame.
+        labels_bytes (bytes): New labels, e.g. from encode_labels.
+    """
+    pieces = [buf[field_start:field_end]
+              for field, _, field_start, _, field_end in iter_fields(buf)
+              if field != LABELED_LABEL_FIELD]
+    pieces.append(labels_bytes)
+    return b''.join(pieces)
@@ -0,0 +1,153 @@
+"""Read videos exported as per-video NumPy arrays by frames_to_npy_memmaps.py.
+
+Each video is stored as one (num_frames, channels, height, width) uint8 .npy
+file (and optionally a (num_frames, num_classes) uint8 label matrix), which is
+opened as a read-only memory map. Reading a clip is a slice of the memory map:
+no copies are made until the data is used, and sequential frames are
+contiguous on disk.
+
+The output directory layout is:
+
+    <root>/
+        index.json
+        frames/<video_name>.npy
+        labels/<video_name>.npy  (optional)
+        frame_indices/<video_name>.npy  (only for non-contiguous videos)
+"""
+
+import json
+import os
+
+import numpy as np
+
+INDEX_FILENAME = 'index.json'
+
+
+def video_paths(root, video_name):
+    """Return (frames, labels, frame_indices) paths for a video."""
+    filename = video_name + '.npy'
+    return (os.path.join(root, 'frames', filename),
+            os.path.join(root, 'labels', filename),
+            os.path.join(root, 'frame_indices', filename))
+
+
+class VideoMemmapDataset(object):
+    """Access frames and labels of videos exported to NumPy memory maps."""
+
+    def __init__(self, root):
+        self.root = root
+        with open(os.path.join(root, INDEX_FILENAME)) as f:
+            index = json.load(f)
+        self.num_classes = index.get('num_classes')
+        self.videos = index['videos']
+        self._frames = {}
+        self._labels = {}
+        self._frame_indices = {}
+
+    def video_names(self):
+        return sorted(self.videos)
+
+    def num_frames(self, video_name):
+        return self.videos[video_name]['num_frames']
+
+    def frame_indices(self, video_name):
+        """Return the frame indices stored for a video, in order."""
+        if video_name not in self._frame_indices:
+            info = self.videos[video_name]
+            if info.get('first_frame_index') is not None:
+                indices = np.arange(info['first_frame_index'],
+                                    info['first_frame_index'] +
+                                    info['num_frames'])
+            else:
+                indices = np.load(video_paths(self.root, video_name)[2])
+            self._frame_indices[video_name] = indices
+        return self._frame_indices[video_name]
+
+    def frames_memmap(self, video_name):
+        """Return the (num_frames, channels, height, width) memmap."""
+        if video_name not in self._frames:
+            self._frames[video_name] = np.load(
+                video_paths(self.root, video_name)[0], mmap_mode='r')
+        return self._frames[video_name]
+
+    def labels_memmap(self, video_name):
+        """Return the (num_frames, num_classes) memmap, or None."""
+        if not self.videos[video_name].get('has_labels'):
+            return None
+        if video_name not in self._labels:
+            self._labels[video_name] = np.load(
+                video_paths(self.root, video_name)[1], mmap_mode='r')
+        return self._labels[video_name]
+
+    def _position(self, video_name, frame_index):
+        """Convert a frame index to a row of the video's arrays.
+
+        One past the last frame index maps to num_frames, so that it can end
+        a range.
+
+        Raises:
+            IndexError: If frame_index is before the first frame, or more
+                than one past the last frame.
+        """
+        info = self.videos[video_name]
+        contiguous = info.get('first_frame_index') is not None
+        if contiguous:
+            first_index = info['first_frame_index']
+            end_index = first_index + info['num_frames']
+        else:
+            indices = self.frame_indices(video_name)
+            first_index, end_index = indices[0], indices[-1] + 1
+        if not first_index <= frame_index <= end_index:
+            raise IndexError(
+                'Frame index %s is out of range [%s, %s] for %s' %
+                (frame_index, first_index, end_index, video_name))
+        if contiguous:
+            return frame_index - first_index
+        return int(np.searchsorted(indices, frame_index))
+
+    def rows(self, video_name, start_frame, end_frame):
+        """Return the slice of rows for frame indices [start_frame,
+        end_frame).
+
+        Raises:
+            IndexError: If start_frame or end_frame is out of range (see
+                _position).
+            ValueError: If start_frame is after end_frame.
+        """
+        if start_frame > end_frame:
+            raise ValueError('start_frame (%s) is after end_frame (%s)' %
+                             (start_frame, end_frame))
+        return slice(self._position(video_name, start_frame),
+                     self._position(video_name, end_frame))
+
+    def frames(self, video_name, start_frame, end_frame, step=1):
+        """Return frames with indices in [start_frame, end_frame).
+
+        step strides over stored rows, not frame indices: for videos that
+        were not exported with consecutive frame indices, step=2 returns
+        every other stored frame in the range.
+
+        Returns:
+            frames (np.memmap, shape (num_frames, channels, height, width)): A
+                view into the memory map; no data is copied.
+
+        Raises:
+            IndexError, ValueError: See rows.
+        """
+        rows = self.rows(video_name, start_frame, end_frame)
+        return self.frames_memmap(video_name)[rows.start:rows.stop:step]
+
+    def labels(self, video_name, start_frame, end_frame, step=1):
+        """Return labels (num_frames, num_classes) for frames in
+        [start_frame, end_frame), or None if the video has no labels.
+
+        As in frames, step strides over stored rows, not frame indices.
+
+        Raises:
+            IndexError, ValueError: See rows.
+        """
+        labels = self.labels_memmap(video_name)
+        if labels is None:
+            return None
+        rows = self.rows(video_name, start_frame, end_frame)
+        return labels[rows.start:rows.stop:step]
@@ -0,0 +1,268 @@
+"""Verify a frame LMDB and report statistics about it as JSON.
+
+Checks an LMDB of LabeledVideoFrames (or VideoFrames) as created by
+frames_to_labeled_video_frames_lmdb.py:
+
+    - Every value parses, and its video_name/frame_index match its key.
+    - Every image has channels * height * width bytes.
+    - The frame indices of each video are contiguous.
+    - Optionally, the videos and frames match a frames directory or a manifest
+      of frame paths.
+
+and reports the number of frames per label and per image shape. The key space
+is split into ranges that are scanned in parallel; image bytes are skipped at
+the wire level rather than parsed.
+
+Exits with a non-zero status if any check fails.
+"""
+
+import argparse
+import collections
+import glob
+import json
+import logging
+import multiprocessing as mp
+import sys
+
+from tqdm import tqdm
+
+from frame_loader_util import parse_frame_path
+from util.lmdb_transform import key_ranges
+from util.video_frames_reader import open_readonly_lmdb, parse_frame_key
+from util.video_frames_wire import parse_frame, parse_labels
+
+# Maximum number of example errors of each kind to include in the report.
+MAX_ERROR_EXAMPLES = 100
+
+
+def _new_stats():
+    return {
+        'num_records': 0,
+        'errors': collections.defaultdict(list),
+        'num_errors': collections.Counter(),
+        # Maps video name to [min frame index, max frame index, count].
+        'videos': {},
+        'label_counts': collections.Counter(),
+        'image_shapes': collections.Counter(),
+    }
+
+
+def _add_error(stats, kind, key, message):
+    stats['num_errors'][kind] += 1
+    if len(stats['errors'][kind]) < MAX_ERROR_EXAMPLES:
+        stats['errors'][kind].append('%s: %s' % (key, message))
+
+
+def scan_range(args):
+    """Scan num_keys records starting at start_key.
+
+    Args:
+        args (tuple): (lmdb_path, labeled, full_parse, start_key, num_keys)
+
+    Returns:
+        stats (dict): See _new_stats.
+    """
+    lmdb_path, labeled, full_parse, start_key, num_keys = args
+    if full_parse:
+        from util import video_frames_pb2
+        message_class = (video_frames_pb2.LabeledVideoFrame
+                         if labeled else video_frames_pb2.VideoFrame)
+    stats = _new_stats()
+    with open_readonly_lmdb(lmdb_path).begin(buffers=True) as transaction:
+        cursor = transaction.cursor()
+        cursor.set_key(start_key)
+        for i, (key, value) in enumerate(cursor):
+            if i == num_keys:
+                break
+            stats['num_records'] += 1
+            key = bytes(key).decode('utf-8', 'replace')
+            try:
+                key_video, key_index = parse_frame_key(key.encode('utf-8'))
+            except ValueError:
+                _add_error(stats, 'invalid_key', key, 'not <video>-<frame>')
+                continue
+            video = stats['videos'].get(key_video)
+            if video is None:
+                stats['videos'][key_video] = [key_index, key_index, 1]
+            else:
+                video[0] = min(video[0], key_index)
+                video[1] = max(video[1], key_index)
+                video[2] += 1
+
+            try:
+                if full_parse:
+                    message_class().ParseFromString(bytes(value))
+                frame = parse_frame(value, labeled)
+                labels = parse_labels(value) if labeled else []
+            except Exception as e:
+                _add_error(stats, 'parse_error', key, repr(e))
+                continue
+
+            if (frame.video_name, frame.frame_index) != (key_video, key_index):
+                _add_error(stats, 'key_mismatch', key,
+                           'value is %s-%s' % (frame.video_name,
+                                               frame.frame_index))
+            image = frame.image
+            if image is None:
+                _add_error(stats, 'missing_image', key, 'no image')
+            else:
+                expected_size = image.channels * image.height * image.width
+                size = image.data_end - image.data_start
+                if size != expected_size:
+                    _add_error(stats, 'image_size_mismatch', key,
+                               '%s bytes for shape %sx%sx%s' %
+                               (size, image.channels, image.height,
+                                image.width))
+                stats['image_shapes']['%sx%sx%s' % (
+                    image.channels, image.height, image.width)] += 1
+            for name, label_id in labels:
+                stats['label_counts'][(label_id, name)] += 1
+    return stats
+
+
+def merge_stats(total, stats):
+    total['num_records'] += stats['num_records']
+    total['num_errors'].update(stats['num_errors'])
+    for kind, examples in stats['errors'].items():
+        room = MAX_ERROR_EXAMPLES - len(total['errors'][kind])
+        total['errors'][kind].extend(examples[:room])
+    for name, (first, last, count) in stats['videos'].items():
+        video = total['videos'].get(name)
+        if video is None:
+            total['videos'][name] = [first, last, count]
+        else:
+            video[0] = min(video[0], first)
+            video[1] = max(video[1], last)
+            video[2] += count
+    total['label_counts'].update(stats['label_counts'])
+    total['image_shapes'].update(stats['image_shapes'])
+
+
+def load_expected_frames(frames_root=None, manifest=None):
+    """Load expected frame indices per video.
+
+    Args:
+        frames_root (str): Directory containing <video>/frame<index>.png.
+        manifest (str): File containing one frame path per line.
+
+    Returns:
+        expected (dict): Maps video name to set of frame indices.
+    """
+    if frames_root is not None:
+        frame_paths = glob.iglob('{}/*/*.png'.format(frames_root))
+    else:
+        with open(manifest) as f:
+            frame_paths = [line.strip() for line in f if line.strip()]
+    expected = collections.defaultdict(set)
+    for frame_path in frame_paths:
+        frame_info = parse_frame_path(frame_path)
+        if frame_info is not None:
+            expected[frame_info[0]].add(frame_info[1])
+    return expected
+
+
+def check_against_expected(report, videos, expected):
+    """Compare per-video frame ranges to expected frame indices."""
+    missing_videos = sorted(set(expected) - set(videos))
+    extra_videos = sorted(set(videos) - set(expected))
+    mismatched = {}
+    for name in sorted(set(expected) & set(videos)):
+        first, last, count = videos[name]
+        indices = expected[name]
+        if (min(indices), max(indices), len(indices)) != (first, last, count):
+            mismatched[name] = {
+                'expected': [min(indices), max(indices), len(indices)],
+                'found': [first, last, count]
+            }
+    report['expected_frames'] = {
+        'num_expected_frames': sum(len(x) for x in expected.values()),
+        'missing_videos': missing_videos,
+        'extra_videos': extra_videos,
+        'mismatched_videos': mismatched,
+    }
+    return not (missing_videos or extra_videos or mismatched)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n')[0],
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('lmdb')
+    parser.add_argument('--output_json',
+                        help='Path to write report to. Defaults to stdout.')
+    parser.add_argument('--video_frames',
+                        action='store_true',
+                        help="""LMDB contains VideoFrames instead of
+                        LabeledVideoFrames.""")
+    parser.add_argument('--full_parse',
+                        action='store_true',
+                        help="""Also parse every value with protobuf. Slower,
+                        but catches errors the wire-level scan does not (e.g.
+                        invalid UTF-8 strings).""")
+    expected_group = parser.add_mutually_exclusive_group()
+    expected_group.add_argument('--frames_root',
+                                help="""Check that the LMDB contains exactly
+                                the frames in this directory.""")
+    expected_group.add_argument('--manifest',
+                                help="""Check that the LMDB contains exactly
+                                the frames listed (one path per line) in this
+                                file.""")
+    parser.add_argument('--num_processes', default=8, type=int)
+    parser.add_argument('--range_size', default=10000, type=int)
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.INFO)
+    logging.basicConfig(format='%(asctime)s.%(msecs).03d: %(message)s',
+                        datefmt='%H:%M:%S')
+
+    ranges = key_ranges(args.lmdb, args.range_size)
+    tasks = [(args.lmdb, not args.video_frames, args.full_parse, start_key,
+              num_keys) for start_key, num_keys in ranges]
+    total = _new_stats()
+    pool = mp.Pool(args.num_processes)
+    progress = tqdm(total=sum(num_keys for _, num_keys in ranges))
+    for stats in pool.imap_unordered(scan_range, tasks):
+        merge_stats(total, stats)
+        progress.update(stats['num_records'])
+    pool.close()
+    progress.close()
+
+    videos = total['videos']
+    non_contiguous = {
+        name: {'first': first, 'last': last, 'count': count,
+               'num_missing': last - first + 1 - count}
+        for name, (first, last, count) in videos.items()
+        if last - first + 1 != count
+    }
+    report = collections.OrderedDict([
+        ('lmdb', args.lmdb),
+        ('num_records', total['num_records']),
+        ('num_videos', len(videos)),
+        ('num_errors', dict(total['num_errors'])),
+        ('error_examples', dict(total['errors'])),
+        ('non_contiguous_videos', non_contiguous),
+        ('image_shapes', dict(total['image_shapes'])),
+        ('label_counts', collections.OrderedDict(
+            ('%s %s' % (label_id, name), count)
+            for (label_id, name), count in sorted(
+                total['label_counts'].items(), key=lambda x: x[0][0]))),
+    ])
+    ok = not total['num_errors'] and not non_contiguous
+    if args.frames_root or args.manifest:
+        expected = load_expected_frames(args.frames_root, args.manifest)
+        ok = check_against_expected(report, videos, expected) and ok
+    report['ok'] = ok
+
+    if args.output_json:
+        with open(args.output_json, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print('')
+    if not ok:
+        logging.error('Verification failed; see report.')
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()